@@ -0,0 +1,274 @@
+import argparse
+import json
+import os
+import tempfile
+from collections import OrderedDict
+from typing import NamedTuple
+
+import numpy as np
+import torch
+from torch import nn
+
+from constants import latent_dim, sidelength, z_range
+from model import VAE
+from util import state_dict_digest
+
+
+class AtlasError(NamedTuple):
+    resolution: int
+    mode: str
+    mean_abs_error: float
+    max_abs_error: float
+    num_bytes: int
+
+
+def atlas_path(weights_path: str) -> str:
+    """
+    Returns the atlas path belonging to a checkpoint, e.g. vae_0.atlas.npy for vae_0.pth.
+    """
+    return os.path.splitext(weights_path)[0] + ".atlas.npy"
+
+
+def lattice(resolution: int, value_range: tuple[float, float] = z_range) -> np.ndarray:
+    return np.linspace(value_range[0], value_range[1], resolution, dtype=np.float32)
+
+
+def to_uint8_images(images: torch.Tensor) -> np.ndarray:
+    return (images * 255.0).round().to(torch.uint8).permute(0, 2, 3, 1).cpu().numpy()
+
+
+def build_atlas(
+    decoder: nn.Module,
+    path: str,
+    resolution: int = 256,
+    value_range: tuple[float, float] = z_range,
+    batch_size: int = 4096,
+) -> None:
+    """
+    Decodes a resolution x resolution lattice over value_range (in both latent dimensions) and
+    stores the images as a memory-mappable array.
+
+    The atlas is a .npy file of shape (resolution, resolution, sidelength, sidelength, 3) (uint8),
+    where atlas[i, j] is the decoding of (lattice[i], lattice[j]). The lattice parameters and a
+    digest of the decoder weights are stored next to it in <path>.json.
+
+    Args:
+        decoder (nn.Module): The decoder.
+        path (str): Path of the atlas file.
+        resolution (int): Number of lattice points per latent dimension.
+        value_range (tuple[float, float]): Range covered in both latent dimensions.
+        batch_size (int): Number of lattice points decoded at once.
+    """
+    if latent_dim != 2:
+        raise ValueError("Atlases are only supported for a 2D latent space.")
+    if resolution < 2:
+        raise ValueError("An atlas needs at least 2 lattice points per dimension.")
+    points = lattice(resolution, value_range)
+    grid = np.stack(np.meshgrid(points, points, indexing="ij"), axis=-1).reshape(-1, 2)
+    tmp_path = f"{path}.tmp.npy"
+    atlas = np.lib.format.open_memmap(
+        tmp_path,
+        mode="w+",
+        dtype=np.uint8,
+        shape=(resolution * resolution, sidelength, sidelength, 3),
+    )
+    device = next(decoder.parameters()).device
+    with torch.no_grad():
+        for start in range(0, len(grid), batch_size):
+            z = torch.from_numpy(grid[start : start + batch_size]).to(device)
+            atlas[start : start + batch_size] = to_uint8_images(decoder(z))
+    atlas.flush()
+    del atlas
+    with open(f"{path}.json", "w") as f:
+        json.dump(
+            {
+                "resolution": resolution,
+                "value_range": list(value_range),
+                "state_dict": state_dict_digest(decoder),
+            },
+            f,
+        )
+    os.replace(tmp_path, path)
+
+
+class Atlas:
+    def __init__(
+        self,
+        path: str,
+        tile_size: int = 16,
+        memory_budget: int = 64 * 1024**2,
+        decoder: nn.Module | None = None,
+    ):
+        """
+        Looks up decoded images in an atlas written by build_atlas, without running the model.
+
+        The atlas is memory-mapped and read in square tiles of tile_size x tile_size lattice
+        points. Tiles are kept in an LRU cache; the least recently used ones are evicted once the
+        cached tiles exceed memory_budget bytes.
+
+        Args:
+            path (str): Path of the atlas file.
+            tile_size (int): Lattice points per tile side.
+            memory_budget (int): Maximum size of the cached tiles in bytes.
+            decoder (nn.Module | None): If given, check that the atlas was built from its weights.
+        """
+        with open(f"{path}.json") as f:
+            meta = json.load(f)
+        if decoder is not None and meta["state_dict"] != state_dict_digest(decoder):
+            raise ValueError(f"{path} was built from different weights")
+        self.resolution: int = meta["resolution"]
+        if self.resolution < 2:
+            raise ValueError(f"{path} has fewer than 2 lattice points per dimension")
+        low, high = meta["value_range"]
+        self.value_range = (float(low), float(high))
+        self.data = np.load(path, mmap_mode="r").reshape(
+            self.resolution, self.resolution, sidelength, sidelength, 3
+        )
+        self.tile_size = tile_size
+        self.memory_budget = memory_budget
+        self.tiles: OrderedDict[tuple[int, int], np.ndarray] = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def tile(self, ti: int, tj: int) -> np.ndarray:
+        key = (ti, tj)
+        if key in self.tiles:
+            self.hits += 1
+            self.tiles.move_to_end(key)
+            return self.tiles[key]
+        self.misses += 1
+        s = self.tile_size
+        tile = np.array(self.data[ti * s : (ti + 1) * s, tj * s : (tj + 1) * s])
+        self.tiles[key] = tile
+        self.cached_bytes += tile.nbytes
+        # Always keep the tile that was just loaded
+        while self.cached_bytes > self.memory_budget and len(self.tiles) > 1:
+            _, evicted = self.tiles.popitem(last=False)
+            self.cached_bytes -= evicted.nbytes
+        return tile
+
+    def gather(self, i: np.ndarray, j: np.ndarray) -> np.ndarray:
+        """
+        Returns the images at lattice indices (i, j), reading them through the tile cache.
+        """
+        images = np.empty((len(i), sidelength, sidelength, 3), dtype=np.uint8)
+        tile_keys = np.stack([i // self.tile_size, j // self.tile_size], axis=1)
+        keys, inverse = np.unique(tile_keys, axis=0, return_inverse=True)
+        for k, (ti, tj) in enumerate(keys):
+            mask = inverse.reshape(-1) == k
+            tile = self.tile(int(ti), int(tj))
+            images[mask] = tile[i[mask] % self.tile_size, j[mask] % self.tile_size]
+        return images
+
+    def positions(self, z: np.ndarray) -> np.ndarray:
+        """
+        Returns the (fractional) lattice positions of latent vectors of shape (n, 2), clipped to
+        the atlas. Infinite values are clipped as well; NaNs are rejected.
+        """
+        z = np.asarray(z, dtype=np.float64)
+        if np.isnan(z).any():
+            raise ValueError("Latent vectors must not contain NaN")
+        low, high = self.value_range
+        positions = (z - low) / (high - low) * (self.resolution - 1)
+        clipped: np.ndarray = np.clip(positions, 0, self.resolution - 1)
+        return clipped
+
+    def nearest(self, z: np.ndarray) -> np.ndarray:
+        positions = np.rint(self.positions(z)).astype(np.int64)
+        return self.gather(positions[:, 0], positions[:, 1])
+
+    def bilinear(self, z: np.ndarray) -> np.ndarray:
+        positions = self.positions(z)
+        low = np.minimum(np.floor(positions).astype(np.int64), self.resolution - 2)
+        frac = (positions - low)[:, :, None, None, None]
+        i, j = low[:, 0], low[:, 1]
+        result = (1 - frac[:, 0]) * (1 - frac[:, 1]) * self.gather(i, j)
+        result += (1 - frac[:, 0]) * frac[:, 1] * self.gather(i, j + 1)
+        result += frac[:, 0] * (1 - frac[:, 1]) * self.gather(i + 1, j)
+        result += frac[:, 0] * frac[:, 1] * self.gather(i + 1, j + 1)
+        images: np.ndarray = np.rint(result).astype(np.uint8)
+        return images
+
+    def lookup(self, z: np.ndarray, mode: str = "bilinear") -> np.ndarray:
+        """
+        Returns the images of shape (n, sidelength, sidelength, 3) (uint8) for latent vectors of
+        shape (n, 2). Latents outside the atlas are clipped to its border.
+
+        Args:
+            z (np.ndarray): The latent vectors.
+            mode (str): "nearest" or "bilinear".
+        """
+        if mode == "nearest":
+            return self.nearest(z)
+        if mode == "bilinear":
+            return self.bilinear(z)
+        raise ValueError(f"Unknown lookup mode {mode}")
+
+
+def error_report(
+    decoder: nn.Module,
+    resolutions: list[int],
+    num_samples: int = 1000,
+    seed: int = 0,
+) -> list[AtlasError]:
+    """
+    Compares atlas lookups at several lattice resolutions to true decoding at random latents in
+    z_range.
+
+    Returns:
+        list[AtlasError]: Per resolution and lookup mode, the mean and maximum absolute pixel
+            difference (in uint8 units) and the atlas size in bytes.
+    """
+    rng = np.random.default_rng(seed)
+    z = rng.uniform(z_range[0], z_range[1], (num_samples, 2)).astype(np.float32)
+    with torch.no_grad():
+        expected = to_uint8_images(decoder(torch.from_numpy(z))).astype(np.int16)
+    rows = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for resolution in resolutions:
+            path = os.path.join(tmp_dir, f"atlas_{resolution}.npy")
+            build_atlas(decoder, path, resolution)
+            atlas = Atlas(path)
+            for mode in ["nearest", "bilinear"]:
+                diff = np.abs(atlas.lookup(z, mode).astype(np.int16) - expected)
+                rows.append(
+                    AtlasError(
+                        resolution,
+                        mode,
+                        float(diff.mean()),
+                        float(diff.max()),
+                        os.path.getsize(path),
+                    )
+                )
+    return rows
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description="Build decoded-image atlases and check them")
+    parser.add_argument("command", choices=["build", "report"])
+    parser.add_argument("--weights", help="VAE state dict, e.g. vae_0.pth", required=True)
+    parser.add_argument("--resolution", type=int, default=256)
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[32, 64, 128, 256])
+    parser.add_argument("--num-samples", type=int, default=1000)
+    args = parser.parse_args()
+
+    vae = VAE(latent_dim)
+    vae.load_state_dict(torch.load(args.weights, map_location="cpu"))
+    vae.eval()
+
+    if args.command == "build":
+        path = atlas_path(args.weights)
+        build_atlas(vae.decoder, path, args.resolution)
+        print(f"Wrote {path} ({os.path.getsize(path) / 1024**2:.1f} MiB)")
+    else:
+        print(f"{'resolution':>10}  {'mode':8}  {'mean err':>8}  {'max err':>7}  {'size':>9}")
+        for row in error_report(vae.decoder, args.resolutions, args.num_samples):
+            print(
+                f"{row.resolution:10}  {row.mode:8}  {row.mean_abs_error:8.3f}  "
+                f"{row.max_abs_error:7.0f}  {row.num_bytes / 1024**2:7.1f}Mi"
+            )
+
+
+if __name__ == "__main__":
+    run()
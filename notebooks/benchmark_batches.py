@@ -0,0 +1,83 @@
+import argparse
+import time
+from typing import Iterable, Iterator
+
+import torch
+
+from constants import sidelength
+from elbo import approximate_elbo
+from model import VAE
+from util import BatchIterator, DeviceBatchIterator
+
+
+class HostBatches:
+    """
+    The loading path of training.train: shuffle on the host, normalize and transfer every batch.
+    """
+
+    def __init__(self, data: torch.Tensor, batch_size: int, device: torch.device):
+        self.batch_iterator = BatchIterator(data, batch_size)
+        self.device = device
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        for batch in self.batch_iterator:
+            yield (batch / 255.0).to(self.device)
+
+
+def steps_per_second(
+    batches: Iterable[torch.Tensor], device: torch.device, num_epochs: int, with_model: bool
+) -> float:
+    vae = VAE(2).to(device)
+    optimizer = torch.optim.Adam(vae.parameters(), lr=1e-3)
+    num_steps = 0
+    start = time.perf_counter()
+    for _ in range(num_epochs):
+        for x in batches:
+            num_steps += 1
+            if not with_model:
+                continue
+            enc_mu, enc_logvar, dec_mu = vae(x)
+            loss = -approximate_elbo(
+                x.view(x.shape[0], sidelength * sidelength * 3),
+                dec_mu.view(dec_mu.shape[0], sidelength * sidelength * 3),
+                enc_mu,
+                enc_logvar,
+            ).mean()
+            optimizer.zero_grad()
+            loss.backward()  # type: ignore[no-untyped-call]
+            optimizer.step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return num_steps / (time.perf_counter() - start)
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description="Compare BatchIterator and DeviceBatchIterator")
+    parser.add_argument("--num-samples", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--num-epochs", type=int, default=3)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--with-model", action="store_true", help="Include forward/backward")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    data = torch.randint(0, 256, (args.num_samples, 3, sidelength, sidelength), dtype=torch.uint8)
+    loaders: dict[str, Iterable[torch.Tensor]] = {
+        "BatchIterator": HostBatches(data, args.batch_size, device),
+    }
+    for dtype in [torch.uint8, torch.float32, torch.bfloat16]:
+        for prefetch in [0, 2]:
+            name = f"DeviceBatchIterator({str(dtype).removeprefix('torch.')}, prefetch={prefetch})"
+            loaders[name] = DeviceBatchIterator(
+                data, args.batch_size, device, dtype=dtype, prefetch=prefetch
+            )
+
+    baseline = None
+    for name, batches in loaders.items():
+        rate = steps_per_second(batches, device, args.num_epochs, args.with_model)
+        baseline = baseline or rate
+        print(f"{name:50} {rate:10.1f} steps/s  {rate / baseline:5.2f}x")
+
+
+if __name__ == "__main__":
+    run()
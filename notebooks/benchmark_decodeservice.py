@@ -0,0 +1,75 @@
+import argparse
+import asyncio
+import time
+
+import numpy as np
+
+from constants import latent_dim
+from decodeservice import DecodeService, MicroBatcher, load_decoder
+from model import VAE
+
+
+async def client(port: int, num_requests: int, seed: int, latencies: list[float]) -> None:
+    rng = np.random.default_rng(seed)
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    for z in rng.uniform(-3.0, 3.0, (num_requests, 2)):
+        start = time.perf_counter()
+        writer.write(f"GET /decode?z={z[0]},{z[1]}&format=raw HTTP/1.1\r\n\r\n".encode())
+        await writer.drain()
+        content_length = 0
+        status = await reader.readline()
+        while (line := await reader.readline()) != b"\r\n":
+            name, _, value = line.decode().partition(":")
+            if name.lower() == "content-length":
+                content_length = int(value)
+        await reader.readexactly(content_length)
+        if b" 200 " in status:
+            latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def load_test(
+    batcher: MicroBatcher, num_clients: int, num_requests: int
+) -> tuple[list[float], float, dict[str, float]]:
+    service = DecodeService(batcher, timeout=10.0)
+    batch_task = asyncio.create_task(batcher.run())
+    server = await asyncio.start_server(service.serve_connection, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    latencies: list[float] = []
+    start = time.perf_counter()
+    await asyncio.gather(*[client(port, num_requests, i, latencies) for i in range(num_clients)])
+    duration = time.perf_counter() - start
+    server.close()
+    batch_task.cancel()
+    return latencies, duration, batcher.metrics.summary()
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(
+        description="Load-test the decode service with and without micro-batching"
+    )
+    parser.add_argument("--weights", help="VAE state dict, defaults to random weights")
+    parser.add_argument("--num-clients", type=int, default=64)
+    parser.add_argument("--num-requests", type=int, default=50, help="Requests per client")
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-delay-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    decoder = VAE(latent_dim).eval().decoder if args.weights is None else load_decoder(args.weights)
+    modes = [("per-request", 1, 0.0), ("batched", args.max_batch_size, args.max_delay_ms / 1000)]
+    for name, max_batch_size, max_delay in modes:
+        batcher = MicroBatcher(decoder, max_batch_size, max_delay)
+        latencies, duration, metrics = asyncio.run(
+            load_test(batcher, args.num_clients, args.num_requests)
+        )
+        latencies_ms = np.array(latencies) * 1000.0
+        print(
+            f"{name:11}  {len(latencies) / duration:8.0f} req/s  "
+            f"p50 {np.percentile(latencies_ms, 50):7.1f} ms  "
+            f"p99 {np.percentile(latencies_ms, 99):7.1f} ms  "
+            f"mean batch size {metrics['mean_batch_size']:5.1f}"
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from typing import Any
+
+
+def train_with_ranks(num_ranks: int, args: argparse.Namespace) -> dict[str, Any]:
+    """
+    Runs distributed.py with num_ranks processes on this machine through torchrun and returns the
+    report of rank 0.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        report_path = os.path.join(tmp_dir, "report.json")
+        command = [
+            sys.executable,
+            "-m",
+            "torch.distributed.run",
+            "--standalone",
+            f"--nproc-per-node={num_ranks}",
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "distributed.py"),
+            f"--dataset={os.path.abspath(args.dataset)}",
+            f"--dst={os.path.join(tmp_dir, 'vae.pth')}",
+            f"--num-epochs={args.num_epochs}",
+            f"--batch-size={args.batch_size}",
+            f"--val-batch-size={args.val_batch_size}",
+            f"--report={report_path}",
+        ]
+        if args.threads is not None:
+            command.append(f"--threads={args.threads}")
+        subprocess.run(command, check=True, capture_output=True, text=True)
+        with open(report_path) as f:
+            report: dict[str, Any] = json.load(f)
+    return report
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(
+        description="Report how distributed training scales with the number of ranks on this host"
+    )
+    parser.add_argument("--dataset", default="dataset.vds", help="Dataset file (see datasetfile)")
+    parser.add_argument("--ranks", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--num-epochs", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=256, help="Global training batch size")
+    parser.add_argument(
+        "--val-batch-size", type=int, default=64, help="Global validation batch size"
+    )
+    parser.add_argument(
+        "--threads", type=int, help="Torch threads per rank, by default the cores split evenly"
+    )
+    parser.add_argument("--output", help="JSON file to write the reports to")
+    args = parser.parse_args()
+
+    reports = []
+    print(
+        f"{'ranks':>5}  {'threads':>7}  {'samples/s':>10}  {'speedup':>7}  {'efficiency':>10}  loss"
+    )
+    for num_ranks in args.ranks:
+        report = train_with_ranks(num_ranks, args)
+        reports.append(report)
+        # Relative to the first configuration, normally a single rank
+        speedup = report["samples_per_second"] / reports[0]["samples_per_second"]
+        efficiency = speedup * args.ranks[0] / num_ranks
+        print(
+            f"{num_ranks:5}  {report['threads_per_rank']:7}  {report['samples_per_second']:10.0f}  "
+            f"{speedup:7.2f}  {efficiency:10.0%}  {report['val_losses'][-1]:.0f}"
+        )
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump({"cpu_count": os.cpu_count(), "reports": reports}, f, indent=2)
+
+
+if __name__ == "__main__":
+    run()
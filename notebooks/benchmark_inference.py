@@ -0,0 +1,102 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Callable
+
+import numpy as np
+import torch
+
+from constants import latent_dim, sidelength
+from inference import OnnxEngine
+from model import VAE
+from util import onnx_export_to_files
+
+# Maximum absolute deviation of the ONNX Runtime outputs from the PyTorch ones
+tolerance = 1e-4
+
+
+def items_per_second(fn: Callable[[], object], n: int, repeats: int) -> float:
+    fn()  # Warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    return n * repeats / (time.perf_counter() - start)
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description="Compare ONNX Runtime inference to eager PyTorch")
+    parser.add_argument("--weights", help="VAE state dict, defaults to random weights")
+    parser.add_argument("--num-inputs", type=int, default=4096)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[64, 256, 1024])
+    parser.add_argument("--num-sessions", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    vae = VAE(latent_dim)
+    if args.weights is not None:
+        vae.load_state_dict(torch.load(args.weights, map_location="cpu"))
+    vae.eval()
+
+    rng = np.random.default_rng(0)
+    images = rng.random((args.num_inputs, 3, sidelength, sidelength), dtype=np.float32)
+    z = rng.standard_normal((args.num_inputs, latent_dim), dtype=np.float32)
+
+    with torch.no_grad():
+        mu, logvar = vae.encoder(torch.from_numpy(images))
+        reconstructions = vae.decoder(torch.from_numpy(z))
+
+    def torch_encode() -> object:
+        with torch.no_grad():
+            return vae.encoder(torch.from_numpy(images))
+
+    def torch_decode() -> object:
+        with torch.no_grad():
+            return vae.decoder(torch.from_numpy(z))
+
+    print(f"{'':14}  {'encode/s':>10}  {'decode/s':>10}")
+    encode_rate = items_per_second(torch_encode, args.num_inputs, args.repeats)
+    decode_rate = items_per_second(torch_decode, args.num_inputs, args.repeats)
+    print(f"{'torch':14}  {encode_rate:10.0f}  {decode_rate:10.0f}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        encoder_path = os.path.join(tmp_dir, "encoder.onnx")
+        decoder_path = os.path.join(tmp_dir, "decoder.onnx")
+        onnx_export_to_files(vae.encoder, vae.decoder, encoder_path, decoder_path)
+
+        failed = []
+        for batch_size in args.batch_sizes:
+            engine = OnnxEngine(
+                encoder_path, decoder_path, batch_size=batch_size, num_sessions=args.num_sessions
+            )
+            mu_onnx, logvar_onnx = engine.encode(images)
+            deviation = max(
+                np.abs(mu_onnx - mu.numpy()).max(),
+                np.abs(logvar_onnx - logvar.numpy()).max(),
+                np.abs(engine.decode(z) - reconstructions.numpy()).max(),
+            )
+            # Reuse the output buffers, as a caller in a loop would
+            encode_out = (mu_onnx, logvar_onnx)
+            decode_out = np.empty_like(reconstructions.numpy())
+            encode_rate = items_per_second(
+                lambda: engine.encode(images, encode_out), args.num_inputs, args.repeats
+            )
+            decode_rate = items_per_second(
+                lambda: engine.decode(z, decode_out), args.num_inputs, args.repeats
+            )
+            engine.close()
+            status = "OK" if deviation <= tolerance else "FAILED"
+            if deviation > tolerance:
+                failed.append(batch_size)
+            name = f"onnx bs={batch_size}"
+            print(
+                f"{name:14}  {encode_rate:10.0f}  {decode_rate:10.0f}  "
+                f"max deviation {deviation:.1e} ({status})"
+            )
+    if failed:
+        sys.exit(f"ONNX outputs deviate by more than {tolerance} at batch sizes {failed}")
+
+
+if __name__ == "__main__":
+    run()
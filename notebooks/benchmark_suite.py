@@ -0,0 +1,391 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, NamedTuple
+
+import numpy as np
+import torch
+
+from constants import latent_dim, sidelength
+
+# Timings are only comparable on the same machine, so every host has its own baseline
+default_baseline_path = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), f"benchmark_baseline.{platform.node()}.json"
+)
+# Maximum relative slowdown before a result counts as a regression
+default_threshold = 0.25
+
+
+class BenchmarkResult(NamedTuple):
+    name: str
+    value: float
+    unit: str
+    higher_is_better: bool
+    # Name of the entry in benchmarks that produced the result
+    benchmark: str = ""
+
+
+class Comparison(NamedTuple):
+    name: str
+    value: float
+    baseline: float | None
+    # Relative slowdown, positive means worse than the baseline
+    slowdown: float | None
+    threshold: float
+
+    @property
+    def regressed(self) -> bool:
+        return self.slowdown is not None and self.slowdown > self.threshold
+
+
+def measure(fn: Callable[[], object], repeats: int = 5, min_time: float = 0.1) -> float:
+    """
+    Returns the duration of a call of fn in seconds, the best of repeats.
+
+    After a warm-up call, the number of calls per repeat is doubled until a repeat takes at least
+    min_time, so that fast functions aren't dominated by timer resolution.
+    """
+    fn()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        duration = time.perf_counter() - start
+        if duration >= min_time:
+            break
+        number *= 2
+    durations = [duration / number]
+    for _ in range(repeats - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        durations.append((time.perf_counter() - start) / number)
+    return min(durations)
+
+
+def throughput(name: str, fn: Callable[[], object], n: int, unit: str) -> BenchmarkResult:
+    return BenchmarkResult(name, n / measure(fn), unit, True)
+
+
+def bench_image() -> list[BenchmarkResult]:
+    from image import get_image, get_images, render_images
+
+    rng = np.random.default_rng(0)
+    coords = [(float(x), float(y)) for x, y in rng.uniform(0.4, 1.0, (256, 2))]
+    return [
+        throughput("image.get_image", lambda: get_image(0.8, 0.5, sidelength), 1, "images/s"),
+        throughput(
+            "image.get_images",
+            lambda: get_images(sidelength, coords, show_progress=False),
+            len(coords),
+            "images/s",
+        ),
+        throughput(
+            "image.render_images",
+            lambda: render_images(sidelength, np.array(coords)),
+            len(coords),
+            "images/s",
+        ),
+    ]
+
+
+def bench_batch_iterator() -> list[BenchmarkResult]:
+    from util import BatchIterator
+
+    data = torch.randint(0, 256, (20000, 3, sidelength, sidelength), dtype=torch.uint8)
+    batches = BatchIterator(data, 256)
+    return [
+        throughput(
+            "util.BatchIterator",
+            lambda: list(batches),
+            len(batches) * batches.batch_size,
+            "samples/s",
+        )
+    ]
+
+
+def bench_training() -> list[BenchmarkResult]:
+    from training import train
+
+    torch.manual_seed(0)
+    trainset = torch.randint(0, 256, (4096, 3, sidelength, sidelength), dtype=torch.uint8)
+    valset = torch.randint(0, 256, (256, 3, sidelength, sidelength), dtype=torch.uint8)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dst_path = os.path.join(tmp_dir, "vae.pth")
+        # One epoch: a forward and backward pass per training batch plus the validation pass
+        result = throughput(
+            "training.train",
+            lambda: train(
+                torch.device("cpu"), trainset, valset, dst_path, 1, 256, show_progress=False
+            ),
+            len(trainset),
+            "samples/s",
+        )
+    return [result]
+
+
+def bench_elbo() -> list[BenchmarkResult]:
+    from elbo import approximate_elbo
+
+    results = []
+    d = 3 * sidelength * sidelength
+    for batch_size in [64, 256, 1024, 4096]:
+        x = torch.rand(batch_size, d)
+        x_mu = torch.rand(batch_size, d)
+        z_mu = torch.randn(batch_size, latent_dim)
+        z_logvar = torch.randn(batch_size, latent_dim)
+        results.append(
+            throughput(
+                f"elbo.approximate_elbo[{batch_size}]",
+                lambda: approximate_elbo(x, x_mu, z_mu, z_logvar),
+                batch_size,
+                "samples/s",
+            )
+        )
+    return results
+
+
+def bench_onnx_export() -> list[BenchmarkResult]:
+    from model import VAE
+    from util import OnnxExportCache, onnx_export
+
+    vae = VAE(latent_dim)
+    warm_cache = OnnxExportCache()
+    return [
+        BenchmarkResult(
+            "util.onnx_export",
+            # A fresh cache per call, so every call exports
+            measure(lambda: onnx_export(vae.encoder, vae.decoder, OnnxExportCache()), 3),
+            "s",
+            False,
+        ),
+        BenchmarkResult(
+            "util.onnx_export[cached]",
+            measure(lambda: onnx_export(vae.encoder, vae.decoder, warm_cache)),
+            "s",
+            False,
+        ),
+    ]
+
+
+def bench_compress_floats() -> list[BenchmarkResult]:
+    from util import compress_floats, expand_floats
+
+    # About the size of the grids of a train_multiple run
+    data = np.random.default_rng(0).standard_normal(1024**2).astype(np.float32)
+    compressed = compress_floats(data)
+    return [
+        throughput("util.compress_floats", lambda: compress_floats(data), data.size, "floats/s"),
+        throughput("util.expand_floats", lambda: expand_floats(compressed), data.size, "floats/s"),
+    ]
+
+
+benchmarks: dict[str, Callable[[], list[BenchmarkResult]]] = {
+    "image": bench_image,
+    "batch_iterator": bench_batch_iterator,
+    "training": bench_training,
+    "elbo": bench_elbo,
+    "onnx_export": bench_onnx_export,
+    "compress_floats": bench_compress_floats,
+}
+
+
+def git_revision() -> str | None:
+    try:
+        revision = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return revision.stdout.strip()
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return None
+
+
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def machine_metadata() -> dict[str, object]:
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "cpu": cpu_model(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "revision": git_revision(),
+    }
+
+
+def compare(
+    results: list[BenchmarkResult],
+    baseline: dict[str, dict[str, object]],
+    threshold: float,
+    thresholds: dict[str, float],
+) -> list[Comparison]:
+    """
+    Compares results to a baseline (the "results" of a results file).
+
+    Args:
+        results (list[BenchmarkResult]): The new results.
+        baseline (dict[str, dict[str, object]]): Baseline results by name.
+        threshold (float): Maximum relative slowdown, e.g. 0.25 for 25%.
+        thresholds (dict[str, float]): Per-benchmark overrides of threshold.
+
+    Returns:
+        list[Comparison]: One entry per result. Results without a baseline are never regressions.
+    """
+    comparisons = []
+    for result in results:
+        limit = thresholds.get(result.name, threshold)
+        entry = baseline.get(result.name)
+        if entry is None:
+            comparisons.append(Comparison(result.name, result.value, None, None, limit))
+            continue
+        reference = float(entry["value"])  # type: ignore[arg-type]
+        if result.higher_is_better:
+            slowdown = reference / result.value - 1.0
+        else:
+            slowdown = result.value / reference - 1.0
+        comparisons.append(Comparison(result.name, result.value, reference, slowdown, limit))
+    return comparisons
+
+
+def missing_results(
+    results: list[BenchmarkResult], baseline: dict[str, dict[str, object]], selected: list[str]
+) -> list[str]:
+    """
+    Returns the names of the baseline results of the selected benchmarks that weren't measured,
+    e.g. because a benchmark couldn't import its dependencies.
+    """
+    measured = {result.name for result in results}
+    return [
+        name
+        for name, entry in baseline.items()
+        if entry.get("benchmark") in selected and name not in measured
+    ]
+
+
+def to_json(results: list[BenchmarkResult]) -> dict[str, object]:
+    return {
+        "metadata": machine_metadata(),
+        "results": {
+            result.name: {
+                "value": result.value,
+                "unit": result.unit,
+                "higher_is_better": result.higher_is_better,
+                "benchmark": result.benchmark,
+            }
+            for result in results
+        },
+    }
+
+
+def parse_thresholds(values: list[str]) -> dict[str, float]:
+    thresholds = {}
+    for value in values:
+        name, _, limit = value.partition("=")
+        thresholds[name] = float(limit)
+    return thresholds
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot paths and compare them to a stored baseline"
+    )
+    parser.add_argument("--only", nargs="+", choices=list(benchmarks), help="Benchmarks to run")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write results")
+    parser.add_argument("--baseline", default=default_baseline_path)
+    parser.add_argument("--threshold", type=float, default=default_threshold)
+    parser.add_argument(
+        "--threshold-for",
+        nargs="+",
+        default=[],
+        metavar="NAME=VALUE",
+        help="Per-benchmark thresholds, e.g. util.onnx_export=0.5",
+    )
+    parser.add_argument(
+        "--update-baseline", action="store_true", help="Store the results as the new baseline"
+    )
+    args = parser.parse_args()
+
+    selected = args.only or list(benchmarks)
+    results: list[BenchmarkResult] = []
+    failed = []
+    for name in selected:
+        try:
+            results += [result._replace(benchmark=name) for result in benchmarks[name]()]
+        except ImportError as e:
+            # Only fails a comparison if the baseline has results of the benchmark, see below
+            print(f"Could not run {name}: {e}")
+            failed.append(name)
+    output = to_json(results)
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+
+    baseline: dict[str, dict[str, object]] = {}
+    thresholds: dict[str, float] = {}
+    if not os.path.exists(args.baseline) and not args.update_baseline:
+        sys.exit(f"No baseline at {args.baseline}, record one on this host with --update-baseline")
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            stored = json.load(f)
+        baseline = stored["results"]
+        thresholds = stored.get("thresholds", {})
+        if stored["metadata"].get("cpu") != output["metadata"]["cpu"]:  # type: ignore[index]
+            print(f"Note: the baseline was recorded on a {stored['metadata'].get('cpu')}")
+    thresholds.update(parse_thresholds(args.threshold_for))
+
+    comparisons = compare(results, baseline, args.threshold, thresholds)
+    print(f"{'benchmark':32}  {'value':>12}  {'unit':9}  {'baseline':>12}  {'slowdown':>8}")
+    for result, comparison in zip(results, comparisons):
+        if comparison.baseline is None or comparison.slowdown is None:
+            print(f"{result.name:32}  {result.value:12.4g}  {result.unit:9}  {'-':>12}  new")
+            continue
+        status = "REGRESSION" if comparison.regressed else ""
+        print(
+            f"{result.name:32}  {result.value:12.4g}  {result.unit:9}  "
+            f"{comparison.baseline:12.4g}  {comparison.slowdown:+8.1%}  {status}"
+        )
+
+    missing = missing_results(results, baseline, selected)
+    for name in missing:
+        reference = float(baseline[name]["value"])  # type: ignore[arg-type]
+        print(f"{name:32}  {'-':>12}  {baseline[name]['unit']!s:9}  {reference:12.4g}  MISSING")
+
+    if args.update_baseline:
+        if failed:
+            sys.exit(f"Not updating the baseline, could not run {', '.join(failed)}")
+        # Keep the baseline of benchmarks that weren't run
+        output["results"] = {**baseline, **output["results"]}  # type: ignore[dict-item]
+        if thresholds:
+            output["thresholds"] = thresholds
+        with open(args.baseline, "w") as f:
+            json.dump(output, f, indent=2)
+            f.write("\n")
+        print(f"Updated {args.baseline}")
+    elif missing or any(comparison.regressed for comparison in comparisons):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,76 @@
+import argparse
+import sys
+import time
+
+import torch
+
+from constants import hue_range, size_range
+from dataset import generate_dataset
+from training import train
+
+# Maximum relative deviation of the final fast-path losses from the eager ones
+loss_tolerance = 0.02
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description="Compare the eager and the fast training path")
+    parser.add_argument("--num-samples", type=int, default=10000)
+    parser.add_argument("--num-epochs", type=int, default=5)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    device = torch.device("cpu")
+    _, _, trainset, valset = generate_dataset(
+        size_range,
+        hue_range,
+        valset_size_range=(0.6, 0.9),
+        valset_hue_range=(0.4, 0.7),
+        num_samples=args.num_samples,
+        vectorized=True,
+        seed=args.seed,
+    )
+    num_steps = args.num_epochs * (trainset.shape[0] // args.batch_size)
+
+    results = {}
+    for fast in [False, True]:
+        # Short warm-up run, so that compilation isn't part of the measurement
+        train(
+            device,
+            trainset,
+            valset,
+            "/dev/null",
+            1,
+            args.batch_size,
+            show_progress=False,
+            fast=fast,
+        )
+        torch.manual_seed(args.seed)
+        start = time.perf_counter()
+        train_losses, val_losses, _ = train(
+            device,
+            trainset,
+            valset,
+            "/dev/null",
+            args.num_epochs,
+            args.batch_size,
+            show_progress=False,
+            fast=fast,
+        )
+        duration = time.perf_counter() - start
+        results[fast] = (train_losses[-1], val_losses[-1])
+        name = "fast" if fast else "eager"
+        print(
+            f"{name:5}  {num_steps / duration:8.1f} steps/s  "
+            f"train loss {train_losses[-1]:.2f}  val loss {val_losses[-1]:.2f}"
+        )
+
+    deviation = max(abs(f - e) / abs(e) for f, e in zip(results[True], results[False]))
+    status = "OK" if deviation <= loss_tolerance else "FAILED"
+    print(f"Final loss deviation {deviation:.4f} (tolerance {loss_tolerance}): {status}")
+    if deviation > loss_tolerance:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,110 @@
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+# Modules used by batch jobs (training, evaluation, serving), which must import without the
+# plotting, widget and notebook stack
+headless_modules = [
+    "atlas",
+    "checkpoint",
+    "dataset",
+    "datasetcache",
+    "datasetfile",
+    "decodeservice",
+    "distributed",
+    "elbo",
+    "ensemble",
+    "image",
+    "inference",
+    "iwae",
+    "model",
+    "monitor",
+    "pipeline",
+    "recorder",
+    "scheduler",
+    "stopping",
+    "sweep",
+    "training",
+    "trajectorystore",
+    "util",
+]
+deferred_modules = [
+    "matplotlib",
+    "ipywidgets",
+    "IPython",
+    "anywidget",
+    "traitlets",
+    "tqdm.notebook",
+]
+# Imports that are heavy but needed, imported up front so they don't count against the budget
+required_modules = ["numpy", "torch", "onnxruntime"]
+
+
+def import_time(module: str) -> tuple[float, list[str]]:
+    """
+    Imports module in a fresh interpreter, from outside the notebooks directory, with
+    python -X importtime, after the required modules.
+
+    Returns:
+        tuple[float, list[str]]: The import time of the module in seconds and the deferred modules
+            that were loaded.
+    """
+    code = (
+        "import importlib, sys\n"
+        f"for name in {required_modules!r}:\n"
+        "    try:\n"
+        "        importlib.import_module(name)\n"
+        "    except ImportError:\n"
+        "        pass\n"
+        f"import {module}\n"
+        f"print(','.join(m for m in {deferred_modules!r} if m in sys.modules))"
+    )
+    env = dict(os.environ)
+    notebooks_dir = os.path.dirname(os.path.abspath(__file__))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [notebooks_dir, env.get("PYTHONPATH")]))
+    with tempfile.TemporaryDirectory() as cwd:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True,
+            text=True,
+            cwd=cwd,
+            env=env,
+        )
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+    seconds = 0.0
+    for line in result.stderr.splitlines():
+        _, _, fields = line.partition("import time:")
+        if fields.count("|") == 2 and fields.split("|")[2].strip() == module:
+            seconds = int(fields.split("|")[1]) / 1e6
+    loaded = [name for name in result.stdout.strip().split(",") if name]
+    return seconds, loaded
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check that the headless modules import quickly and without the notebook stack"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=0.25,
+        help="Maximum import time of a module in seconds, not counting the required modules",
+    )
+    parser.add_argument("modules", nargs="*", default=headless_modules)
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'module':16}  {'time':>8}  deferred modules loaded")
+    for module in args.modules:
+        seconds, loaded = import_time(module)
+        print(f"{module:16}  {seconds:7.3f}s  {', '.join(loaded) or '-'}")
+        if loaded:
+            failures.append(f"{module} imports {', '.join(loaded)}")
+        if seconds > args.budget:
+            failures.append(f"{module} takes {seconds:.3f}s to import (budget {args.budget}s)")
+
+    if failures:
+        sys.exit("\n".join(failures))
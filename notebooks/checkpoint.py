@@ -0,0 +1,145 @@
+import os
+import random
+import re
+import threading
+from queue import Queue
+from typing import Any
+
+import numpy as np
+import torch
+
+
+def to_cpu(state: Any) -> Any:
+    """
+    Returns a copy of a (nested) state dict with all tensors copied to the CPU.
+    """
+    if isinstance(state, torch.Tensor):
+        return state.detach().to("cpu", copy=True)
+    if isinstance(state, dict):
+        return {key: to_cpu(value) for key, value in state.items()}
+    if isinstance(state, (list, tuple)):
+        return type(state)(to_cpu(value) for value in state)
+    return state
+
+
+def get_rng_states() -> dict[str, Any]:
+    states: dict[str, Any] = {
+        "torch": torch.get_rng_state(),
+        "numpy": np.random.get_state(),
+        "random": random.getstate(),
+    }
+    if torch.cuda.is_available():
+        states["cuda"] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states: dict[str, Any]) -> None:
+    torch.set_rng_state(states["torch"])
+    np.random.set_state(states["numpy"])
+    random.setstate(states["random"])
+    if "cuda" in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states["cuda"])
+
+
+def atomic_save(obj: object, path: str) -> None:
+    tmp_path = f"{path}.tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def checkpoint_path(directory: str, epoch: int) -> str:
+    return os.path.join(directory, f"checkpoint_{epoch:05d}.pth")
+
+
+def list_checkpoints(directory: str) -> list[str]:
+    """
+    Returns the paths of the checkpoints in a directory, oldest epoch first.
+    """
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(
+        name for name in os.listdir(directory) if re.fullmatch(r"checkpoint_\d+\.pth", name)
+    )
+    return [os.path.join(directory, name) for name in names]
+
+
+def latest_checkpoint(directory: str) -> str | None:
+    checkpoints = list_checkpoints(directory)
+    return checkpoints[-1] if checkpoints else None
+
+
+def load_checkpoint(path: str) -> dict[str, Any]:
+    return torch.load(path, weights_only=False)  # type: ignore[no-any-return]
+
+
+class CheckpointManager:
+    def __init__(self, directory: str | None = None, keep_last: int = 3):
+        """
+        Writes checkpoints on a background thread, so that checkpoint I/O doesn't stall training.
+
+        The state is copied to the CPU synchronously (which is cheap for this model); serializing
+        and writing happen on the writer thread. Files are written under a temporary name and
+        renamed, so a crash never leaves a partial checkpoint behind. Only the last keep_last
+        checkpoints are kept. Without a directory, only save_weights can be used.
+        """
+        self.directory = directory
+        self.keep_last = keep_last
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.queue: Queue[tuple[object, str] | None] = Queue()
+        self.error: BaseException | None = None
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    def write_loop(self) -> None:
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                obj, path = item
+                atomic_save(obj, path)
+                self.prune()
+            except BaseException as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def prune(self) -> None:
+        if self.directory is None:
+            return
+        for path in list_checkpoints(self.directory)[: -self.keep_last]:
+            os.remove(path)
+
+    def check(self) -> None:
+        if self.error is not None:
+            raise RuntimeError("Writing a checkpoint failed") from self.error
+
+    def save(self, epoch: int, state: dict[str, Any], is_best: bool = False) -> None:
+        """
+        Schedules a checkpoint of the given training state (model and optimizer state, losses,
+        etc.). The current RNG states are added automatically. If is_best is set, the checkpoint is
+        also kept as checkpoint_best.pth, which isn't subject to pruning.
+        """
+        if self.directory is None:
+            raise ValueError("No checkpoint directory given.")
+        self.check()
+        checkpoint = {"epoch": epoch, "rng_states": get_rng_states(), **to_cpu(state)}
+        self.queue.put((checkpoint, checkpoint_path(self.directory, epoch)))
+        if is_best:
+            self.queue.put((checkpoint, os.path.join(self.directory, "checkpoint_best.pth")))
+
+    def save_weights(self, state_dict: dict[str, torch.Tensor], path: str) -> None:
+        """
+        Schedules writing a plain model state dict (e.g. of the best model so far).
+        """
+        self.check()
+        self.queue.put((to_cpu(state_dict), path))
+
+    def close(self) -> None:
+        """
+        Waits for all pending writes and stops the writer thread.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        self.check()
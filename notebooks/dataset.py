@@ -1,9 +1,13 @@
 import random
+from typing import Iterator
 
+import numpy as np
 import torch
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
 
 from constants import sidelength
-from image import get_images
+from datasetfile import write_dataset
+from image import get_images, render_images
 from util import in_range
 
 
@@ -13,18 +17,138 @@ def generate_dataset(
     valset_size_range: tuple[float, float],
     valset_hue_range: tuple[float, float],
     num_samples: int,
+    vectorized: bool = False,
+    num_workers: int = 1,
+    seed: int | None = None,
+    path: str | None = None,
 ) -> tuple[list[tuple[float, float]], list[tuple[float, float]], torch.Tensor, torch.Tensor]:
+    # Without a seed, keep using the global random module
+    rng = random if seed is None else random.Random(seed)
     trainset_coords = []
     valset_coords = []
     for i in range(num_samples):
-        x = random.uniform(size_range[0], size_range[1])
-        y = random.uniform(hue_range[0], hue_range[1])
+        x = rng.uniform(size_range[0], size_range[1])
+        y = rng.uniform(hue_range[0], hue_range[1])
         if in_range(valset_size_range, x) and in_range(valset_hue_range, y):
             valset_coords.append((x, y))
         else:
             trainset_coords.append((x, y))
 
-    trainset = torch.from_numpy(get_images(sidelength, trainset_coords))
-    valset = torch.from_numpy(get_images(sidelength, valset_coords))
+    if vectorized:
+        trainset = torch.from_numpy(render_images(sidelength, np.array(trainset_coords)))
+        valset = torch.from_numpy(render_images(sidelength, np.array(valset_coords)))
+    else:
+        trainset = torch.from_numpy(get_images(sidelength, trainset_coords, num_workers))
+        valset = torch.from_numpy(get_images(sidelength, valset_coords, num_workers))
+
+    if path is not None:
+        params: dict[str, object] = {
+            "size_range": list(size_range),
+            "hue_range": list(hue_range),
+            "valset_size_range": list(valset_size_range),
+            "valset_hue_range": list(valset_hue_range),
+            "num_samples": num_samples,
+            "seed": seed,
+            "vectorized": vectorized,
+        }
+        write_dataset(path, trainset_coords, valset_coords, trainset, valset, params)
 
     return trainset_coords, valset_coords, trainset, valset
+
+
+class StreamingDataset(IterableDataset[torch.Tensor]):
+    def __init__(
+        self,
+        size_range: tuple[float, float],
+        hue_range: tuple[float, float],
+        valset_size_range: tuple[float, float],
+        valset_hue_range: tuple[float, float],
+        samples_per_epoch: int,
+        seed: int = 0,
+        num_workers: int = 0,
+        prefetch_factor: int = 2,
+    ):
+        """
+        Training set that renders fresh samples on the fly instead of holding them in memory.
+
+        Every epoch draws new (size, hue) coordinates outside of the validation rectangle (using the
+        same inclusive bounds as in_range), which must leave part of the sampling range, and yields
+        uint8 batches of shape (batch_size, 3, sidelength, sidelength). Like BatchIterator,
+        incomplete batches are dropped.
+
+        Args:
+            samples_per_epoch (int): Number of samples drawn per epoch.
+            seed (int): Seed for the coordinate sampling; combined with the epoch and worker id.
+            num_workers (int): Number of DataLoader worker processes that render the images.
+            prefetch_factor (int): Number of batches each worker renders ahead.
+        """
+        # Fraction of each sampling range covered by the validation rectangle
+        covered = [
+            (
+                max(0.0, min(high, valset_high) - max(low, valset_low)) / (high - low)
+                if high > low
+                else float(valset_low <= low <= valset_high)
+            )
+            for (low, high), (valset_low, valset_high) in [
+                (size_range, valset_size_range),
+                (hue_range, valset_hue_range),
+            ]
+        ]
+        if covered[0] * covered[1] >= 1.0:
+            # Every draw would be rejected, see sample_coords
+            raise ValueError("The validation rectangle covers the whole sampling range.")
+        self.size_range = size_range
+        self.hue_range = hue_range
+        self.valset_size_range = valset_size_range
+        self.valset_hue_range = valset_hue_range
+        self.samples_per_epoch = samples_per_epoch
+        self.seed = seed
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.batch_size = 1
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def sample_coords(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        coords = np.zeros((0, 2))
+        while len(coords) < n:
+            x = rng.uniform(self.size_range[0], self.size_range[1], n)
+            y = rng.uniform(self.hue_range[0], self.hue_range[1], n)
+            in_valset = (
+                (self.valset_size_range[0] <= x)
+                & (x <= self.valset_size_range[1])
+                & (self.valset_hue_range[0] <= y)
+                & (y <= self.valset_hue_range[1])
+            )
+            coords = np.concatenate([coords, np.stack([x, y], axis=-1)[~in_valset]])
+        return coords[:n]
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        rng = np.random.default_rng([self.seed, self.epoch, worker_id])
+        # Each worker renders every num_workers-th batch
+        for _ in range(worker_id, len(self), num_workers):
+            coords = self.sample_coords(rng, self.batch_size)
+            yield torch.from_numpy(render_images(sidelength, coords))
+
+    def __len__(self) -> int:
+        return self.samples_per_epoch // self.batch_size
+
+    def loader(self, batch_size: int) -> DataLoader[torch.Tensor]:
+        """
+        Returns a DataLoader over one epoch of batches. The number of batches in flight is bounded
+        by num_workers * prefetch_factor.
+        """
+        self.batch_size = batch_size
+        if len(self) == 0:
+            raise ValueError("Batch size is larger than the number of samples per epoch.")
+        return DataLoader(
+            self,
+            batch_size=None,
+            num_workers=self.num_workers,
+            prefetch_factor=self.prefetch_factor if self.num_workers > 0 else None,
+        )
@@ -0,0 +1,212 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import NamedTuple
+
+import numpy as np
+import torch
+
+from constants import sidelength
+from dataset import generate_dataset
+from image import face_path
+
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "vae", "datasets")
+default_max_bytes = 2 * 1024**3
+
+array_names = ["trainset_coords", "valset_coords", "trainset", "valset"]
+
+
+class CacheEntry(NamedTuple):
+    key: str
+    params: dict[str, object]
+    num_bytes: int
+    last_used: float
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def dataset_key(params: dict[str, object]) -> str:
+    """
+    Returns the cache key for a set of generation parameters.
+
+    Args:
+        params (dict[str, object]): JSON-serializable generation parameters.
+
+    Returns:
+        str: Hex digest identifying the dataset.
+    """
+    return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+def entry_size(entry_dir: str) -> int:
+    return sum(os.path.getsize(os.path.join(entry_dir, name)) for name in os.listdir(entry_dir))
+
+
+def list_entries(cache_dir: str = default_cache_dir) -> list[CacheEntry]:
+    """
+    Lists the cached datasets, least recently used first.
+    """
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for key in os.listdir(cache_dir):
+        meta_path = os.path.join(cache_dir, key, "meta.json")
+        if key.startswith(".") or not os.path.isfile(meta_path):
+            continue
+        with open(meta_path) as f:
+            params = json.load(f)
+        entries.append(
+            CacheEntry(
+                key,
+                params,
+                entry_size(os.path.join(cache_dir, key)),
+                os.path.getmtime(meta_path),
+            )
+        )
+    entries.sort(key=lambda entry: entry.last_used)
+    return entries
+
+
+def prune(cache_dir: str = default_cache_dir, max_bytes: int = default_max_bytes) -> list[str]:
+    """
+    Deletes the least recently used datasets until the cache is no larger than max_bytes.
+
+    Returns:
+        list[str]: Keys of the deleted entries.
+    """
+    entries = list_entries(cache_dir)
+    total = sum(entry.num_bytes for entry in entries)
+    removed = []
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(os.path.join(cache_dir, entry.key), ignore_errors=True)
+        total -= entry.num_bytes
+        removed.append(entry.key)
+    return removed
+
+
+def load_entry(
+    entry_dir: str,
+) -> tuple[list[tuple[float, float]], list[tuple[float, float]], torch.Tensor, torch.Tensor]:
+    # Copy-on-write maps, so that torch gets writable arrays without touching the files
+    arrays = [
+        np.load(os.path.join(entry_dir, f"{name}.npy"), mmap_mode="c") for name in array_names
+    ]
+    trainset_coords = [(x, y) for x, y in arrays[0].tolist()]
+    valset_coords = [(x, y) for x, y in arrays[1].tolist()]
+    return trainset_coords, valset_coords, torch.from_numpy(arrays[2]), torch.from_numpy(arrays[3])
+
+
+def store_entry(
+    cache_dir: str,
+    key: str,
+    params: dict[str, object],
+    dataset: tuple[
+        list[tuple[float, float]], list[tuple[float, float]], torch.Tensor, torch.Tensor
+    ],
+) -> None:
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write into a temporary directory first so that readers never see a partial entry
+    tmp_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".tmp-")
+    trainset_coords, valset_coords, trainset, valset = dataset
+    arrays = [
+        np.array(trainset_coords, dtype=np.float64).reshape(-1, 2),
+        np.array(valset_coords, dtype=np.float64).reshape(-1, 2),
+        trainset.numpy(),
+        valset.numpy(),
+    ]
+    for name, array in zip(array_names, arrays):
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+    with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+        json.dump(params, f, indent=2)
+    try:
+        os.rename(tmp_dir, os.path.join(cache_dir, key))
+    except OSError:
+        # Another process stored the same dataset in the meantime
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def cached_generate_dataset(
+    size_range: tuple[float, float],
+    hue_range: tuple[float, float],
+    valset_size_range: tuple[float, float],
+    valset_hue_range: tuple[float, float],
+    num_samples: int,
+    seed: int,
+    vectorized: bool = False,
+    num_workers: int = 1,
+    cache_dir: str = default_cache_dir,
+    max_bytes: int = default_max_bytes,
+) -> tuple[list[tuple[float, float]], list[tuple[float, float]], torch.Tensor, torch.Tensor]:
+    """
+    Same as generate_dataset, but looks the dataset up in an on-disk cache first.
+
+    The cache key covers all generation parameters, the seed and the digest of the face image. On a
+    hit, the image tensors are backed by memory-mapped .npy files. After storing a new entry, the
+    least recently used entries are evicted until the cache fits into max_bytes.
+    """
+    params: dict[str, object] = {
+        "size_range": list(size_range),
+        "hue_range": list(hue_range),
+        "valset_size_range": list(valset_size_range),
+        "valset_hue_range": list(valset_hue_range),
+        "num_samples": num_samples,
+        "sidelength": sidelength,
+        "seed": seed,
+        "vectorized": vectorized,
+        "face_digest": file_digest(face_path),
+    }
+    key = dataset_key(params)
+    entry_dir = os.path.join(cache_dir, key)
+    if os.path.isdir(entry_dir):
+        # Mark as recently used
+        os.utime(os.path.join(entry_dir, "meta.json"))
+        return load_entry(entry_dir)
+
+    dataset = generate_dataset(
+        size_range,
+        hue_range,
+        valset_size_range,
+        valset_hue_range,
+        num_samples,
+        vectorized=vectorized,
+        num_workers=num_workers,
+        seed=seed,
+    )
+    store_entry(cache_dir, key, params, dataset)
+    prune(cache_dir, max_bytes)
+    return dataset
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description="Manage the dataset cache")
+    parser.add_argument("--cache-dir", default=default_cache_dir)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List cached datasets")
+    prune_parser = subparsers.add_parser("prune", help="Evict least recently used datasets")
+    prune_parser.add_argument("--max-bytes", type=int, default=default_max_bytes)
+    subparsers.add_parser("clear", help="Delete all cached datasets")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        for entry in list_entries(args.cache_dir):
+            last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_used))
+            print(f"{entry.key}  {entry.num_bytes:>12}  {last_used}  {json.dumps(entry.params)}")
+    elif args.command == "prune":
+        for key in prune(args.cache_dir, args.max_bytes):
+            print(f"Removed {key}")
+    elif args.command == "clear":
+        for key in prune(args.cache_dir, 0):
+            print(f"Removed {key}")
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,184 @@
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+
+from constants import sidelength
+
+dataset_magic = b"VAEDS001"
+alignment = 64
+split_names = ["train", "val"]
+
+
+def align(offset: int) -> int:
+    return -(-offset // alignment) * alignment
+
+
+def write_dataset(
+    path: str,
+    trainset_coords: list[tuple[float, float]],
+    valset_coords: list[tuple[float, float]],
+    trainset: torch.Tensor,
+    valset: torch.Tensor,
+    params: dict[str, object] | None = None,
+) -> None:
+    """
+    Writes a dataset as returned by generate_dataset to a single self-describing file.
+
+    The file starts with the magic bytes, the length of a JSON header (little-endian uint32) and
+    the header itself. The header holds the sidelength, the dtypes, the generation parameters and,
+    per split, the number of samples and the offsets of its blocks relative to the (aligned) end of
+    the header. Per split, there is a float32 block of shape (2, n) (the x and y coordinate
+    columns) and a uint8 block of shape (n, 3, sidelength, sidelength) (the images). All blocks
+    start at multiples of 64 bytes.
+
+    Args:
+        path (str): Path of the dataset file.
+        trainset_coords (list[tuple[float, float]]): Coordinates of the training set.
+        valset_coords (list[tuple[float, float]]): Coordinates of the validation set.
+        trainset (torch.Tensor): Training images of shape (n, 3, sidelength, sidelength).
+        valset (torch.Tensor): Validation images of shape (n, 3, sidelength, sidelength).
+        params (dict[str, object] | None): JSON-serializable generation parameters.
+    """
+    blocks = []
+    splits = {}
+    offset = 0
+    for name, coords, images in [
+        ("train", trainset_coords, trainset),
+        ("val", valset_coords, valset),
+    ]:
+        columns = np.array(coords, dtype="<f4").reshape(-1, 2).T.copy()
+        image_array = np.ascontiguousarray(images.numpy(), dtype=np.uint8)
+        if image_array.shape[1:] != (3, sidelength, sidelength):
+            raise ValueError(f"Expected images of shape (n, 3, {sidelength}, {sidelength})")
+        if columns.shape[1] != image_array.shape[0]:
+            raise ValueError(f"Got {columns.shape[1]} coordinates for {len(image_array)} images")
+        coords_offset = offset
+        images_offset = align(coords_offset + columns.nbytes)
+        offset = align(images_offset + image_array.nbytes)
+        splits[name] = {
+            "num_samples": image_array.shape[0],
+            "coords_offset": coords_offset,
+            "images_offset": images_offset,
+        }
+        blocks += [(coords_offset, columns), (images_offset, image_array)]
+    header = json.dumps(
+        {
+            "sidelength": sidelength,
+            "coords_dtype": "<f4",
+            "images_dtype": "|u1",
+            "images_shape": [3, sidelength, sidelength],
+            "params": params or {},
+            "splits": splits,
+        }
+    ).encode("utf-8")
+    data_start = align(len(dataset_magic) + 4 + len(header))
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(dataset_magic + struct.pack("<I", len(header)) + header)
+        for block_offset, array in blocks:
+            f.seek(data_start + block_offset)
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+def write_web_files(
+    trainset_coords: list[tuple[float, float]],
+    valset_coords: list[tuple[float, float]],
+    trainset: torch.Tensor,
+    valset: torch.Tensor,
+    directory: str = ".",
+) -> None:
+    """
+    Writes the files the dataset preview on the website loads: per split, the coordinates as JSON
+    ({split}set_coords.json) and the raw images without a header ({split}set_images.bin), which the
+    website reads one image at a time with HTTP range requests.
+    """
+    for name, coords, images in [
+        ("train", trainset_coords, trainset),
+        ("val", valset_coords, valset),
+    ]:
+        x = ",".join(f"{x:.3f}" for x, _ in coords)
+        y = ",".join(f"{y:.3f}" for _, y in coords)
+        with open(os.path.join(directory, f"{name}set_coords.json"), "w") as f:
+            f.write(f'{{"x": [{x}], "y": [{y}]}}')
+        with open(os.path.join(directory, f"{name}set_images.bin"), "wb") as f:
+            f.write(images.numpy().tobytes())
+
+
+class DatasetFile:
+    def __init__(self, path: str):
+        """
+        Reads a dataset file written by write_dataset. Only the header is read up front; the
+        coordinates and images are memory-mapped on access, so a split or a range of it can be
+        used without reading the rest of the file.
+        """
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(dataset_magic)) != dataset_magic:
+                raise ValueError(f"{path} is not a dataset file")
+            (header_size,) = struct.unpack("<I", f.read(4))
+            self.header = json.loads(f.read(header_size))
+        if self.header["sidelength"] != sidelength:
+            raise ValueError(f"{path} has sidelength {self.header['sidelength']}")
+        self.params: dict[str, object] = self.header["params"]
+        self.data_start = align(len(dataset_magic) + 4 + header_size)
+
+    def __len__(self) -> int:
+        return sum(self.num_samples(split) for split in split_names)
+
+    def num_samples(self, split: str) -> int:
+        num_samples: int = self.header["splits"][split]["num_samples"]
+        return num_samples
+
+    def map(self, offset: int, dtype: str, shape: tuple[int, ...]) -> np.ndarray:
+        if shape[0] == 0:
+            return np.empty(shape, dtype=dtype)
+        # Copy-on-write, so that torch gets a writable array without touching the file
+        return np.memmap(
+            self.path, dtype=dtype, mode="c", offset=self.data_start + offset, shape=shape
+        )
+
+    def coords(self, split: str, start: int | None = None, stop: int | None = None) -> np.ndarray:
+        """
+        Returns the coordinates of a split (or of the range start:stop of it) as an array of shape
+        (n, 2).
+        """
+        info = self.header["splits"][split]
+        start, stop, _ = slice(start, stop).indices(info["num_samples"])
+        stop = max(start, stop)
+        columns = self.map(info["coords_offset"], "<f4", (2, info["num_samples"]))
+        return np.array(columns[:, start:stop].T)
+
+    def images(self, split: str, start: int | None = None, stop: int | None = None) -> torch.Tensor:
+        """
+        Returns the images of a split (or of the range start:stop of it) as a uint8 tensor of
+        shape (n, 3, sidelength, sidelength), backed by a memory map of just that range.
+        """
+        info = self.header["splits"][split]
+        start, stop, _ = slice(start, stop).indices(info["num_samples"])
+        stop = max(start, stop)
+        image_size = sidelength * sidelength * 3
+        return torch.from_numpy(
+            self.map(
+                info["images_offset"] + start * image_size,
+                "|u1",
+                (stop - start, 3, sidelength, sidelength),
+            )
+        )
+
+
+def load_dataset(
+    path: str,
+) -> tuple[list[tuple[float, float]], list[tuple[float, float]], torch.Tensor, torch.Tensor]:
+    """
+    Loads a dataset file in the format returned by generate_dataset. The image tensors are backed
+    by memory maps of the file.
+    """
+    dataset = DatasetFile(path)
+    trainset_coords = [(x, y) for x, y in dataset.coords("train").tolist()]
+    valset_coords = [(x, y) for x, y in dataset.coords("val").tolist()]
+    return trainset_coords, valset_coords, dataset.images("train"), dataset.images("val")
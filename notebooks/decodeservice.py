@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import json
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import torch
+from torch import nn
+
+from atlas import Atlas
+from constants import latent_dim
+from model import VAE
+
+# Decode requests are tiny; larger bodies are refused instead of being read into memory
+max_body_size = 64 * 1024
+
+
+class Overloaded(Exception):
+    pass
+
+
+class PendingRequest(NamedTuple):
+    z: np.ndarray
+    future: asyncio.Future[np.ndarray]
+
+
+def encode_png(image: np.ndarray) -> bytes:
+    """
+    Encodes a uint8 image of shape (height, width, 3) as PNG.
+    """
+    height, width, _ = image.shape
+
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        body = tag + data
+        return struct.pack(">I", len(data)) + body + struct.pack(">I", zlib.crc32(body))
+
+    # Every row starts with filter type 0 (none)
+    rows = np.concatenate([np.zeros((height, 1), np.uint8), image.reshape(height, -1)], axis=1)
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows.tobytes()))
+        + chunk(b"IEND", b"")
+    )
+
+
+class Metrics:
+    def __init__(self, window: int = 10000):
+        """
+        Counters plus the latencies and batch sizes of the last window requests/batches.
+        """
+        self.start = time.perf_counter()
+        self.num_requests = 0
+        self.num_rejected = 0
+        self.num_timeouts = 0
+        self.num_batches = 0
+        self.latencies: deque[float] = deque(maxlen=window)
+        self.batch_sizes: deque[int] = deque(maxlen=window)
+
+    def summary(self) -> dict[str, float]:
+        latencies = np.array(self.latencies) * 1000.0
+        elapsed = time.perf_counter() - self.start
+        return {
+            "requests": self.num_requests,
+            "rejected": self.num_rejected,
+            "timeouts": self.num_timeouts,
+            "batches": self.num_batches,
+            "requests_per_second": self.num_requests / elapsed,
+            "mean_batch_size": float(np.mean(self.batch_sizes)) if self.batch_sizes else 0.0,
+            "latency_p50_ms": float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+            "latency_p99_ms": float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+        }
+
+
+class MicroBatcher:
+    def __init__(
+        self,
+        decoder: nn.Module,
+        max_batch_size: int = 64,
+        max_delay: float = 0.005,
+        max_queue_size: int = 1024,
+    ):
+        """
+        Coalesces concurrent decode requests into batches.
+
+        A batch is started by the first waiting request and closed when it has max_batch_size
+        requests or max_delay seconds have passed, whichever comes first. The decoder runs on a
+        single worker thread, so the event loop keeps accepting requests in the meantime. When
+        max_queue_size requests are waiting, new ones are rejected with Overloaded.
+
+        Args:
+            decoder (nn.Module): The decoder, in eval mode.
+            max_batch_size (int): Maximum number of latents per decoder call, 1 to disable
+                batching.
+            max_delay (float): Latency window in seconds.
+            max_queue_size (int): Maximum number of waiting requests.
+        """
+        self.decoder = decoder
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue: asyncio.Queue[PendingRequest] = asyncio.Queue(maxsize=max_queue_size)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.metrics = Metrics()
+
+    def submit(self, z: np.ndarray) -> asyncio.Future[np.ndarray]:
+        future: asyncio.Future[np.ndarray] = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait(PendingRequest(z, future))
+        except asyncio.QueueFull:
+            self.metrics.num_rejected += 1
+            raise Overloaded()
+        return future
+
+    def decode(self, z: np.ndarray) -> np.ndarray:
+        with torch.no_grad():
+            images: torch.Tensor = self.decoder(torch.from_numpy(z))
+        return (images * 255.0).round().to(torch.uint8).permute(0, 2, 3, 1).numpy()
+
+    async def collect(self) -> list[PendingRequest]:
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        # Requests that timed out while waiting don't need to be decoded
+        return [request for request in batch if not request.future.done()]
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.collect()
+            if not batch:
+                continue
+            z = np.stack([request.z for request in batch]).astype(np.float32)
+            try:
+                images = await loop.run_in_executor(self.executor, self.decode, z)
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                continue
+            self.metrics.num_batches += 1
+            self.metrics.batch_sizes.append(len(batch))
+            for request, image in zip(batch, images):
+                if not request.future.done():
+                    request.future.set_result(image)
+
+
+class DecodeService:
+    def __init__(self, batcher: MicroBatcher, timeout: float = 1.0, atlas: Atlas | None = None):
+        """
+        A minimal HTTP/1.1 server (with keep-alive) around a MicroBatcher. If an atlas is given,
+        requests are answered by (bilinear) atlas lookups instead, without running the model.
+
+        Endpoints:
+            GET /decode?z=<z1>,<z2>[&format=png|raw]: The decoded image, as PNG (default) or as raw
+                uint8 pixels of shape (sidelength, sidelength, 3).
+            POST /decode: Same, with a JSON body {"z": [z1, z2], "format": "png"}.
+            GET /metrics: Request, batch and latency metrics as JSON.
+        """
+        self.batcher = batcher
+        self.timeout = timeout
+        self.atlas = atlas
+
+    async def decode(self, z: np.ndarray, image_format: str) -> tuple[int, str, bytes]:
+        metrics = self.batcher.metrics
+        start = time.perf_counter()
+        if self.atlas is not None:
+            image = self.atlas.lookup(z[None])[0]
+            metrics.num_requests += 1
+            metrics.latencies.append(time.perf_counter() - start)
+            return self.respond(image, image_format)
+        try:
+            future = self.batcher.submit(z)
+        except Overloaded:
+            return 503, "text/plain", b"Overloaded"
+        try:
+            image = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            metrics.num_timeouts += 1
+            return 504, "text/plain", b"Timeout"
+        metrics.num_requests += 1
+        metrics.latencies.append(time.perf_counter() - start)
+        return self.respond(image, image_format)
+
+    def respond(self, image: np.ndarray, image_format: str) -> tuple[int, str, bytes]:
+        if image_format == "raw":
+            return 200, "application/octet-stream", image.tobytes()
+        return 200, "image/png", encode_png(image)
+
+    async def handle(self, method: str, target: str, body: bytes) -> tuple[int, str, bytes]:
+        url = urlsplit(target)
+        if url.path == "/metrics" and method == "GET":
+            return 200, "application/json", json.dumps(self.batcher.metrics.summary()).encode()
+        if url.path != "/decode":
+            return 404, "text/plain", b"Not found"
+        try:
+            if method == "POST":
+                params = json.loads(body)
+                z_values = [float(value) for value in params["z"]]
+                image_format = params.get("format", "png")
+            else:
+                query = parse_qs(url.query)
+                z_values = [float(value) for value in query["z"][0].split(",")]
+                image_format = query.get("format", ["png"])[0]
+        except (KeyError, ValueError, TypeError):
+            return 400, "text/plain", b"Expected z with latent_dim comma-separated floats"
+        # Values beyond the float32 range become infinite and are rejected with the others
+        with np.errstate(over="ignore"):
+            z = np.array(z_values, dtype=np.float32)
+        if len(z_values) != latent_dim or not np.isfinite(z).all():
+            return 400, "text/plain", b"Expected z with latent_dim comma-separated finite floats"
+        if image_format not in ["png", "raw"]:
+            return 400, "text/plain", b"Expected format png or raw"
+        return await self.decode(z, image_format)
+
+    async def serve_connection(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in [b"\r\n", b"\n", b""]:
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                content_length = int(headers.get("content-length", "0"))
+                if content_length > max_body_size:
+                    # The body isn't read, so the connection can't be reused
+                    status, content_type, content = 413, "text/plain", b"Request body too large"
+                    headers["connection"] = "close"
+                else:
+                    body = await reader.readexactly(content_length)
+                    status, content_type, content = await self.handle(method, target, body)
+                writer.write(
+                    (
+                        f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                        f"Content-Type: {content_type}\r\n"
+                        f"Content-Length: {len(content)}\r\n\r\n"
+                    ).encode("latin-1")
+                    + content
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host: str, port: int) -> None:
+        batch_task = asyncio.create_task(self.batcher.run())
+        server = await asyncio.start_server(self.serve_connection, host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batch_task.cancel()
+
+
+def load_decoder(weights_path: str) -> nn.Module:
+    vae = VAE(latent_dim)
+    vae.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    vae.eval()
+    return vae.decoder
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(description="Serve the VAE decoder over HTTP")
+    parser.add_argument("--weights", help="VAE state dict, e.g. vae_0.pth", required=True)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-delay-ms", type=float, default=5.0)
+    parser.add_argument("--max-queue-size", type=int, default=1024)
+    parser.add_argument("--timeout", type=float, default=1.0, help="Per-request timeout in seconds")
+    parser.add_argument("--atlas", help="Answer from an atlas built by atlas.py instead")
+    args = parser.parse_args()
+
+    decoder = load_decoder(args.weights)
+    atlas = None if args.atlas is None else Atlas(args.atlas, decoder=decoder)
+    batcher = MicroBatcher(
+        decoder,
+        args.max_batch_size,
+        args.max_delay_ms / 1000.0,
+        args.max_queue_size,
+    )
+    print(f"Serving on http://{args.host}:{args.port}")
+    asyncio.run(DecodeService(batcher, args.timeout, atlas).serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,232 @@
+import argparse
+import json
+import os
+import socket
+import time
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+from checkpoint import CheckpointManager
+from constants import hue_range, latent_dim, sidelength, size_range
+from datasetfile import DatasetFile
+from elbo import approximate_elbo
+from model import VAE
+from recorder import MetricsRecorder, TrajectoryRecorder
+from training import normalize
+from util import ShardedBatchIterator, progress
+
+
+def init_distributed() -> tuple[int, int]:
+    """
+    Joins the gloo process group described by the environment variables that torchrun sets, or,
+    without them, starts a group of a single process.
+
+    Returns:
+        tuple[int, int]: The rank of this process and the number of processes.
+    """
+    if "RANK" in os.environ:
+        dist.init_process_group("gloo")
+    else:
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=0, world_size=1)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def all_reduce_mean(value: float) -> float:
+    """
+    Returns the mean of value over all ranks.
+    """
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item() / dist.get_world_size()
+
+
+def train_distributed(
+    trainset: torch.Tensor,
+    valset: torch.Tensor,
+    dst_path: str,
+    num_epochs: int = 100,
+    trainset_batch_size: int = 256,
+    valset_batch_size: int = 64,
+    grid: torch.Tensor | None = None,
+    trajectory_path: str | None = None,
+    seed: int = 0,
+    show_progress: bool = True,
+) -> tuple[list[float], list[float], torch.Tensor | None]:
+    """
+    Trains a VAE like training.train, but data-parallel on the CPU over all ranks of the process
+    group (see init_distributed), with DistributedDataParallel averaging the gradients.
+
+    Every rank is called with the whole dataset (e.g. memory maps of the same dataset file) and
+    trains on its shard of it (see ShardedBatchIterator). The batch sizes are global, so with the
+    same batch sizes, any number of ranks takes the same number of steps per epoch. The epoch losses
+    are averaged over the ranks, so all ranks see the same losses; only rank 0 records the grid and
+    writes the weights of the best model to dst_path.
+
+    Args:
+        trainset (torch.Tensor): uint8 training images of shape (n, 3, sidelength, sidelength).
+        valset (torch.Tensor): uint8 validation images.
+        dst_path (str): Where rank 0 saves the weights of the best model.
+        num_epochs (int): Number of epochs.
+        trainset_batch_size (int): Global training batch size, a multiple of the number of ranks.
+        valset_batch_size (int): Global validation batch size, a multiple of the number of ranks.
+        grid (torch.Tensor | None): Normalized grid images, encoded by rank 0 after every epoch.
+        trajectory_path (str | None): Trajectory store rank 0 writes the grid encodings to.
+        seed (int): Seed of the initial weights, the sampling and the shuffling.
+        show_progress (bool): Show a progress bar on rank 0.
+
+    Returns:
+        tuple[list[float], list[float], torch.Tensor | None]: The training and validation losses
+            per epoch and, on rank 0, the grid encodings per epoch.
+    """
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    if trainset_batch_size % world_size != 0 or valset_batch_size % world_size != 0:
+        raise ValueError(f"Batch sizes must be multiples of the number of ranks ({world_size}).")
+    is_main = rank == 0
+    device = torch.device("cpu")
+
+    # Same initial weights everywhere (DistributedDataParallel also broadcasts them from rank 0),
+    # but different sampling noise on every rank
+    torch.manual_seed(seed)
+    vae = VAE(latent_dim)
+    model = DistributedDataParallel(vae)
+    torch.manual_seed(seed + 1 + rank)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+
+    train_batches = ShardedBatchIterator(
+        trainset, trainset_batch_size // world_size, rank, world_size, seed
+    )
+    val_batches = ShardedBatchIterator(valset, valset_batch_size // world_size, rank, world_size)
+    train_metrics = MetricsRecorder()
+    val_metrics = MetricsRecorder()
+    trajectory = None
+    if grid is not None and is_main:
+        trajectory = TrajectoryRecorder(grid, num_epochs, latent_dim, trajectory_path)
+    checkpoints = CheckpointManager() if is_main else None
+
+    def batch_loss(x: torch.Tensor) -> torch.Tensor:
+        enc_mu, enc_logvar, dec_mu = model(x)
+        return -approximate_elbo(
+            x.view(x.shape[0], sidelength * sidelength * 3),
+            dec_mu.view(dec_mu.shape[0], sidelength * sidelength * 3),
+            enc_mu,
+            enc_logvar,
+        ).mean()
+
+    train_losses = []
+    val_losses = []
+    best_val_loss = float("inf")
+    step = 0
+    pbar = progress(range(num_epochs), show_progress and is_main)
+    for epoch in pbar:
+        model.train()  # type: ignore[no-untyped-call]
+        train_batches.set_epoch(epoch)
+        for x in normalize(train_batches, device):
+            batch_train_loss = batch_loss(x)
+            train_metrics.add(batch_train_loss)
+            optimizer.zero_grad()
+            batch_train_loss.backward()  # type: ignore[no-untyped-call]
+            optimizer.step()
+            step += 1
+        # All ranks have the same number of batches, so the mean of the means is the global mean
+        train_losses.append(all_reduce_mean(train_metrics.mean()))
+
+        model.eval()
+        with torch.no_grad():
+            for x in normalize(val_batches, device):
+                val_metrics.add(batch_loss(x))
+        epoch_val_loss = all_reduce_mean(val_metrics.mean())
+        val_losses.append(epoch_val_loss)
+        if trajectory is not None:
+            trajectory.after_epoch(vae.encoder, step, epoch)
+        pbar.set_postfix(train_loss=round(train_losses[-1]), val_loss=round(epoch_val_loss))
+
+        # The losses are the same on all ranks, so they agree on the best epoch
+        if epoch_val_loss < best_val_loss:
+            best_val_loss = epoch_val_loss
+            if checkpoints is not None:
+                checkpoints.save_weights(vae.state_dict(), dst_path)
+
+    if checkpoints is not None:
+        checkpoints.close()
+    if trajectory is None:
+        return train_losses, val_losses, None
+    trajectory.close()
+    return train_losses, val_losses, trajectory.snapshots()
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(
+        description="Train a VAE data-parallel over several processes, launched with torchrun"
+    )
+    parser.add_argument("--dataset", default="dataset.vds", help="Dataset file (see datasetfile)")
+    parser.add_argument("--dst", default="vae.pth", help="Weights of the best model")
+    parser.add_argument("--num-epochs", type=int, default=100)
+    parser.add_argument("--batch-size", type=int, default=256, help="Global training batch size")
+    parser.add_argument(
+        "--val-batch-size", type=int, default=64, help="Global validation batch size"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--threads", type=int, help="Torch threads per rank, by default the cores split evenly"
+    )
+    parser.add_argument("--trajectory", help="Record the standard grid to this trajectory store")
+    parser.add_argument("--report", help="JSON file rank 0 writes the losses and timings to")
+    args = parser.parse_args()
+
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", "1"))
+    torch.set_num_threads(args.threads or max(1, (os.cpu_count() or 1) // local_world_size))
+    rank, world_size = init_distributed()
+
+    dataset = DatasetFile(args.dataset)
+    trainset, valset = dataset.images("train"), dataset.images("val")
+    grid = None
+    if args.trajectory is not None and rank == 0:
+        from grid import make_standard_grid
+        from image import render_images
+
+        standard_grid = make_standard_grid(size_range, hue_range).reshape(-1, 2)
+        grid = torch.from_numpy(render_images(sidelength, standard_grid)).float() / 255.0
+
+    start = time.perf_counter()
+    train_losses, val_losses, _ = train_distributed(
+        trainset,
+        valset,
+        args.dst,
+        args.num_epochs,
+        args.batch_size,
+        args.val_batch_size,
+        grid,
+        args.trajectory,
+        args.seed,
+        show_progress=False,
+    )
+    duration = time.perf_counter() - start
+    if rank == 0 and args.report is not None:
+        batches_per_epoch = trainset.shape[0] // world_size // (args.batch_size // world_size)
+        samples = args.num_epochs * batches_per_epoch * args.batch_size
+        with open(args.report, "w") as f:
+            json.dump(
+                {
+                    "world_size": world_size,
+                    "threads_per_rank": torch.get_num_threads(),
+                    "num_epochs": args.num_epochs,
+                    "batch_size": args.batch_size,
+                    "duration": duration,
+                    "samples_per_second": samples / duration,
+                    "train_losses": train_losses,
+                    "val_losses": val_losses,
+                },
+                f,
+                indent=2,
+            )
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    run()
@@ -22,3 +22,27 @@ def approximate_elbo(
     recon_term = log_normal_spherical(xi, mu_z, sigma2=1.0)
     kl_term = kl_divergence(mu_xi, logvar_xi)
     return recon_term - kl_term
+
+
+def negative_elbo(
+    xi: torch.Tensor,
+    mu_z: torch.Tensor,
+    mu_xi: torch.Tensor,
+    logvar_xi: torch.Tensor,
+) -> torch.Tensor:
+    """
+    Mean negative ELBO of a batch, same as -approximate_elbo(...).mean() with sigma2 = 1.
+
+    Works on image-shaped tensors in any memory format (no .view needed) and accumulates in float32
+    even if the decoder ran in lower precision. Reconstruction and KL terms are written as one
+    expression so that torch.compile can fuse them into a single pass without materializing the
+    (x - mu) difference.
+    """
+    xi = xi.flatten(1).float()
+    mu_z = mu_z.flatten(1).float()
+    mu_xi = mu_xi.float()
+    logvar_xi = logvar_xi.float()
+    d = xi.size(1)
+    squared_error = (xi - mu_z).pow(2).sum(dim=1)
+    kl = 0.5 * torch.sum(mu_xi**2 + torch.exp(logvar_xi) - logvar_xi - 1, dim=1)
+    return (0.5 * (d * math.log(2 * math.pi) + squared_error) + kl).mean()
@@ -0,0 +1,208 @@
+import copy
+import os
+from typing import Iterator
+
+import numpy as np
+import torch
+from torch.func import functional_call, stack_module_state, vmap
+
+from constants import sidelength
+from elbo import approximate_elbo
+from model import VAE
+from stopping import EarlyStopping, pad_epochs
+from trajectorystore import TrajectoryWriter
+from util import progress
+
+
+class StackedBatchIterator:
+    def __init__(self, data: torch.Tensor, batch_size: int, num_models: int):
+        """
+        Like BatchIterator, but yields batches of shape (num_models, batch_size, ...) where every
+        model gets its own shuffle of the data.
+        """
+        self.data = data
+        self.batch_size = batch_size
+        self.num_models = num_models
+        self.n = data.shape[0]
+        self.num_full_batches = self.n // self.batch_size
+        if self.num_full_batches == 0:
+            raise ValueError("Batch size is larger than the dataset size.")
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        indices = torch.stack([torch.randperm(self.n) for _ in range(self.num_models)])
+        for i in range(self.num_full_batches):
+            yield self.data[indices[:, i * self.batch_size : (i + 1) * self.batch_size]]
+
+    def __len__(self) -> int:
+        return self.num_full_batches
+
+
+def model_state_dict(
+    params: dict[str, torch.Tensor], buffers: dict[str, torch.Tensor], i: int
+) -> dict[str, torch.Tensor]:
+    """
+    Extracts the state dict of the i-th model from the stacked parameters and buffers.
+    """
+    return {name: value[i].detach().clone() for name, value in {**params, **buffers}.items()}
+
+
+def train_ensemble(
+    device: torch.device,
+    trainset: torch.Tensor,
+    valset: torch.Tensor,
+    dst_paths: list[str],
+    num_epochs: int = 100,
+    trainset_batch_size: int = 256,
+    valset_batch_size: int = 64,
+    grid: torch.Tensor | None = None,
+    trajectory_path: str | None = None,
+    early_stopping: list[EarlyStopping] | None = None,
+) -> list[tuple[list[float], list[float], torch.Tensor | None]]:
+    """
+    Trains one VAE per destination path, all of them at once.
+
+    The parameters of the models are stacked and the training step is vectorized with vmap, so a
+    single pass covers all models. Each model sees its own shuffle of the data and its own
+    reparameterization noise; since Adam works elementwise, one optimizer over the stacked
+    parameters behaves like one optimizer per model.
+
+    If a trajectory_path is given (and a grid), the grid encodings and losses of every model are
+    appended to a trajectory store (see trajectorystore) after every epoch.
+
+    With early_stopping (one per model), a model that stops is frozen like in training.train: its
+    returned losses and grid encodings repeat those of its last epoch, and its weights are no longer
+    saved. The vectorized step keeps computing all models until the last one stops, but a stopped
+    model gets no gradient and no Adam momentum, so its parameters don't change. As with
+    training.train, the trajectory store only holds the epochs a model actually trained.
+
+    Returns:
+        list[tuple[list[float], list[float], torch.Tensor | None]]: Per model, the same
+            (train_losses, val_losses, processed_grids) triple that training.train returns.
+    """
+    num_models = len(dst_paths)
+    if early_stopping is not None:
+        if len(early_stopping) != num_models:
+            raise ValueError("Expected one EarlyStopping per model.")
+        for stopping in early_stopping:
+            stopping.start()
+
+    def stopped(i: int) -> bool:
+        return early_stopping is not None and early_stopping[i].stopped_epoch is not None
+
+    models = [VAE(2).to(device) for _ in range(num_models)]
+    params, buffers = stack_module_state(models)
+    base_model = copy.deepcopy(models[0]).to("meta")
+    optimizer = torch.optim.Adam(params.values(), lr=1e-3)
+
+    def loss_fn(
+        model_params: dict[str, torch.Tensor],
+        model_buffers: dict[str, torch.Tensor],
+        x: torch.Tensor,
+    ) -> torch.Tensor:
+        enc_mu, enc_logvar, dec_mu = functional_call(
+            base_model, (model_params, model_buffers), (x,)
+        )
+        return -approximate_elbo(
+            x.view(x.shape[0], sidelength * sidelength * 3),
+            dec_mu.view(dec_mu.shape[0], sidelength * sidelength * 3),
+            enc_mu,
+            enc_logvar,
+        ).mean()
+
+    def encode(encoder_params: dict[str, torch.Tensor], x: torch.Tensor) -> torch.Tensor:
+        mu, logvar = functional_call(base_model.encoder, encoder_params, (x,))
+        return mu  # type: ignore[no-any-return]
+
+    batched_loss = vmap(loss_fn, randomness="different")
+    batched_encode = vmap(encode, in_dims=(0, None))
+
+    train_losses: list[list[float]] = [[] for _ in range(num_models)]
+    val_losses: list[list[float]] = [[] for _ in range(num_models)]
+    best_val_losses = np.full(num_models, np.inf)
+    # 1 for the models still training, 0 for the stopped ones
+    active = torch.ones(num_models, device=device)
+    trajectory = None
+    if grid is not None:
+        processed_grids = torch.zeros((num_models, num_epochs, 100, 2))
+        if trajectory_path is not None:
+            if os.path.exists(trajectory_path):
+                os.remove(trajectory_path)
+            trajectory = TrajectoryWriter(trajectory_path, grid.shape[0], bits=16, delta=True)
+
+    pbar = progress(range(num_epochs))
+    for epoch in pbar:
+        per_batch_train_losses = []
+        for batch in StackedBatchIterator(trainset, trainset_batch_size, num_models):
+            x = (batch / 255.0).to(device)
+            losses = batched_loss(params, buffers, x)
+            per_batch_train_losses.append(losses.detach())
+            optimizer.zero_grad()
+            # The models don't share parameters, so the gradient of the sum is the per-model one
+            (losses * active).sum().backward()  # type: ignore[no-untyped-call]
+            optimizer.step()
+        epoch_train_losses = torch.stack(per_batch_train_losses).mean(dim=0).tolist()
+
+        per_batch_val_losses = []
+        with torch.no_grad():
+            for batch in StackedBatchIterator(valset, valset_batch_size, num_models):
+                x = (batch / 255.0).to(device)
+                per_batch_val_losses.append(batched_loss(params, buffers, x))
+            if grid is not None:
+                encoder_params = {
+                    name.removeprefix("encoder."): value
+                    for name, value in params.items()
+                    if name.startswith("encoder.")
+                }
+                processed_grids[:, epoch] = batched_encode(encoder_params, grid).cpu()
+        epoch_val_losses = torch.stack(per_batch_val_losses).mean(dim=0).tolist()
+
+        for i in range(num_models):
+            if stopped(i):
+                train_losses[i].append(train_losses[i][-1])
+                val_losses[i].append(val_losses[i][-1])
+                if grid is not None:
+                    processed_grids[i, epoch] = processed_grids[i, epoch - 1]
+                continue
+            train_losses[i].append(epoch_train_losses[i])
+            val_losses[i].append(epoch_val_losses[i])
+            if epoch_val_losses[i] < best_val_losses[i]:
+                best_val_losses[i] = epoch_val_losses[i]
+                torch.save(model_state_dict(params, buffers, i), dst_paths[i])
+            if trajectory is not None:
+                trajectory.append(
+                    i,
+                    epoch,
+                    processed_grids[i, epoch].numpy(),
+                    epoch_train_losses[i],
+                    epoch_val_losses[i],
+                )
+            if early_stopping is not None and early_stopping[i].should_stop(epoch, val_losses[i]):
+                active[i] = 0.0
+                # Without gradients and momentum, Adam leaves the parameters of the model unchanged
+                for param in params.values():
+                    optimizer.state[param]["exp_avg"][i].zero_()
+        if trajectory is not None:
+            trajectory.flush()
+        pbar.set_postfix(
+            train_loss=int(np.round(np.mean(epoch_train_losses))),
+            val_loss=int(np.round(np.mean(epoch_val_losses))),
+        )
+        if all(stopped(i) for i in range(num_models)):
+            break
+
+    # After all models stopped early, pad the results to the shapes of a full run
+    num_epochs_trained = len(train_losses[0])
+    if num_epochs_trained < num_epochs:
+        for i in range(num_models):
+            train_losses[i] = pad_epochs(train_losses[i], num_epochs).tolist()
+            val_losses[i] = pad_epochs(val_losses[i], num_epochs).tolist()
+        if grid is not None:
+            processed_grids[:, num_epochs_trained:] = processed_grids[
+                :, num_epochs_trained - 1, None
+            ]
+    if trajectory is not None:
+        trajectory.close()
+    return [
+        (train_losses[i], val_losses[i], None if grid is None else processed_grids[i])
+        for i in range(num_models)
+    ]
@@ -1,9 +1,10 @@
-from typing import Tuple
+from typing import TYPE_CHECKING, Tuple
 
-import ipywidgets as widgets  # type: ignore
-import matplotlib.pyplot as plt
 import numpy as np
 
+if TYPE_CHECKING:
+    import ipywidgets as widgets  # type: ignore
+
 
 def make_standard_grid(x_range: Tuple[float, float], y_range: Tuple[float, float]) -> np.ndarray:
     rows, cols = 10, 10
@@ -13,10 +14,9 @@ def make_standard_grid(x_range: Tuple[float, float], y_range: Tuple[float, float
     return np.stack([xx, yy], axis=-1).round(3)  # Shape: (10, 10, 2)
 
 
-px = 1 / plt.rcParams["figure.dpi"]  # Pixel in inches
-
-
 def connect_rows(grid: np.ndarray) -> None:
+    import matplotlib.pyplot as plt
+
     for i in range(10):
         for j in range(9):
             plt.plot(
@@ -28,6 +28,8 @@ def connect_rows(grid: np.ndarray) -> None:
 
 
 def connect_columns(grid: np.ndarray) -> None:
+    import matplotlib.pyplot as plt
+
     for j in range(10):
         for i in range(9):
             plt.plot(
@@ -39,8 +41,11 @@ def connect_columns(grid: np.ndarray) -> None:
 
 
 def show_grid(
-    out: widgets.Output, xlim: tuple[float, float], ylim: tuple[float, float], grid: np.ndarray
+    out: "widgets.Output", xlim: tuple[float, float], ylim: tuple[float, float], grid: np.ndarray
 ) -> None:
+    import matplotlib.pyplot as plt
+
+    px = 1 / plt.rcParams["figure.dpi"]  # Pixel in inches
     with out:
         plt.subplots(figsize=(250 * px, 250 * px))
         plt.xlim(xlim)
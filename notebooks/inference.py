@@ -0,0 +1,176 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from queue import Queue
+from typing import Iterator
+
+import numpy as np
+import onnxruntime as ort  # type: ignore
+
+from constants import latent_dim, sidelength
+
+
+def session_options(intra_op_threads: int, inter_op_threads: int = 1) -> ort.SessionOptions:
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
+
+
+class SessionPool:
+    def __init__(self, path: str, num_sessions: int, options: ort.SessionOptions):
+        """
+        A fixed set of ONNX Runtime sessions for one model, handed out to one caller at a time.
+        """
+        with open(path, "rb") as f:
+            model = f.read()
+        self.sessions: Queue[ort.InferenceSession] = Queue()
+        for _ in range(num_sessions):
+            self.sessions.put(
+                ort.InferenceSession(model, options, providers=["CPUExecutionProvider"])
+            )
+
+    @contextmanager
+    def session(self) -> Iterator[ort.InferenceSession]:
+        session = self.sessions.get()
+        try:
+            yield session
+        finally:
+            self.sessions.put(session)
+
+
+def check_output(out: np.ndarray, shape: tuple[int, ...]) -> None:
+    """
+    Checks that an output buffer can be bound to a session, which writes to it through its raw
+    pointer: a mismatch would make the session write past the buffer or scramble it.
+    """
+    if out.dtype != np.float32 or not out.flags.c_contiguous or out.shape != shape:
+        raise ValueError(
+            f"Expected a C-contiguous float32 output array of shape {shape}, got "
+            f"{out.dtype} of shape {out.shape}"
+            f"{'' if out.flags.c_contiguous else ' (not C-contiguous)'}"
+        )
+
+
+class OnnxEngine:
+    def __init__(
+        self,
+        encoder_path: str,
+        decoder_path: str,
+        batch_size: int = 256,
+        num_sessions: int = 1,
+        intra_op_threads: int | None = None,
+    ):
+        """
+        Runs an encoder/decoder pair exported by util.onnx_export_to_files with ONNX Runtime.
+
+        The models are loaded once into a pool of sessions per model. Large inputs are split into
+        batches of batch_size; with more than one session, the batches are run concurrently. The
+        outputs are written directly into preallocated arrays through IO binding, so no per-batch
+        results are allocated or concatenated.
+
+        Args:
+            encoder_path (str): Path of the ONNX encoder.
+            decoder_path (str): Path of the ONNX decoder.
+            batch_size (int): Maximum number of inputs per session run.
+            num_sessions (int): Number of sessions per model.
+            intra_op_threads (int | None): Threads per session, defaults to an even share of the
+                cores.
+        """
+        if intra_op_threads is None:
+            intra_op_threads = max(1, (os.cpu_count() or 1) // num_sessions)
+        options = session_options(intra_op_threads)
+        self.batch_size = batch_size
+        self.num_sessions = num_sessions
+        self.encoders = SessionPool(encoder_path, num_sessions, options)
+        self.decoders = SessionPool(decoder_path, num_sessions, options)
+        self.executor = ThreadPoolExecutor(max_workers=num_sessions) if num_sessions > 1 else None
+
+    @classmethod
+    def load(cls, i: int, directory: str = ".", **kwargs: int) -> "OnnxEngine":
+        """
+        Loads the vae_{i}_encoder.onnx / vae_{i}_decoder.onnx pair written by train_multiple.
+        """
+        return cls(
+            os.path.join(directory, f"vae_{i}_encoder.onnx"),
+            os.path.join(directory, f"vae_{i}_decoder.onnx"),
+            **kwargs,
+        )
+
+    def run(
+        self,
+        pool: SessionPool,
+        input_name: str,
+        inputs: np.ndarray,
+        outputs: dict[str, np.ndarray],
+    ) -> None:
+        inputs = np.ascontiguousarray(inputs, dtype=np.float32)
+        starts = range(0, inputs.shape[0], self.batch_size)
+
+        def run_batch(start: int) -> None:
+            end = min(start + self.batch_size, inputs.shape[0])
+            with pool.session() as session:
+                binding = session.io_binding()
+                binding.bind_cpu_input(input_name, inputs[start:end])
+                for name, out in outputs.items():
+                    # Slices along the first axis of a C-contiguous array are contiguous, so the
+                    # session can write into them directly
+                    binding.bind_output(
+                        name, "cpu", 0, np.float32, out[start:end].shape, out[start:end].ctypes.data
+                    )
+                session.run_with_iobinding(binding)
+
+        if self.executor is None:
+            for start in starts:
+                run_batch(start)
+        else:
+            list(self.executor.map(run_batch, starts))
+
+    def encode(
+        self, images: np.ndarray, out: tuple[np.ndarray, np.ndarray] | None = None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Encodes normalized images of shape (n, 3, sidelength, sidelength).
+
+        Args:
+            images (np.ndarray): The images.
+            out (tuple[np.ndarray, np.ndarray] | None): Optional C-contiguous float32 arrays of
+                shape (n, latent_dim) to write mu and logvar to.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: mu and logvar, each of shape (n, latent_dim).
+        """
+        n = images.shape[0]
+        if out is None:
+            out = (
+                np.empty((n, latent_dim), dtype=np.float32),
+                np.empty((n, latent_dim), dtype=np.float32),
+            )
+        for array in out:
+            check_output(array, (n, latent_dim))
+        self.run(self.encoders, "image", images, {"mu": out[0], "logvar": out[1]})
+        return out
+
+    def decode(self, z: np.ndarray, out: np.ndarray | None = None) -> np.ndarray:
+        """
+        Decodes latent vectors of shape (n, latent_dim).
+
+        Args:
+            z (np.ndarray): The latent vectors.
+            out (np.ndarray | None): Optional C-contiguous float32 array of shape
+                (n, 3, sidelength, sidelength) to write the reconstructions to.
+
+        Returns:
+            np.ndarray: The reconstructions of shape (n, 3, sidelength, sidelength).
+        """
+        if out is None:
+            out = np.empty((z.shape[0], 3, sidelength, sidelength), dtype=np.float32)
+        check_output(out, (z.shape[0], 3, sidelength, sidelength))
+        self.run(self.decoders, "z", z, {"reconstruction": out})
+        return out
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown()
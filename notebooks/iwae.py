@@ -0,0 +1,187 @@
+import argparse
+import math
+from typing import NamedTuple
+
+import torch
+from torch import nn
+
+from constants import latent_dim
+from datasetfile import DatasetFile
+from elbo import log_normal_spherical
+from model import VAE
+
+# Larger chunks don't decode faster on CPUs, see iwae_log_weights
+default_memory_budget = 16 * 1024**2
+
+
+class IwaeResult(NamedTuple):
+    path: str
+    # Mean over the inputs of the K-sample importance weighted bound (nats per image)
+    log_likelihood: float
+    # Standard error of that mean over the inputs
+    standard_error: float
+    # Mean of the single-sample ELBOs of the same K samples, for comparison
+    elbo: float
+
+
+def decoder_bytes_per_sample(decoder: nn.Module, device: torch.device) -> int:
+    """
+    Returns the bytes of the activations of all layers of the decoder for a single latent vector,
+    an upper bound of what decoding one sample needs at once without gradients.
+    """
+    num_bytes = 0
+
+    def count(module: nn.Module, inputs: object, output: torch.Tensor) -> None:
+        nonlocal num_bytes
+        num_bytes += output.numel() * output.element_size()
+
+    handles = [
+        module.register_forward_hook(count)
+        for module in decoder.modules()
+        if not list(module.children())
+    ]
+    with torch.no_grad():
+        decoder(torch.zeros(1, latent_dim, device=device))
+    for handle in handles:
+        handle.remove()
+    return num_bytes
+
+
+def iwae_log_weights(
+    vae: VAE,
+    images: torch.Tensor,
+    num_samples: int,
+    memory_budget: int = default_memory_budget,
+    generator: torch.Generator | None = None,
+) -> torch.Tensor:
+    """
+    Returns the log importance weights log p(x|z) + log p(z) - log q(z|x) of num_samples samples
+    from the encoder distribution of every image, as a tensor of shape (n, num_samples).
+
+    The images are encoded once. The (image, sample) pairs are then decoded in chunks as large as
+    memory_budget allows, each chunk in a single decoder call, so a chunk may cover many images or
+    only part of the samples of one. On CPUs, chunks that fit into the caches (a few MiB) are the
+    fastest; on GPUs, larger budgets pay off.
+
+    Args:
+        vae (VAE): The model, in eval mode.
+        images (torch.Tensor): Images of shape (n, 3, sidelength, sidelength), uint8 or normalized.
+        num_samples (int): Number of samples K per image.
+        memory_budget (int): Approximate peak memory of a chunk in bytes.
+        generator (torch.Generator | None): Generator for the samples, on the model's device.
+    """
+    device = next(vae.parameters()).device
+    num_images = images.shape[0]
+    image_size = images[0].numel()
+    # The decoder activations plus the gathered (normalized) input images of a chunk
+    bytes_per_sample = decoder_bytes_per_sample(vae.decoder, device) + 8 * image_size
+    chunk_size = max(1, memory_budget // bytes_per_sample)
+
+    def normalized(x: torch.Tensor) -> torch.Tensor:
+        x = x.to(device)
+        return x.float() / 255.0 if x.dtype == torch.uint8 else x.float()
+
+    with torch.no_grad():
+        mu = torch.empty(num_images, latent_dim, device=device)
+        logvar = torch.empty(num_images, latent_dim, device=device)
+        for start in range(0, num_images, chunk_size):
+            stop = min(start + chunk_size, num_images)
+            mu[start:stop], logvar[start:stop] = vae.encoder(normalized(images[start:stop]))
+        std = torch.exp(0.5 * logvar)
+
+        log_weights = torch.empty(num_images * num_samples, device=device)
+        for start in range(0, num_images * num_samples, chunk_size):
+            stop = min(start + chunk_size, num_images * num_samples)
+            i = torch.arange(start, stop, device=device) // num_samples
+            eps = torch.randn(stop - start, latent_dim, device=device, generator=generator)
+            z = mu[i] + eps * std[i]
+            x = normalized(images[i.to(images.device)])
+            log_px_z = log_normal_spherical(x.flatten(1), vae.decoder(z).flatten(1), sigma2=1.0)
+            log_pz = -0.5 * (z.pow(2) + math.log(2 * math.pi)).sum(dim=1)
+            log_qz_x = -0.5 * (eps.pow(2) + logvar[i] + math.log(2 * math.pi)).sum(dim=1)
+            log_weights[start:stop] = log_px_z + log_pz - log_qz_x
+    return log_weights.view(num_images, num_samples)
+
+
+def iwae_bound(
+    vae: VAE,
+    images: torch.Tensor,
+    num_samples: int = 64,
+    memory_budget: int = default_memory_budget,
+    generator: torch.Generator | None = None,
+) -> torch.Tensor:
+    """
+    Returns the importance weighted bound of log p(x) with num_samples samples (IWAE) for every
+    image, as a tensor of shape (n,). With num_samples = 1, this is the ELBO; the bound tightens as
+    num_samples grows.
+    """
+    log_weights = iwae_log_weights(vae, images, num_samples, memory_budget, generator)
+    return torch.logsumexp(log_weights, dim=1) - math.log(num_samples)
+
+
+def evaluate_checkpoints(
+    paths: list[str],
+    images: torch.Tensor,
+    num_samples: int = 64,
+    memory_budget: int = default_memory_budget,
+    device: torch.device = torch.device("cpu"),
+    seed: int = 0,
+) -> list[IwaeResult]:
+    """
+    Estimates the log-likelihood of images (e.g. the validation set) under every model in paths
+    (e.g. the vae_{i}.pth files of train_multiple).
+
+    Every model sees the same samples of the noise (from the same seed), which reduces the variance
+    of the differences between the models.
+    """
+    results = []
+    for path in paths:
+        vae = VAE(latent_dim).to(device)
+        vae.load_state_dict(torch.load(path, map_location=device))
+        vae.eval()
+        generator = torch.Generator(device).manual_seed(seed)
+        log_weights = iwae_log_weights(vae, images, num_samples, memory_budget, generator)
+        bounds = torch.logsumexp(log_weights, dim=1) - math.log(num_samples)
+        results.append(
+            IwaeResult(
+                path,
+                bounds.mean().item(),
+                (bounds.std() / math.sqrt(len(bounds))).item(),
+                log_weights.mean().item(),
+            )
+        )
+    return results
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(
+        description="Estimate the validation log-likelihood of trained models with IWAE"
+    )
+    parser.add_argument("weights", nargs="+", help="VAE state dicts, e.g. vae_*.pth")
+    parser.add_argument("--dataset", default="dataset.vds", help="Dataset file (see datasetfile)")
+    parser.add_argument("--split", default="val", choices=["train", "val"])
+    parser.add_argument("--num-samples", type=int, default=64)
+    parser.add_argument("--memory-budget-mib", type=int, default=default_memory_budget // 1024**2)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    images = DatasetFile(args.dataset).images(args.split)
+    results = evaluate_checkpoints(
+        args.weights,
+        images,
+        args.num_samples,
+        args.memory_budget_mib * 1024**2,
+        torch.device(args.device),
+        args.seed,
+    )
+    print(f"{'weights':20}  {'log p(x)':>12}  {'+-':>6}  {'ELBO':>12}")
+    for result in sorted(results, key=lambda result: -result.log_likelihood):
+        print(
+            f"{result.path:20}  {result.log_likelihood:12.2f}  {result.standard_error:6.2f}  "
+            f"{result.elbo:12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    run()
@@ -57,11 +57,6 @@ class VAE(nn.Module):
 
     def forward(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         enc_mu, enc_logvar = self.encoder(x)
-
-        # Reparameterization trick
-        std = torch.exp(0.5 * enc_logvar)
-        eps = torch.randn_like(std)
-        z = enc_mu + eps * std
-
+        z = reparameterize(enc_mu, enc_logvar)
         dec_mu = self.decoder(z)
         return enc_mu, enc_logvar, dec_mu
@@ -0,0 +1,129 @@
+import json
+import os
+import resource
+import sys
+import time
+from typing import Collection
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+# Phases of an epoch, in the order in which they first occur
+phases = ["data", "forward", "loss", "backward", "optimizer", "grid", "validation", "checkpoint"]
+training_phases = phases[:6]
+
+
+def peak_rss() -> int:
+    """
+    Returns the peak resident set size of the process in bytes.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class TrainingMonitor:
+    def __init__(
+        self,
+        path: str | None = None,
+        device: torch.device = torch.device("cpu"),
+        profile_epochs: Collection[int] = (),
+        trace_dir: str = ".",
+        synchronize: bool = False,
+    ):
+        """
+        Times the phases of training epochs and writes one JSON record per epoch to a JSONL file.
+
+        The training loop calls lap(phase) at the end of each phase, which attributes the time since
+        the previous lap to that phase. Without a path, lap returns immediately, so the calls can
+        stay in the loop at no measurable cost.
+
+        A record holds the epoch, the step, the duration of every phase and of the epoch in
+        seconds, the number of training samples and the samples per second of the training phases
+        (everything but validation and checkpointing), the losses, the peak RSS of the process
+        and, on CUDA, the peak memory allocated during the epoch.
+
+        Args:
+            path (str | None): JSONL file to append the records to, None to disable timing.
+            device (torch.device): The training device.
+            profile_epochs (Collection[int]): Epochs to run under torch.profiler. Their Chrome
+                traces are written to trace_dir/epoch_{epoch}.json. Profiling works without a path.
+            trace_dir (str): Directory for the traces.
+            synchronize (bool): Wait for the device at every lap. Without it, the time of queued
+                device work on asynchronous devices (CUDA) is attributed to the phase that next
+                waits for it.
+        """
+        self.file = None if path is None else open(path, "a")
+        self.enabled = self.file is not None
+        self.device = device
+        self.profile_epochs = set(profile_epochs)
+        self.trace_dir = trace_dir
+        self.synchronize = synchronize and device.type == "cuda"
+        self.profiler: profile | None = None
+        self.durations = dict.fromkeys(phases, 0.0)
+        self.num_samples = 0
+        self.epoch_start = 0.0
+        self.last = 0.0
+
+    def start_epoch(self, epoch: int) -> None:
+        if epoch in self.profile_epochs:
+            activities = [ProfilerActivity.CPU]
+            if self.device.type == "cuda":
+                activities.append(ProfilerActivity.CUDA)
+            self.profiler = profile(activities=activities)
+            self.profiler.start()
+        if not self.enabled:
+            return
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.durations = dict.fromkeys(phases, 0.0)
+        self.num_samples = 0
+        self.epoch_start = self.last = time.perf_counter()
+
+    def lap(self, phase: str, num_samples: int = 0) -> None:
+        """
+        Attributes the time since the previous lap to phase, and num_samples to the epoch.
+        """
+        if not self.enabled:
+            return
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+        now = time.perf_counter()
+        self.durations[phase] += now - self.last
+        self.last = now
+        self.num_samples += num_samples
+
+    def end_epoch(self, epoch: int, step: int, train_loss: float, val_loss: float) -> None:
+        duration = time.perf_counter() - self.epoch_start
+        profiled = self.profiler is not None
+        if self.profiler is not None:
+            self.profiler.stop()
+            os.makedirs(self.trace_dir, exist_ok=True)
+            self.profiler.export_chrome_trace(os.path.join(self.trace_dir, f"epoch_{epoch}.json"))
+            self.profiler = None
+        if self.file is None:
+            return
+        training_time = sum(self.durations[phase] for phase in training_phases)
+        record = {
+            "epoch": epoch,
+            "step": step,
+            "duration": duration,
+            "phases": self.durations,
+            "samples": self.num_samples,
+            "samples_per_second": self.num_samples / training_time if training_time > 0 else 0.0,
+            "train_loss": train_loss,
+            "val_loss": val_loss,
+            "peak_rss": peak_rss(),
+            "profiled": profiled,
+        }
+        if self.device.type == "cuda":
+            record["peak_device_memory"] = torch.cuda.max_memory_allocated(self.device)
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.profiler is not None:
+            self.profiler.stop()
+            self.profiler = None
+        if self.file is not None:
+            self.file.close()
@@ -0,0 +1,444 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Any, Callable, NamedTuple
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from constants import hue_range, num_epochs, num_models, sidelength, size_range
+
+default_config: dict[str, Any] = {
+    "num_models": num_models,
+    "num_epochs": num_epochs,
+    "num_samples": 2000,
+    # Render the dataset and the grid with render_images instead of cairo
+    "vectorized": False,
+    "dataset_seed": 0,
+    "valset_size_range": [0.6, 0.9],
+    "valset_hue_range": [0.4, 0.7],
+    # Seed of every model, defaults to its index
+    "seeds": None,
+    "trainset_batch_size": 256,
+    "valset_batch_size": 64,
+}
+
+commands = ["dataset", "grid", "train", "aggregate", "export", "all"]
+
+
+class Stage(NamedTuple):
+    name: str
+    fn: Callable[..., None]
+    # Keyword arguments of fn, which include all parameters of the stage
+    kwargs: dict[str, Any]
+    # Files read (outputs of the dependencies) and written
+    inputs: list[str]
+    outputs: list[str]
+    deps: list[str]
+
+
+def make_dataset(path: str, params: dict[str, Any]) -> None:
+    from dataset import generate_dataset
+
+    generate_dataset(
+        size_range,
+        hue_range,
+        tuple(params["valset_size_range"]),
+        tuple(params["valset_hue_range"]),
+        params["num_samples"],
+        vectorized=params["vectorized"],
+        seed=params["seed"],
+        path=path,
+    )
+
+
+def render_grid(path: str, vectorized: bool) -> None:
+    from grid import make_standard_grid
+    from image import get_images, render_images
+
+    standard_grid = make_standard_grid(size_range, hue_range)
+    if vectorized:
+        images = render_images(sidelength, standard_grid.reshape(-1, 2))
+    else:
+        coords = [(x, y) for x, y in standard_grid.reshape(-1, 2).tolist()]
+        images = get_images(sidelength, coords, show_progress=False)
+    np.save(path, images)
+
+
+def train_model(
+    dataset_path: str,
+    grid_path: str,
+    weights_path: str,
+    losses_path: str,
+    grids_path: str,
+    seed: int,
+    num_epochs: int,
+    trainset_batch_size: int,
+    valset_batch_size: int,
+) -> None:
+    from datasetfile import load_dataset
+    from training import train
+
+    _, _, trainset, valset = load_dataset(dataset_path)
+    grid = torch.from_numpy(np.load(grid_path)).float() / 255.0
+    torch.manual_seed(seed)
+    train_losses, val_losses, processed_grids = train(
+        torch.device("cpu"),
+        trainset,
+        valset,
+        weights_path,
+        num_epochs,
+        trainset_batch_size,
+        valset_batch_size,
+        grid,
+        show_progress=False,
+    )
+    assert processed_grids is not None
+    np.save(losses_path, np.array([train_losses, val_losses], dtype=np.float32))
+    np.save(grids_path, processed_grids.numpy())
+
+
+def write_losses(paths: list[str], dst_path: str) -> None:
+    """
+    Writes the losses of all models to losses.bin, float32 of shape (num_models, 2, num_epochs).
+    """
+    np.stack([np.load(path) for path in paths]).astype(np.float32).tofile(dst_path)
+
+
+def write_grids(paths: list[str], dst_path: str) -> None:
+    """
+    Writes the grid encodings of all models to grids.bin in the format of the web widgets.
+    """
+    from util import compress_floats
+
+    grids = np.stack([np.load(path) for path in paths])
+    with open(dst_path, "wb") as f:
+        f.write(compress_floats(grids.reshape(len(paths), -1, 10, 10, 2)))
+
+
+def export_model(weights_path: str, encoder_path: str, decoder_path: str) -> None:
+    from model import VAE
+    from util import onnx_export_to_files
+
+    vae = VAE(2)
+    vae.load_state_dict(torch.load(weights_path, map_location="cpu"))
+    vae.eval()
+    onnx_export_to_files(vae.encoder, vae.decoder, encoder_path, decoder_path)
+
+
+def build_stages(config: dict[str, Any], out_dir: str) -> dict[str, Stage]:
+    """
+    Returns the stages of the train_multiple flow, by name. Per model, there is a train_{i} and an
+    export_{i} stage; train_{i} only depends on the dataset and the grid, so the models are
+    independent of each other.
+    """
+
+    def path(name: str) -> str:
+        return os.path.join(out_dir, name)
+
+    n = config["num_models"]
+    seeds = config["seeds"] or list(range(n))
+    if len(seeds) != n:
+        raise ValueError(f"Expected {n} seeds, got {len(seeds)}")
+    dataset_params = {
+        "valset_size_range": config["valset_size_range"],
+        "valset_hue_range": config["valset_hue_range"],
+        "num_samples": config["num_samples"],
+        "vectorized": config["vectorized"],
+        "seed": config["dataset_seed"],
+    }
+    stages = [
+        Stage(
+            "dataset",
+            make_dataset,
+            {"path": path("dataset.vds"), "params": dataset_params},
+            [],
+            [path("dataset.vds")],
+            [],
+        ),
+        Stage(
+            "grid",
+            render_grid,
+            {"path": path("grid.npy"), "vectorized": config["vectorized"]},
+            [],
+            [path("grid.npy")],
+            [],
+        ),
+    ]
+    for i, seed in enumerate(seeds):
+        outputs = [path(f"vae_{i}.pth"), path(f"losses_{i}.npy"), path(f"grids_{i}.npy")]
+        stages.append(
+            Stage(
+                f"train_{i}",
+                train_model,
+                {
+                    "dataset_path": path("dataset.vds"),
+                    "grid_path": path("grid.npy"),
+                    "weights_path": outputs[0],
+                    "losses_path": outputs[1],
+                    "grids_path": outputs[2],
+                    "seed": seed,
+                    "num_epochs": config["num_epochs"],
+                    "trainset_batch_size": config["trainset_batch_size"],
+                    "valset_batch_size": config["valset_batch_size"],
+                },
+                [path("dataset.vds"), path("grid.npy")],
+                outputs,
+                ["dataset", "grid"],
+            )
+        )
+        stages.append(
+            Stage(
+                f"export_{i}",
+                export_model,
+                {
+                    "weights_path": outputs[0],
+                    "encoder_path": path(f"vae_{i}_encoder.onnx"),
+                    "decoder_path": path(f"vae_{i}_decoder.onnx"),
+                },
+                [outputs[0]],
+                [path(f"vae_{i}_encoder.onnx"), path(f"vae_{i}_decoder.onnx")],
+                [f"train_{i}"],
+            )
+        )
+    train_names = [f"train_{i}" for i in range(n)]
+    losses_paths = [path(f"losses_{i}.npy") for i in range(n)]
+    grids_paths = [path(f"grids_{i}.npy") for i in range(n)]
+    stages += [
+        Stage(
+            "losses",
+            write_losses,
+            {"paths": losses_paths, "dst_path": path("losses.bin")},
+            losses_paths,
+            [path("losses.bin")],
+            train_names,
+        ),
+        Stage(
+            "grids",
+            write_grids,
+            {"paths": grids_paths, "dst_path": path("grids.bin")},
+            grids_paths,
+            [path("grids.bin")],
+            train_names,
+        ),
+    ]
+    return {stage.name: stage for stage in stages}
+
+
+def targets(command: str, stages: dict[str, Stage], models: list[int] | None) -> list[str]:
+    def per_model(prefix: str) -> list[str]:
+        return (
+            [name for name in stages if name.startswith(prefix)]
+            if models is None
+            else [f"{prefix}{i}" for i in models]
+        )
+
+    if command == "train":
+        return per_model("train_")
+    if command == "export":
+        return per_model("export_")
+    if command == "aggregate":
+        return ["losses", "grids"]
+    if command == "all":
+        return ["losses", "grids", *per_model("export_")]
+    return [command]
+
+
+def with_dependencies(names: list[str], stages: dict[str, Stage]) -> list[str]:
+    """
+    Returns the given stages and everything they depend on, in a valid execution order.
+    """
+    order: list[str] = []
+
+    def visit(name: str) -> None:
+        if name in order:
+            return
+        for dep in stages[name].deps:
+            visit(dep)
+        order.append(name)
+
+    for name in names:
+        visit(name)
+    return order
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class Memo:
+    def __init__(self, out_dir: str):
+        """
+        Records per stage a digest of its parameters and input files and the digests of the
+        outputs it wrote, in out_dir/.pipeline/<stage>.json.
+        """
+        self.dir = os.path.join(out_dir, ".pipeline")
+
+    def stamp_path(self, stage: Stage) -> str:
+        return os.path.join(self.dir, f"{stage.name}.json")
+
+    def key(self, stage: Stage) -> str:
+        description = {
+            "kwargs": stage.kwargs,
+            "inputs": {path: file_digest(path) for path in stage.inputs},
+        }
+        return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def is_up_to_date(self, stage: Stage) -> bool:
+        """
+        A stage is up to date if it ran with the same parameters and inputs before and its outputs
+        are still the ones it wrote.
+        """
+        if not os.path.exists(self.stamp_path(stage)):
+            return False
+        if not all(os.path.exists(path) for path in stage.outputs):
+            return False
+        with open(self.stamp_path(stage)) as f:
+            stamp = json.load(f)
+        outputs = {path: file_digest(path) for path in stage.outputs}
+        return bool(stamp["key"] == self.key(stage) and stamp["outputs"] == outputs)
+
+    def record(self, stage: Stage) -> None:
+        os.makedirs(self.dir, exist_ok=True)
+        stamp = {
+            "key": self.key(stage),
+            "outputs": {path: file_digest(path) for path in stage.outputs},
+        }
+        tmp_path = f"{self.stamp_path(stage)}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(stamp, f, indent=2)
+        os.replace(tmp_path, self.stamp_path(stage))
+
+
+def init_worker(num_threads: int) -> None:
+    torch.set_num_threads(num_threads)
+
+
+def run_stage(stage: Stage) -> float:
+    start = time.perf_counter()
+    stage.fn(**stage.kwargs)
+    return time.perf_counter() - start
+
+
+def run_pipeline(
+    stages: dict[str, Stage],
+    names: list[str],
+    out_dir: str,
+    max_workers: int = 4,
+    force: bool = False,
+) -> list[str]:
+    """
+    Runs the given stages and their dependencies. Stages that are up to date are skipped; the
+    others run in a pool of worker processes as soon as their dependencies are done, so
+    independent stages (e.g. the training of different models) run concurrently.
+
+    Args:
+        stages (dict[str, Stage]): All stages, see build_stages.
+        names (list[str]): Stages to bring up to date.
+        out_dir (str): Output directory, which holds the memo.
+        max_workers (int): Maximum number of concurrent stages.
+        force (bool): Run the stages even if they are up to date.
+
+    Returns:
+        list[str]: Names of the stages that ran.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    memo = Memo(out_dir)
+    remaining = with_dependencies(names, stages)
+    done: set[str] = set()
+    ran = []
+    threads_per_worker = max(1, (os.cpu_count() or 1) // max_workers)
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(threads_per_worker,),
+    ) as executor:
+        running: dict[Future[float], Stage] = {}
+        failed: dict[str, BaseException] = {}
+        while True:
+            progressed = False
+            for name in list(remaining):
+                stage = stages[name]
+                if not all(dep in done for dep in stage.deps):
+                    continue
+                remaining.remove(name)
+                progressed = True
+                if not force and memo.is_up_to_date(stage):
+                    print(f"{name}: up to date")
+                    done.add(name)
+                    continue
+                print(f"{name}: running")
+                running[executor.submit(run_stage, stage)] = stage
+            if progressed:
+                continue
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    # The stages that don't depend on it still run, so a re-run only repeats this
+                    # branch
+                    print(f"{stage.name}: failed ({error!r})")
+                    failed[stage.name] = error
+                    continue
+                memo.record(stage)
+                done.add(stage.name)
+                ran.append(stage.name)
+                print(f"{stage.name}: done in {future.result():.1f}s")
+    if failed:
+        skipped = f", skipped {', '.join(remaining)}" if remaining else ""
+        raise RuntimeError(f"Stages {', '.join(failed)} failed{skipped}") from next(
+            iter(failed.values())
+        )
+    return ran
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run the train_multiple flow headlessly, skipping stages that are up to date"
+    )
+    parser.add_argument("command", choices=commands)
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--config", help="JSON file overriding the defaults, e.g. the seeds")
+    parser.add_argument("--models", type=int, nargs="+", help="Models to train or export")
+    parser.add_argument("--jobs", type=int, default=4, help="Maximum number of concurrent stages")
+    parser.add_argument("--force", action="store_true", help="Re-run up-to-date stages")
+    parser.add_argument(
+        "--dry-run", action="store_true", help="Only list the stages that would run"
+    )
+    args = parser.parse_args()
+
+    config = dict(default_config)
+    if args.config is not None:
+        with open(args.config) as f:
+            config.update(json.load(f))
+    stages = build_stages(config, args.out_dir)
+    names = targets(args.command, stages, args.models)
+    if args.dry_run:
+        memo = Memo(args.out_dir)
+        stale: set[str] = set()
+        for name in with_dependencies(names, stages):
+            stage = stages[name]
+            # A stage whose dependencies re-run may get new inputs, so it counts as stale
+            if (
+                args.force
+                or any(dep in stale for dep in stage.deps)
+                or not all(os.path.exists(path) for path in stage.inputs)
+                or not memo.is_up_to_date(stage)
+            ):
+                stale.add(name)
+            print(f"{name}: {'would run' if name in stale else 'up to date'}")
+        return
+    run_pipeline(stages, names, args.out_dir, args.jobs, args.force)
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,152 @@
+import os
+
+import numpy as np
+import torch
+from torch import nn
+
+from trajectorystore import TrajectoryWriter
+
+
+class MetricsRecorder:
+    def __init__(self) -> None:
+        """
+        Accumulates batch losses on the device they were computed on, so that the host only has to
+        wait for the device once per epoch instead of once per batch.
+        """
+        self.total: torch.Tensor | None = None
+        self.count = 0
+
+    def add(self, loss: torch.Tensor) -> None:
+        loss = loss.detach()
+        self.total = loss if self.total is None else self.total + loss
+        self.count += 1
+
+    def mean(self) -> float:
+        """
+        Returns the mean of the recorded losses and resets the recorder.
+        """
+        if self.total is None:
+            raise ValueError("No losses recorded.")
+        mean = self.total.item() / self.count
+        self.total = None
+        self.count = 0
+        return mean
+
+
+class TrajectoryRecorder:
+    def __init__(
+        self,
+        grid: torch.Tensor,
+        capacity: int,
+        latent_dim: int,
+        path: str | None = None,
+        every_n_steps: int | None = None,
+        append: bool = False,
+    ):
+        """
+        Records the encodings of a fixed grid of images over the course of training.
+
+        The encodings are written into a preallocated ring buffer on the grid's device; they are
+        copied to the host only when the buffer is full or when flush is called. If a path is given,
+        all snapshots are written to a trajectory store (see trajectorystore) as the chunks of model
+        0, which replaces an existing store unless append is set.
+
+        Args:
+            grid (torch.Tensor): Normalized images of shape (num_points, 3, sidelength, sidelength).
+            capacity (int): Number of snapshots kept in memory.
+            latent_dim (int): Dimension of the encodings.
+            path (str | None): Trajectory store to write to.
+            every_n_steps (int | None): Snapshot cadence in training steps, None for once per epoch.
+            append (bool): Append to an existing trajectory store, e.g. when resuming. Its grid
+                size and latent_dim must match.
+        """
+        self.grid = grid
+        self.capacity = capacity
+        self.every_n_steps = every_n_steps
+        self.buffer = torch.zeros((capacity, grid.shape[0], latent_dim), device=grid.device)
+        self.positions = np.zeros((capacity, 2), dtype=np.int64)
+        self.count = 0
+        self.flushed = 0
+        self.writer = None
+        if path is not None:
+            if not append and os.path.exists(path):
+                os.remove(path)
+            # Raises if an existing store was written for another grid size or latent_dim
+            self.writer = TrajectoryWriter(path, grid.shape[0], latent_dim, bits=16, delta=True)
+
+    def record(self, encoder: nn.Module, step: int, epoch: int) -> None:
+        if self.count - self.flushed == self.capacity:
+            self.flush()
+        with torch.no_grad():
+            mu, _ = encoder(self.grid)
+        i = self.count % self.capacity
+        self.buffer[i] = mu
+        self.positions[i] = (step, epoch)
+        self.count += 1
+
+    def after_step(self, encoder: nn.Module, step: int, epoch: int) -> None:
+        if self.every_n_steps is not None and step % self.every_n_steps == 0:
+            self.record(encoder, step, epoch)
+
+    def after_epoch(self, encoder: nn.Module, step: int, epoch: int) -> None:
+        if self.every_n_steps is None:
+            self.record(encoder, step, epoch)
+
+    def flush(self) -> None:
+        """
+        Appends the snapshots that haven't been written yet to the trajectory store.
+        """
+        if self.writer is None or self.flushed == self.count:
+            self.flushed = self.count
+            return
+        indices = [i % self.capacity for i in range(self.flushed, self.count)]
+        encodings = self.buffer[indices].cpu().numpy()
+        for j, i in enumerate(indices):
+            step, epoch = self.positions[i]
+            self.writer.append(0, int(epoch), encodings[j], step=int(step))
+        self.writer.flush()
+        self.flushed = self.count
+
+    def snapshots(self) -> torch.Tensor:
+        """
+        Returns the snapshots still held in memory, oldest first, on the CPU.
+        """
+        num_kept = min(self.count, self.capacity)
+        indices = [i % self.capacity for i in range(self.count - num_kept, self.count)]
+        return self.buffer[indices].cpu()
+
+    def state(self) -> dict[str, object]:
+        """
+        Flushes the trajectory store and returns the recorder state for a checkpoint.
+        """
+        self.flush()
+        num_kept = min(self.count, self.capacity)
+        indices = [i % self.capacity for i in range(self.count - num_kept, self.count)]
+        return {
+            "snapshots": self.snapshots(),
+            "positions": self.positions[indices].copy(),
+            "count": self.count,
+        }
+
+    def restore(self, state: dict[str, object]) -> None:
+        """
+        Restores the state returned by state(). Snapshots that were appended to the trajectory store
+        after that state was taken are cut off.
+        """
+        snapshots = state["snapshots"]
+        positions = state["positions"]
+        assert isinstance(snapshots, torch.Tensor) and isinstance(positions, np.ndarray)
+        self.count = int(state["count"])  # type: ignore[call-overload]
+        self.flushed = self.count
+        for j in range(len(snapshots)):
+            i = (self.count - len(snapshots) + j) % self.capacity
+            self.buffer[i] = snapshots[j]
+            self.positions[i] = positions[j]
+        if self.writer is not None:
+            self.writer.truncate(self.count)
+
+    def close(self) -> None:
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
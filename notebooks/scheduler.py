@@ -0,0 +1,136 @@
+import os
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterator, NamedTuple
+
+import torch
+import torch.multiprocessing as mp
+
+from training import train
+
+
+class TrainingJob(NamedTuple):
+    seed: int
+    dst_path: str
+    num_epochs: int = 100
+    trainset_batch_size: int = 256
+    valset_batch_size: int = 64
+
+
+class JobResult(NamedTuple):
+    job: TrainingJob
+    train_losses: list[float]
+    val_losses: list[float]
+    processed_grids: torch.Tensor | None
+
+
+# Data of a worker process, set by init_worker
+worker_tensors: tuple[torch.Tensor, torch.Tensor, torch.Tensor | None] | None = None
+
+
+def init_worker(
+    num_threads: int, trainset: torch.Tensor, valset: torch.Tensor, grid: torch.Tensor | None
+) -> None:
+    global worker_tensors
+    torch.set_num_threads(num_threads)
+    worker_tensors = (trainset, valset, grid)
+
+
+def run_job(job: TrainingJob) -> JobResult:
+    assert worker_tensors is not None
+    trainset, valset, grid = worker_tensors
+    torch.manual_seed(job.seed)
+    train_losses, val_losses, processed_grids = train(
+        torch.device("cpu"),
+        trainset,
+        valset,
+        job.dst_path,
+        job.num_epochs,
+        job.trainset_batch_size,
+        job.valset_batch_size,
+        grid,
+        show_progress=False,
+    )
+    return JobResult(job, train_losses, val_losses, processed_grids)
+
+
+def run_jobs(
+    jobs: list[TrainingJob],
+    trainset: torch.Tensor,
+    valset: torch.Tensor,
+    grid: torch.Tensor | None = None,
+    max_workers: int = 4,
+    threads_per_worker: int | None = None,
+    max_retries: int = 1,
+) -> Iterator[JobResult]:
+    """
+    Runs independent training jobs in a pool of CPU worker processes and yields the results as the
+    jobs finish.
+
+    The datasets (and the grid) are moved to shared memory once and handed to the workers when
+    they start, so they are not pickled per job. CPU tensors are moved in place (share_memory_), so
+    the caller's tensors end up in shared memory too; their values don't change. Every worker gets
+    a fixed torch thread budget so that the workers don't oversubscribe the cores.
+
+    A job that raises is retried up to max_retries times. When a worker crashes, the pool breaks
+    and all its unfinished jobs fail without telling which one crashed it. These jobs are not
+    charged an attempt; they run again one at a time, so that a crash can be attributed to the job
+    that causes it.
+
+    Args:
+        jobs (list[TrainingJob]): The jobs to run.
+        trainset (torch.Tensor): Training set (uint8), shared by all jobs.
+        valset (torch.Tensor): Validation set (uint8), shared by all jobs.
+        grid (torch.Tensor | None): Normalized grid images to track during training.
+        max_workers (int): Maximum number of concurrent jobs.
+        threads_per_worker (int | None): Torch threads per worker, defaults to an even share of
+            the cores.
+        max_retries (int): How often a failed job is retried before giving up.
+
+    Returns:
+        Iterator[JobResult]: The results in order of completion.
+    """
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // max_workers)
+    shared = [tensor.cpu() for tensor in [trainset, valset]]
+    if grid is not None:
+        shared.append(grid.cpu())
+    for tensor in shared:
+        tensor.share_memory_()  # type: ignore[no-untyped-call]
+    shared_grid = None if grid is None else shared[2]
+
+    attempts = [0] * len(jobs)
+    pending = list(range(len(jobs)))
+    # Unfinished jobs of a broken pool, one of which may have crashed it
+    suspects: list[int] = []
+    while pending or suspects:
+        isolated = not pending
+        batch = [suspects.pop(0)] if isolated else pending
+        pending = []
+        with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(batch)),
+            mp_context=mp.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(threads_per_worker, shared[0], shared[1], shared_grid),
+        ) as executor:
+            futures: dict[Future[JobResult], int] = {
+                executor.submit(run_job, jobs[i]): i for i in batch
+            }
+            for future in as_completed(futures):
+                i = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool as e:
+                    if not isolated:
+                        suspects.append(i)
+                        continue
+                    error: BaseException = e
+                except Exception as e:
+                    error = e
+                else:
+                    yield result
+                    continue
+                attempts[i] += 1
+                if attempts[i] > max_retries:
+                    raise RuntimeError(f"Job {jobs[i]} failed {attempts[i]} times") from error
+                pending.append(i)
@@ -0,0 +1,147 @@
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Sequence
+
+import numpy as np
+
+
+class StoppingPolicy(ABC):
+    """
+    Decides after every epoch whether training should stop, based on the validation losses so far.
+    """
+
+    def start(self) -> None:
+        pass
+
+    @abstractmethod
+    def should_stop(self, val_losses: list[float]) -> bool:
+        pass
+
+    def state(self) -> dict[str, Any]:
+        """
+        Returns what the policy needs besides the losses to continue after resuming training.
+        """
+        return {}
+
+    def restore(self, state: dict[str, Any]) -> None:
+        pass
+
+
+class Patience(StoppingPolicy):
+    def __init__(self, patience: int, min_delta: float = 0.0):
+        """
+        Stops when the best validation loss hasn't improved by more than min_delta for patience
+        epochs.
+        """
+        self.patience = patience
+        self.min_delta = min_delta
+
+    def should_stop(self, val_losses: list[float]) -> bool:
+        if len(val_losses) <= self.patience:
+            return False
+        best_before = min(val_losses[: -self.patience])
+        return min(val_losses[-self.patience :]) > best_before - self.min_delta
+
+
+class RelativeImprovement(StoppingPolicy):
+    def __init__(self, threshold: float, window: int = 5):
+        """
+        Stops when the best validation loss improved by less than threshold (a fraction, e.g. 0.001)
+        over the last window epochs.
+        """
+        self.threshold = threshold
+        self.window = window
+
+    def should_stop(self, val_losses: list[float]) -> bool:
+        if len(val_losses) <= self.window:
+            return False
+        best_before = min(val_losses[: -self.window])
+        best = min(best_before, *val_losses[-self.window :])
+        return (best_before - best) / abs(best_before) < self.threshold
+
+
+class WallClock(StoppingPolicy):
+    def __init__(self, seconds: float):
+        """
+        Stops when another epoch, taking as long as the last one, would exceed a time budget counted
+        from the start of training.
+        """
+        self.seconds = seconds
+        self.start_time = time.perf_counter()
+        self.last_time = self.start_time
+
+    def start(self) -> None:
+        self.start_time = self.last_time = time.perf_counter()
+
+    def should_stop(self, val_losses: list[float]) -> bool:
+        now = time.perf_counter()
+        epoch_duration = now - self.last_time
+        self.last_time = now
+        return now + epoch_duration - self.start_time > self.seconds
+
+    def state(self) -> dict[str, Any]:
+        return {"elapsed": time.perf_counter() - self.start_time}
+
+    def restore(self, state: dict[str, Any]) -> None:
+        # Only the time spent training counts, not the time between the runs
+        self.last_time = time.perf_counter()
+        self.start_time = self.last_time - state["elapsed"]
+
+
+class EarlyStopping:
+    def __init__(self, policies: Sequence[StoppingPolicy], min_epochs: int = 1):
+        """
+        Stops training as soon as any of the policies says so, but not before min_epochs epochs.
+
+        After training, stopped_epoch and reason tell whether and why training stopped early. The
+        losses and grids returned by training.train keep their full length (see pad_epochs), so
+        these are the only record of where the actual training ended.
+        """
+        self.policies = policies
+        self.min_epochs = min_epochs
+        self.stopped_epoch: int | None = None
+        self.reason: str | None = None
+
+    def start(self) -> None:
+        self.stopped_epoch = None
+        self.reason = None
+        for policy in self.policies:
+            policy.start()
+
+    def should_stop(self, epoch: int, val_losses: list[float]) -> bool:
+        """
+        Checks the policies after epoch, given the validation losses of all epochs so far.
+        """
+        # Every policy sees every epoch, so that their clocks and windows stay in step
+        stopping = [policy for policy in self.policies if policy.should_stop(val_losses)]
+        if epoch + 1 < self.min_epochs or not stopping:
+            return False
+        self.stopped_epoch = epoch
+        self.reason = type(stopping[0]).__name__
+        return True
+
+    def state(self) -> dict[str, Any]:
+        return {
+            "stopped_epoch": self.stopped_epoch,
+            "reason": self.reason,
+            "policies": [policy.state() for policy in self.policies],
+        }
+
+    def restore(self, state: dict[str, Any]) -> None:
+        self.stopped_epoch = state["stopped_epoch"]
+        self.reason = state["reason"]
+        for policy, policy_state in zip(self.policies, state["policies"]):
+            policy.restore(policy_state)
+
+    def num_epochs_trained(self, num_epochs: int) -> int:
+        return num_epochs if self.stopped_epoch is None else self.stopped_epoch + 1
+
+
+def pad_epochs(values: Sequence[float] | np.ndarray, num_epochs: int) -> np.ndarray:
+    """
+    Pads per-epoch values (losses, or grid encodings of shape (epochs, ...)) to num_epochs entries
+    by repeating the last one, as if the model had been frozen after it stopped training.
+    """
+    values = np.asarray(values)
+    padding = np.repeat(values[-1:], num_epochs - len(values), axis=0)
+    return np.concatenate([values, padding])
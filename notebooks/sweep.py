@@ -0,0 +1,284 @@
+import argparse
+import csv
+import itertools
+import os
+import random
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import NamedTuple
+
+import torch
+import torch.multiprocessing as mp
+
+import scheduler
+from checkpoint import latest_checkpoint
+from datasetfile import DatasetFile
+from scheduler import init_worker
+from training import train
+
+
+class SearchSpace(NamedTuple):
+    latent_dim: tuple[int, ...] = (2,)
+    learning_rate: tuple[float, ...] = (1e-3,)
+    trainset_batch_size: tuple[int, ...] = (256,)
+    valset_batch_size: tuple[int, ...] = (64,)
+
+
+class TrialConfig(NamedTuple):
+    latent_dim: int
+    learning_rate: float
+    trainset_batch_size: int
+    valset_batch_size: int
+    seed: int
+
+
+class TrialResult(NamedTuple):
+    trial: int
+    config: TrialConfig
+    # Validation losses (negative ELBO) of all epochs the trial trained for
+    val_losses: list[float]
+    # Whether the scheduler stopped the trial before max_epochs
+    stopped: bool
+
+
+def sample_trials(
+    space: SearchSpace, num_trials: int | None = None, seed: int = 0
+) -> list[TrialConfig]:
+    """
+    Returns all combinations of the search space or, with num_trials, that many of them drawn at
+    random (with repetitions only if there are fewer combinations). Every trial gets its own seed.
+    """
+    combinations = list(itertools.product(*space))
+    if num_trials is not None:
+        rng = random.Random(seed)
+        if num_trials <= len(combinations):
+            combinations = rng.sample(combinations, num_trials)
+        else:
+            combinations = [rng.choice(combinations) for _ in range(num_trials)]
+    return [TrialConfig(*values, seed=seed + i) for i, values in enumerate(combinations)]
+
+
+def rung_epochs(min_epochs: int, max_epochs: int, eta: int) -> list[int]:
+    """
+    Returns the epochs at which trials are compared: min_epochs, growing by a factor of eta, up to
+    max_epochs.
+    """
+    rungs = []
+    epochs = min_epochs
+    while epochs < max_epochs:
+        rungs.append(epochs)
+        epochs *= eta
+    return rungs + [max_epochs]
+
+
+class AshaScheduler:
+    def __init__(self, num_trials: int, rungs: list[int], eta: int = 3):
+        """
+        Decides which trial to train next with asynchronous successive halving (ASHA).
+
+        Every trial starts by training up to the first rung. Whenever a worker is free, a trial is
+        promoted to its next rung if it is among the best 1/eta of the trials that reached its
+        current rung so far; otherwise a new trial starts. Trials that are never promoted are
+        stopped, so only about a 1/eta fraction of the trials trains on from each rung.
+        """
+        self.num_trials = num_trials
+        self.rungs = rungs
+        self.eta = eta
+        self.num_started = 0
+        # Per rung, the validation loss of every trial that reached it
+        self.losses: list[dict[int, float]] = [{} for _ in rungs]
+        self.promoted: list[set[int]] = [set() for _ in rungs]
+
+    def next_job(self) -> tuple[int, int] | None:
+        """
+        Returns the next trial and the rung to train it to, or None if there is nothing to do until
+        a running job reports.
+        """
+        for rung in reversed(range(len(self.rungs) - 1)):
+            losses = self.losses[rung]
+            best = sorted(losses, key=losses.__getitem__)[: len(losses) // self.eta]
+            for trial in best:
+                if trial not in self.promoted[rung]:
+                    self.promoted[rung].add(trial)
+                    return trial, rung + 1
+        if self.num_started < self.num_trials:
+            self.num_started += 1
+            return self.num_started - 1, 0
+        return None
+
+    def report(self, trial: int, rung: int, val_loss: float) -> None:
+        self.losses[rung][trial] = val_loss
+
+
+def run_trial(trial_dir: str, config: TrialConfig, num_epochs: int) -> list[float]:
+    """
+    Trains a trial up to num_epochs, continuing from its latest checkpoint, and returns the
+    validation losses of all its epochs.
+    """
+    assert scheduler.worker_tensors is not None
+    trainset, valset, _ = scheduler.worker_tensors
+    torch.manual_seed(config.seed)
+    _, val_losses, _ = train(
+        torch.device("cpu"),
+        trainset,
+        valset,
+        os.path.join(trial_dir, "vae.pth"),
+        num_epochs,
+        config.trainset_batch_size,
+        config.valset_batch_size,
+        show_progress=False,
+        checkpoint_dir=trial_dir,
+        keep_last_checkpoints=1,
+        resume_from=latest_checkpoint(trial_dir),
+        learning_rate=config.learning_rate,
+        latent_dim=config.latent_dim,
+    )
+    return val_losses
+
+
+def run_sweep(
+    configs: list[TrialConfig],
+    trainset: torch.Tensor,
+    valset: torch.Tensor,
+    out_dir: str,
+    min_epochs: int = 5,
+    max_epochs: int = 100,
+    eta: int = 3,
+    max_workers: int = 4,
+    threads_per_worker: int | None = None,
+) -> list[TrialResult]:
+    """
+    Trains the trials with ASHA (see AshaScheduler) on a pool of CPU worker processes, comparing
+    them by their validation loss (negative ELBO) at the rungs (see rung_epochs). A promoted trial
+    continues from its checkpoint in out_dir/trial_{i}, so no epoch is trained twice.
+
+    Args:
+        configs (list[TrialConfig]): The trials, e.g. from sample_trials.
+        trainset (torch.Tensor): Training set (uint8), shared by all trials.
+        valset (torch.Tensor): Validation set (uint8), shared by all trials.
+        out_dir (str): Directory for the checkpoints and weights (vae.pth) of the trials.
+        min_epochs (int): Epochs of the first rung.
+        max_epochs (int): Epochs of the trials that are never stopped.
+        eta (int): Reduction factor between the rungs.
+        max_workers (int): Maximum number of concurrently training trials.
+        threads_per_worker (int | None): Torch threads per worker, defaults to an even share of
+            the cores.
+
+    Returns:
+        list[TrialResult]: The results of all trials, in the order of configs.
+    """
+    if threads_per_worker is None:
+        threads_per_worker = max(1, (os.cpu_count() or 1) // max_workers)
+    shared = [tensor.cpu() for tensor in [trainset, valset]]
+    for tensor in shared:
+        tensor.share_memory_()  # type: ignore[no-untyped-call]
+
+    rungs = rung_epochs(min_epochs, max_epochs, eta)
+    asha = AshaScheduler(len(configs), rungs, eta)
+    val_losses: list[list[float]] = [[] for _ in configs]
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(threads_per_worker, shared[0], shared[1], None),
+    ) as executor:
+        running: dict[Future[list[float]], tuple[int, int]] = {}
+        while True:
+            while len(running) < max_workers and (job := asha.next_job()) is not None:
+                trial, rung = job
+                trial_dir = os.path.join(out_dir, f"trial_{trial}")
+                future = executor.submit(run_trial, trial_dir, configs[trial], rungs[rung])
+                running[future] = job
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                trial, rung = running.pop(future)
+                val_losses[trial] = future.result()
+                asha.report(trial, rung, val_losses[trial][-1])
+
+    return [
+        TrialResult(i, config, val_losses[i], len(val_losses[i]) < max_epochs)
+        for i, config in enumerate(configs)
+    ]
+
+
+def write_results(results: list[TrialResult], path: str) -> None:
+    """
+    Writes one row per trial to a CSV file, the best trials first.
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(
+            ["trial", *TrialConfig._fields, "epochs", "best_val_loss", "final_val_loss", "status"]
+        )
+        for result in sorted(results, key=lambda result: min(result.val_losses)):
+            writer.writerow(
+                [
+                    result.trial,
+                    *result.config,
+                    len(result.val_losses),
+                    min(result.val_losses),
+                    result.val_losses[-1],
+                    "stopped" if result.stopped else "completed",
+                ]
+            )
+
+
+def run() -> None:
+    parser = argparse.ArgumentParser(
+        description="Search hyperparameters with asynchronous successive halving (ASHA)"
+    )
+    parser.add_argument("--dataset", default="dataset.vds", help="Dataset file (see datasetfile)")
+    parser.add_argument("--out-dir", default="sweep")
+    parser.add_argument("--latent-dims", type=int, nargs="+", default=[2])
+    parser.add_argument("--learning-rates", type=float, nargs="+", default=[1e-3])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[256])
+    parser.add_argument("--val-batch-sizes", type=int, nargs="+", default=[64])
+    parser.add_argument(
+        "--num-trials", type=int, help="Sample this many trials instead of the full grid"
+    )
+    parser.add_argument("--min-epochs", type=int, default=5)
+    parser.add_argument("--max-epochs", type=int, default=100)
+    parser.add_argument("--eta", type=int, default=3)
+    parser.add_argument("--jobs", type=int, default=4, help="Maximum number of concurrent trials")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    space = SearchSpace(
+        tuple(args.latent_dims),
+        tuple(args.learning_rates),
+        tuple(args.batch_sizes),
+        tuple(args.val_batch_sizes),
+    )
+    configs = sample_trials(space, args.num_trials, args.seed)
+    dataset = DatasetFile(args.dataset)
+    results = run_sweep(
+        configs,
+        dataset.images("train"),
+        dataset.images("val"),
+        args.out_dir,
+        args.min_epochs,
+        args.max_epochs,
+        args.eta,
+        args.jobs,
+    )
+    results_path = os.path.join(args.out_dir, "results.csv")
+    write_results(results, results_path)
+
+    print(f"{'trial':>5}  {'latent':>6}  {'lr':>8}  {'batch':>5}  {'epochs':>6}  {'val loss':>10}")
+    for result in sorted(results, key=lambda result: min(result.val_losses)):
+        config = result.config
+        print(
+            f"{result.trial:5}  {config.latent_dim:6}  {config.learning_rate:8.1e}  "
+            f"{config.trainset_batch_size:5}  {len(result.val_losses):6}  "
+            f"{min(result.val_losses):10.1f}"
+        )
+    epochs = sum(len(result.val_losses) for result in results)
+    print(
+        f"Trained {epochs} epochs instead of {len(results) * args.max_epochs} for an exhaustive "
+        f"search; results in {results_path}"
+    )
+
+
+if __name__ == "__main__":
+    run()
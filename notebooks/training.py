@@ -1,16 +1,27 @@
+from typing import Collection, Iterable, Iterator
+
 import numpy as np
 import torch
-from tqdm.notebook import trange
 
-from constants import sidelength
-from elbo import approximate_elbo
+from checkpoint import CheckpointManager, load_checkpoint, set_rng_states
+from constants import latent_dim, sidelength
+from dataset import StreamingDataset
+from elbo import approximate_elbo, negative_elbo
 from model import VAE
-from util import BatchIterator
+from monitor import TrainingMonitor
+from recorder import MetricsRecorder, TrajectoryRecorder
+from stopping import EarlyStopping, pad_epochs
+from util import BatchIterator, DeviceBatchIterator, progress
+
+
+def normalize(batches: Iterable[torch.Tensor], device: torch.device) -> Iterator[torch.Tensor]:
+    for batch in batches:
+        yield (batch / 255.0).to(device)
 
 
 def train(
     device: torch.device,
-    trainset: torch.Tensor,
+    trainset: torch.Tensor | StreamingDataset,
     valset: torch.Tensor,
     dst_path: str,
     num_epochs: int = 100,
@@ -18,67 +29,197 @@ def train(
     valset_batch_size: int = 64,
     grid: torch.Tensor | None = None,
     is_inner_loop: bool = False,
+    device_resident: bool = False,
+    data_dtype: torch.dtype = torch.uint8,
+    show_progress: bool = True,
+    fast: bool = False,
+    grid_every_n_steps: int | None = None,
+    trajectory_path: str | None = None,
+    checkpoint_dir: str | None = None,
+    keep_last_checkpoints: int = 3,
+    resume_from: str | None = None,
+    timings_path: str | None = None,
+    profile_epochs: Collection[int] = (),
+    trace_dir: str = ".",
+    learning_rate: float = 1e-3,
+    latent_dim: int = latent_dim,
+    early_stopping: EarlyStopping | None = None,
 ) -> tuple[list[float], list[float], torch.Tensor | None]:
     train_losses = []
     val_losses = []
 
     best_val_loss = np.inf
-    vae = VAE(2).to(device)
-    optimizer = torch.optim.Adam(vae.parameters(), lr=1e-3)
+    vae = VAE(latent_dim).to(device)
+    optimizer = torch.optim.Adam(vae.parameters(), lr=learning_rate)
+
+    if fast:
+        # Compiled, channels-last model running in bfloat16, loss accumulated in float32
+        vae = vae.to(memory_format=torch.channels_last)
+        compiled_vae = torch.compile(vae)
+        compiled_loss = torch.compile(negative_elbo)
+
+    def forward(x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        if fast:
+            x = x.contiguous(memory_format=torch.channels_last)
+            with torch.autocast(device.type, dtype=torch.bfloat16):
+                enc_mu, enc_logvar, dec_mu = compiled_vae(x)
+            return x, enc_mu, enc_logvar, dec_mu
+        enc_mu, enc_logvar, dec_mu = vae(x)
+        return x, enc_mu, enc_logvar, dec_mu
 
+    def loss(
+        x: torch.Tensor, enc_mu: torch.Tensor, enc_logvar: torch.Tensor, dec_mu: torch.Tensor
+    ) -> torch.Tensor:
+        if fast:
+            return compiled_loss(x, dec_mu, enc_mu, enc_logvar)
+        return -approximate_elbo(
+            x.view(x.shape[0], sidelength * sidelength * 3),
+            dec_mu.view(dec_mu.shape[0], sidelength * sidelength * 3),
+            enc_mu,
+            enc_logvar,
+        ).mean()
+
+    def batch_loss(x: torch.Tensor) -> torch.Tensor:
+        return loss(*forward(x))
+
+    if device_resident:
+        if isinstance(trainset, torch.Tensor):
+            device_trainset = DeviceBatchIterator(trainset, trainset_batch_size, device, data_dtype)
+        device_valset = DeviceBatchIterator(valset, valset_batch_size, device, data_dtype)
+
+    train_metrics = MetricsRecorder()
+    val_metrics = MetricsRecorder()
+    trajectory = None
     if grid is not None:
-        processed_grids = torch.zeros((num_epochs, 100, 2))
+        if grid_every_n_steps is None:
+            num_snapshots = num_epochs
+        else:
+            if isinstance(trainset, StreamingDataset):
+                steps_per_epoch = trainset.samples_per_epoch // trainset_batch_size
+            else:
+                steps_per_epoch = trainset.shape[0] // trainset_batch_size
+            num_snapshots = max(1, num_epochs * steps_per_epoch // grid_every_n_steps)
+        trajectory = TrajectoryRecorder(
+            grid,
+            num_snapshots,
+            latent_dim,
+            trajectory_path,
+            grid_every_n_steps,
+            append=resume_from is not None,
+        )
+
+    step = 0
+    start_epoch = 0
+    if early_stopping is not None:
+        early_stopping.start()
+    if resume_from is not None:
+        checkpoint = load_checkpoint(resume_from)
+        vae.load_state_dict(checkpoint["model"])
+        optimizer.load_state_dict(checkpoint["optimizer"])
+        train_losses = checkpoint["train_losses"]
+        val_losses = checkpoint["val_losses"]
+        best_val_loss = checkpoint["best_val_loss"]
+        step = checkpoint["step"]
+        if trajectory is not None:
+            trajectory.restore(checkpoint["trajectory"])
+        set_rng_states(checkpoint["rng_states"])
+        start_epoch = checkpoint["epoch"] + 1
+        if early_stopping is not None and "early_stopping" in checkpoint:
+            early_stopping.restore(checkpoint["early_stopping"])
+            if early_stopping.stopped_epoch is not None:
+                # The run already stopped, only its (padded) results are returned
+                start_epoch = num_epochs
 
+    checkpoints = CheckpointManager(checkpoint_dir, keep_last_checkpoints)
+    monitor = TrainingMonitor(timings_path, device, profile_epochs, trace_dir)
     if is_inner_loop:
-        pbar = trange(num_epochs, position=1, leave=False)
+        pbar = progress(range(start_epoch, num_epochs), show_progress, position=1, leave=False)
     else:
-        pbar = trange(num_epochs)
+        pbar = progress(range(start_epoch, num_epochs), show_progress)
     for epoch in pbar:
+        monitor.start_epoch(epoch)
         vae.train()
-        per_batch_train_losses = []
-        batch_iterator = BatchIterator(trainset, trainset_batch_size)
-        for batch in batch_iterator:
-            x = (batch / 255.0).to(device)
-            enc_mu, enc_logvar, dec_mu = vae(x)
-            loss: torch.Tensor = -approximate_elbo(
-                x.view(x.shape[0], sidelength * sidelength * 3),
-                dec_mu.view(dec_mu.shape[0], sidelength * sidelength * 3),
-                enc_mu,
-                enc_logvar,
-            ).mean()
-            per_batch_train_losses.append(loss.item())
+        train_batches: Iterable[torch.Tensor]
+        if isinstance(trainset, StreamingDataset):
+            trainset.set_epoch(epoch)
+            train_batches = normalize(trainset.loader(trainset_batch_size), device)
+        elif device_resident:
+            train_batches = device_trainset
+        else:
+            train_batches = normalize(BatchIterator(trainset, trainset_batch_size), device)
+        for x in train_batches:
+            monitor.lap("data", x.shape[0])
+            outputs = forward(x)
+            monitor.lap("forward")
+            batch_train_loss = loss(*outputs)
+            train_metrics.add(batch_train_loss)
+            monitor.lap("loss")
             optimizer.zero_grad()
-            loss.backward()  # type: ignore[no-untyped-call]
+            batch_train_loss.backward()  # type: ignore[no-untyped-call]
+            monitor.lap("backward")
             optimizer.step()
-        train_losses.append(float(np.mean(per_batch_train_losses)))
+            monitor.lap("optimizer")
+            step += 1
+            if trajectory is not None:
+                trajectory.after_step(vae.encoder, step, epoch)
+                monitor.lap("grid")
+        train_losses.append(train_metrics.mean())
 
-        per_batch_val_losses = []
         vae.eval()
         with torch.no_grad():
-            batch_iterator = BatchIterator(valset, valset_batch_size)
-            for batch in batch_iterator:
-                x = (batch / 255.0).to(device)
-                enc_mu, enc_logvar, dec_mu = vae(x)
-                loss = -approximate_elbo(
-                    x.view(x.shape[0], sidelength * sidelength * 3),
-                    dec_mu.view(dec_mu.shape[0], sidelength * sidelength * 3),
-                    enc_mu,
-                    enc_logvar,
-                ).mean()
-                per_batch_val_losses.append(loss.item())
-
-                if grid is not None:
-                    mu, logvar = vae.encoder(grid)
-                    processed_grids[epoch] = mu
+            val_batches: Iterable[torch.Tensor]
+            if device_resident:
+                val_batches = device_valset
+            else:
+                val_batches = normalize(BatchIterator(valset, valset_batch_size), device)
+            for x in val_batches:
+                val_metrics.add(batch_loss(x))
+        epoch_val_loss = val_metrics.mean()
+        val_losses.append(epoch_val_loss)
+        monitor.lap("validation")
+        if trajectory is not None:
+            trajectory.after_epoch(vae.encoder, step, epoch)
+            monitor.lap("grid")
         pbar.set_postfix(
             train_loss=int(np.round(train_losses[-1])),
-            val_loss=int(np.round(np.mean(per_batch_val_losses))),
+            val_loss=int(np.round(epoch_val_loss)),
         )
-        epoch_val_loss = float(np.mean(per_batch_val_losses))
-        val_losses.append(float(epoch_val_loss))
 
-        if epoch > float(num_epochs) * 0.75 and epoch_val_loss < best_val_loss:
+        stop = early_stopping is not None and early_stopping.should_stop(epoch, val_losses)
+        is_best = epoch_val_loss < best_val_loss
+        if is_best:
             best_val_loss = epoch_val_loss
-            torch.save(vae.state_dict(), dst_path)
+            checkpoints.save_weights(vae.state_dict(), dst_path)
+        if checkpoint_dir is not None:
+            state = {
+                "model": vae.state_dict(),
+                "optimizer": optimizer.state_dict(),
+                "train_losses": train_losses,
+                "val_losses": val_losses,
+                "best_val_loss": best_val_loss,
+                "step": step,
+            }
+            if trajectory is not None:
+                state["trajectory"] = trajectory.state()
+            if early_stopping is not None:
+                state["early_stopping"] = early_stopping.state()
+            checkpoints.save(epoch, state, is_best)
+        monitor.lap("checkpoint")
+        monitor.end_epoch(epoch, step, train_losses[-1], epoch_val_loss)
+        if stop:
+            break
 
-    return train_losses, val_losses, None if grid is None else processed_grids
+    checkpoints.close()
+    monitor.close()
+    # After stopping early, pad the results to the shapes of a full run (see EarlyStopping)
+    stopped = early_stopping is not None and early_stopping.stopped_epoch is not None
+    if stopped:
+        train_losses = pad_epochs(train_losses, num_epochs).tolist()
+        val_losses = pad_epochs(val_losses, num_epochs).tolist()
+    if trajectory is None:
+        return train_losses, val_losses, None
+    trajectory.close()
+    snapshots = trajectory.snapshots()
+    if stopped:
+        snapshots = torch.from_numpy(pad_epochs(snapshots.numpy(), trajectory.capacity))
+    return train_losses, val_losses, snapshots
@@ -0,0 +1,349 @@
+import os
+
+import numpy as np
+
+store_magic = b"VAETRC02"
+store_header = np.dtype(
+    [
+        ("magic", "S8"),
+        ("bits", "u1"),
+        ("delta", "u1"),
+        ("keyframe_interval", "<u2"),
+        ("num_points", "<u4"),
+        ("dims", "<u4"),
+    ]
+)
+# Key of every chunk, in file order, in the index sidecar written next to the store on close
+index_dtype = np.dtype([("model", "<u4"), ("epoch", "<u4"), ("step", "<i8")])
+
+
+def index_path(path: str) -> str:
+    return path + ".idx"
+
+
+def chunk_dtype(bits: int, num_points: int, dims: int) -> np.dtype:
+    """
+    Returns the record type of one chunk: its key (model, epoch and training step), the losses of
+    that epoch, the per-axis offset and scale of the quantization and the quantized values.
+    """
+    if bits not in [8, 16]:
+        raise ValueError("Only 8 and 16 bit quantization is supported.")
+    return np.dtype(
+        [
+            ("model", "<u4"),
+            ("epoch", "<u4"),
+            ("step", "<i8"),
+            ("keyframe", "u1"),
+            ("padding", "u1", (3,)),
+            ("train_loss", "<f4"),
+            ("val_loss", "<f4"),
+            ("offset", "<f4", (dims,)),
+            ("scale", "<f4", (dims,)),
+            ("values", "<u1" if bits == 8 else "<u2", (num_points, dims)),
+        ]
+    )
+
+
+def quantize(values: np.ndarray, bits: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Quantizes values of shape (num_points, dims) with a separate offset and scale per axis.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: The quantized values, the offsets and the
+            scales. The reconstruction offset + quantized * scale is off by at most scale / 2.
+    """
+    offset = values.min(axis=0).astype(np.float32)
+    extent = values.max(axis=0) - offset
+    scale = np.where(extent > 0, extent / (2**bits - 1), 1.0).astype(np.float32)
+    quantized = np.clip(np.rint((values - offset) / scale), 0, 2**bits - 1)
+    return quantized.astype(np.uint8 if bits == 8 else np.uint16), offset, scale
+
+
+def read_index(path: str, dtype: np.dtype) -> np.ndarray:
+    """
+    Returns the keys (model, epoch, step) of the complete chunks of a store, from its index sidecar
+    if that is up to date, otherwise by reading the key of every chunk. A partially written last
+    chunk is ignored.
+    """
+    num_chunks = (os.path.getsize(path) - store_header.itemsize) // dtype.itemsize
+    if os.path.exists(index_path(path)):
+        keys = np.fromfile(index_path(path), dtype=index_dtype)
+        if len(keys) == num_chunks:
+            return keys
+    chunks = np.memmap(
+        path, dtype=dtype, mode="r", offset=store_header.itemsize, shape=(num_chunks,)
+    )
+    keys = np.empty(num_chunks, index_dtype)
+    keys["model"] = chunks["model"]
+    keys["epoch"] = chunks["epoch"]
+    keys["step"] = chunks["step"]
+    return keys
+
+
+def dequantize(quantized: np.ndarray, offset: np.ndarray, scale: np.ndarray) -> np.ndarray:
+    result: np.ndarray = offset + quantized.astype(np.float32) * scale
+    return result
+
+
+class TrajectoryWriter:
+    def __init__(
+        self,
+        path: str,
+        num_points: int,
+        dims: int = 2,
+        bits: int = 8,
+        delta: bool = False,
+        keyframe_interval: int = 10,
+    ):
+        """
+        Appends quantized per-(model, epoch) chunks of grid encodings (and the losses of that
+        epoch) to a trajectory store. If the file exists, its parameters must match and new chunks
+        are appended to it, so a store can be written incrementally during training. On close, the
+        keys of all chunks are written to an index sidecar (path + ".idx"), so that readers don't
+        have to touch every chunk to find one.
+
+        With delta encoding, a chunk stores the difference to the reconstruction of the previous
+        chunk of the same model, which needs fewer bits for the same error as training converges.
+        Every keyframe_interval-th chunk of a model is stored in full, which bounds the work of a
+        random access.
+
+        Args:
+            path (str): Path of the store.
+            num_points (int): Number of grid points per chunk.
+            dims (int): Dimension of each point.
+            bits (int): Quantization bits, 8 or 16.
+            delta (bool): Whether to use delta encoding between consecutive epochs.
+            keyframe_interval (int): Distance between full chunks when delta encoding.
+        """
+        self.dtype = chunk_dtype(bits, num_points, dims)
+        self.bits = bits
+        self.delta = delta
+        self.keyframe_interval = keyframe_interval
+        self.num_points = num_points
+        self.dims = dims
+        self.path = path
+        # Reconstruction of the last chunk and number of chunks since the last keyframe, per model
+        self.previous: dict[int, tuple[np.ndarray, int]] = {}
+        header = np.array(
+            [(store_magic, bits, delta, keyframe_interval, num_points, dims)], store_header
+        )
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            existing = np.fromfile(path, dtype=store_header, count=1)
+            if existing.tobytes() != header.tobytes():
+                raise ValueError(f"{path} was written with different parameters")
+            self.keys = read_index(path, self.dtype).tolist()
+            # Chunks appended after reopening start with a keyframe, see self.previous
+            self.file = open(path, "ab")
+        else:
+            self.keys = []
+            if os.path.exists(index_path(path)):
+                os.remove(index_path(path))
+            self.file = open(path, "wb")
+            self.file.write(header.tobytes())
+
+    def append(
+        self,
+        model: int,
+        epoch: int,
+        values: np.ndarray,
+        train_loss: float = np.nan,
+        val_loss: float = np.nan,
+        step: int = -1,
+    ) -> None:
+        """
+        Appends the values of shape (num_points, dims) of a model at an epoch and training step (-1
+        if unknown). A model can have several chunks per epoch, e.g. when recording every n steps.
+        """
+        values = np.asarray(values, dtype=np.float32).reshape(self.num_points, self.dims)
+        chunk = np.zeros(1, self.dtype)
+        previous = self.previous.get(model)
+        keyframe = not self.delta or previous is None or previous[1] + 1 >= self.keyframe_interval
+        base = np.zeros_like(values) if keyframe or previous is None else previous[0]
+        quantized, offset, scale = quantize(values - base, self.bits)
+        chunk["model"] = model
+        chunk["epoch"] = epoch
+        chunk["step"] = step
+        chunk["keyframe"] = keyframe
+        chunk["train_loss"] = train_loss
+        chunk["val_loss"] = val_loss
+        chunk["offset"] = offset
+        chunk["scale"] = scale
+        chunk["values"] = quantized
+        self.file.write(chunk.tobytes())
+        self.keys.append((model, epoch, step))
+        if self.delta:
+            # Encode the next delta against what a reader will reconstruct, so errors don't add up
+            reconstruction = base + dequantize(quantized, offset, scale)
+            self.previous[model] = (
+                reconstruction,
+                0 if keyframe or previous is None else previous[1] + 1,
+            )
+
+    def flush(self) -> None:
+        self.file.flush()
+
+    def truncate(self, num_chunks: int) -> None:
+        """
+        Drops all but the first num_chunks chunks, e.g. those written after the checkpoint that
+        training resumes from.
+        """
+        self.file.flush()
+        self.file.truncate(store_header.itemsize + num_chunks * self.dtype.itemsize)
+        del self.keys[num_chunks:]
+        # The next chunk of every model is a keyframe, so it can't refer to a dropped one
+        self.previous.clear()
+
+    def close(self) -> None:
+        self.file.close()
+        np.array(self.keys, dtype=index_dtype).tofile(index_path(self.path))
+
+
+class TrajectoryReader:
+    def __init__(self, path: str):
+        """
+        Reads a trajectory store through a memory map, so single (model, epoch) chunks can be read
+        without loading the rest of the file. The chunks are located through the index sidecar, or,
+        if it is missing or stale (e.g. after a crash), by reading the key of every chunk. A
+        partially written last chunk is ignored.
+
+        Model and epoch ids don't have to be contiguous: losses and read_all lay out the models and
+        epochs in the order of the sorted ids in self.models and self.epochs.
+        """
+        header = np.fromfile(path, dtype=store_header, count=1)[0]
+        if header["magic"] != store_magic:
+            raise ValueError(f"{path} is not a trajectory store")
+        self.bits = int(header["bits"])
+        self.delta = bool(header["delta"])
+        self.num_points = int(header["num_points"])
+        self.dims = int(header["dims"])
+        dtype = chunk_dtype(self.bits, self.num_points, self.dims)
+        self.keys = read_index(path, dtype)
+        self.chunks = np.memmap(
+            path, dtype=dtype, mode="r", offset=store_header.itemsize, shape=(len(self.keys),)
+        )
+        self.index = {
+            (int(model), int(epoch)): i
+            for i, (model, epoch) in enumerate(zip(self.keys["model"], self.keys["epoch"]))
+        }
+        self.models = np.unique(self.keys["model"])
+        self.epochs = np.unique(self.keys["epoch"])
+        # Position of the previous chunk of the same model, for delta decoding
+        self.previous_chunk: dict[int, int] = {}
+        last: dict[int, int] = {}
+        for i, model in enumerate(self.keys["model"].tolist()):
+            if model in last:
+                self.previous_chunk[i] = last[model]
+            last[model] = i
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    @property
+    def num_models(self) -> int:
+        return len(self.models)
+
+    @property
+    def num_epochs(self) -> int:
+        return len(self.epochs)
+
+    def read_chunk(self, i: int) -> np.ndarray:
+        chunk = self.chunks[i]
+        values = dequantize(chunk["values"], chunk["offset"], chunk["scale"])
+        if chunk["keyframe"]:
+            return values
+        reconstruction: np.ndarray = self.read_chunk(self.previous_chunk[i]) + values
+        return reconstruction
+
+    def read(self, model: int, epoch: int) -> np.ndarray:
+        """
+        Returns the values of shape (num_points, dims) of a model at an epoch, the last chunk of
+        the epoch if there are several.
+        """
+        return self.read_chunk(self.index[(model, epoch)])
+
+    def trajectory(self, model: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns all chunks of a model in the order they were written.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray]: Steps and epochs of the chunks (both of
+                shape (n,)) and the values of shape (n, num_points, dims).
+        """
+        chunks = np.flatnonzero(self.keys["model"] == model)
+        values = np.zeros((len(chunks), self.num_points, self.dims), dtype=np.float32)
+        for j, i in enumerate(chunks):
+            values[j] = self.read_chunk(int(i))
+        return self.keys["step"][chunks], self.keys["epoch"][chunks], values
+
+    def max_error(self, model: int, epoch: int) -> np.ndarray:
+        """
+        Returns the per-axis bound of the absolute error of read(model, epoch): half a quantization
+        step plus float32 rounding.
+        """
+        chunk = self.chunks[self.index[(model, epoch)]]
+        magnitude = (
+            np.abs(self.read(model, epoch)).max(axis=0)
+            + np.abs(chunk["offset"])
+            + chunk["scale"] * (2**self.bits - 1)
+        )
+        bound: np.ndarray = chunk["scale"] / 2 + 4 * np.finfo(np.float32).eps * magnitude
+        return bound
+
+    def losses(self) -> np.ndarray:
+        """
+        Returns the losses of shape (num_models, 2, num_epochs) (train and validation), in the
+        layout of losses.bin. Missing (model, epoch) chunks are NaN.
+        """
+        rows = np.searchsorted(self.models, self.keys["model"])
+        cols = np.searchsorted(self.epochs, self.keys["epoch"])
+        result = np.full((self.num_models, 2, self.num_epochs), np.nan, dtype=np.float32)
+        result[rows, 0, cols] = self.chunks["train_loss"]
+        result[rows, 1, cols] = self.chunks["val_loss"]
+        return result
+
+    def read_all(self) -> np.ndarray:
+        """
+        Returns all values as an array of shape (num_models, num_epochs, num_points, dims).
+        Missing (model, epoch) chunks are NaN; of several chunks per epoch, the last one is used.
+        """
+        result = np.full(
+            (self.num_models, self.num_epochs, self.num_points, self.dims),
+            np.nan,
+            dtype=np.float32,
+        )
+        rows = np.searchsorted(self.models, self.keys["model"])
+        cols = np.searchsorted(self.epochs, self.keys["epoch"])
+        for i in range(len(self.keys)):
+            result[rows[i], cols[i]] = self.read_chunk(i)
+        return result
+
+
+def write_trajectories(
+    path: str,
+    grids: np.ndarray,
+    losses: np.ndarray | None = None,
+    bits: int = 8,
+    delta: bool = False,
+    keyframe_interval: int = 10,
+) -> None:
+    """
+    Writes grid encodings of shape (num_models, num_epochs, num_points, dims) and, optionally,
+    losses of shape (num_models, 2, num_epochs) (as in losses.bin) to a new trajectory store.
+    """
+    num_models, num_epochs, num_points, dims = grids.shape
+    if os.path.exists(path):
+        os.remove(path)
+    writer = TrajectoryWriter(path, num_points, dims, bits, delta, keyframe_interval)
+    for epoch in range(num_epochs):
+        for model in range(num_models):
+            if losses is None:
+                writer.append(model, epoch, grids[model, epoch])
+            else:
+                writer.append(
+                    model,
+                    epoch,
+                    grids[model, epoch],
+                    losses[model, 0, epoch],
+                    losses[model, 1, epoch],
+                )
+    writer.close()
@@ -1,13 +1,25 @@
-import base64
+import functools
+import hashlib
+import inspect
+import io
+import json
 import os
-from typing import Iterator
+import sys
+import threading
+from collections import OrderedDict
+from queue import Empty, Full, Queue
+from typing import TYPE_CHECKING, Any, BinaryIO, Callable, Iterable, Iterator, TypeVar
 
-import matplotlib.pyplot as plt
 import numpy as np
 import torch
 from torch import nn
 
-from constants import latent_dim
+from constants import latent_dim, sidelength
+
+if TYPE_CHECKING:
+    from tqdm import tqdm
+
+T = TypeVar("T")
 
 
 # function to map value from [0, 1] to the specified range
@@ -54,7 +66,175 @@ class BatchIterator:
         return self.num_full_batches
 
 
+class ShardedBatchIterator:
+    def __init__(
+        self, data: torch.Tensor, batch_size: int, rank: int, world_size: int, seed: int = 0
+    ):
+        """
+        Creates an iterator over the shuffled batches of one rank in data-parallel training.
+
+        Every epoch, all ranks draw the same permutation of the data from seed and the epoch (see
+        set_epoch), and each rank takes every world_size-th sample of it, so the shards are disjoint
+        and change from epoch to epoch. Every rank gets the same number of full batches, which
+        DistributedDataParallel needs to keep the ranks in step; the few samples that don't fit are
+        dropped, as in BatchIterator.
+
+        Args:
+            data (torch.Tensor): The full dataset of shape (n, ...).
+            batch_size (int): The batch size of each rank.
+            rank (int): Index of this process.
+            world_size (int): Number of processes.
+            seed (int): Seed of the shuffle, the same on all ranks.
+        """
+        self.data = data
+        self.batch_size = batch_size
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        self.epoch = 0
+        self.n = data.shape[0] // world_size
+        self.num_full_batches = self.n // self.batch_size
+        if self.num_full_batches == 0:
+            raise ValueError("Batch size is larger than the shard size.")
+
+    def set_epoch(self, epoch: int) -> None:
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        generator = torch.Generator().manual_seed(self.seed + self.epoch)
+        permutation = torch.randperm(self.data.shape[0], generator=generator)
+        indices = permutation[self.rank :: self.world_size][: self.n]
+        for i in range(self.num_full_batches):
+            yield self.data[indices[i * self.batch_size : (i + 1) * self.batch_size]]
+
+    def __len__(self) -> int:
+        return self.num_full_batches
+
+
+class DeviceBatchIterator:
+    def __init__(
+        self,
+        data: torch.Tensor,
+        batch_size: int,
+        device: torch.device,
+        dtype: torch.dtype = torch.uint8,
+        keep_on_host: bool = False,
+        prefetch: int | None = None,
+    ):
+        """
+        Creates an iterator over shuffled, normalized float32 batches on the target device.
+
+        Unlike BatchIterator, the dataset is converted only once: it is moved to the device (unless
+        keep_on_host is set) and, for floating point dtypes, scaled to [0, 1] up front. Batches are
+        gathered on a background thread while the current step runs. Incomplete batches are dropped,
+        as in BatchIterator.
+
+        Args:
+            data (torch.Tensor): The full uint8 dataset of shape (n, ...).
+            batch_size (int): The desired batch size.
+            device (torch.device): The device the batches are used on.
+            dtype (torch.dtype): Storage type, torch.uint8 or a pre-normalized floating point type
+                like torch.float32 or torch.bfloat16.
+            keep_on_host (bool): Keep the data in host memory and copy every batch to the device
+                through pinned memory instead.
+            prefetch (int | None): Number of batches prepared ahead, 0 to disable the background
+                thread. Defaults to 2 for accelerators and 0 for the CPU, where the thread only
+                competes with the training step for the same cores.
+        """
+        storage_device = torch.device("cpu") if keep_on_host else device
+        if dtype.is_floating_point:
+            self.data = data.to(storage_device).to(dtype) / 255.0
+        else:
+            self.data = data.to(storage_device, dtype)
+        self.batch_size = batch_size
+        self.device = device
+        self.pin = keep_on_host and device.type == "cuda"
+        self.prefetch = (0 if device.type == "cpu" else 2) if prefetch is None else prefetch
+        self.n = data.shape[0]
+        self.num_full_batches = self.n // self.batch_size
+        if self.num_full_batches == 0:
+            raise ValueError("Batch size is larger than the dataset size.")
+
+    def get_batch(self, indices: torch.Tensor, i: int) -> torch.Tensor:
+        batch = self.data.index_select(0, indices[i * self.batch_size : (i + 1) * self.batch_size])
+        if self.pin:
+            batch = batch.pin_memory()
+        batch = batch.to(self.device, non_blocking=True)
+        if not batch.is_floating_point():
+            return batch.float() / 255.0
+        return batch.float()
+
+    def produce(
+        self,
+        indices: torch.Tensor,
+        queue: Queue[torch.Tensor | BaseException],
+        stop: threading.Event,
+    ) -> None:
+        def put(item: torch.Tensor | BaseException) -> None:
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    pass
+
+        try:
+            for i in range(self.num_full_batches):
+                put(self.get_batch(indices, i))
+                if stop.is_set():
+                    return
+        except BaseException as e:
+            # Hand the error to the consumer, which would otherwise wait for the batch forever
+            put(e)
+
+    def __iter__(self) -> Iterator[torch.Tensor]:
+        indices = torch.randperm(self.n, device=self.data.device)
+        if self.prefetch == 0:
+            for i in range(self.num_full_batches):
+                yield self.get_batch(indices, i)
+            return
+
+        queue: Queue[torch.Tensor | BaseException] = Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        producer = threading.Thread(target=self.produce, args=(indices, queue, stop), daemon=True)
+        producer.start()
+        try:
+            for _ in range(self.num_full_batches):
+                batch = queue.get()
+                if isinstance(batch, BaseException):
+                    raise batch
+                yield batch
+        finally:
+            # Unblock the producer if the consumer stops early
+            stop.set()
+            try:
+                while True:
+                    queue.get_nowait()
+            except Empty:
+                pass
+            producer.join()
+
+    def __len__(self) -> int:
+        return self.num_full_batches
+
+
+def progress(iterable: Iterable[T], show_progress: bool = True, **kwargs: Any) -> "tqdm[T]":
+    """
+    Wraps iterable in a notebook progress bar. tqdm.notebook (and with it ipywidgets) is only
+    imported when the bar is shown, so headless callers don't pay for it.
+    """
+    if show_progress:
+        from tqdm.notebook import tqdm as notebook_tqdm
+
+        return notebook_tqdm(iterable, **kwargs)
+    from tqdm import tqdm
+
+    return tqdm(iterable, disable=True, **kwargs)
+
+
 def plot_losses(train_losses: list[float], val_losses: list[float]) -> None:
+    import matplotlib.pyplot as plt
+
     _, ax = plt.subplots()
     ax.plot(train_losses, label="Train loss")
     ax.set_xlabel("Batch")
@@ -64,46 +244,22 @@ def plot_losses(train_losses: list[float], val_losses: list[float]) -> None:
     plt.tight_layout()
 
 
-def read_as_base64(file_path: str) -> str:
-    """
-    Reads a file and returns its content as a base64 encoded string.
-
-    Args:
-        file_path (str): Path to the file to be read.
+onnx_opset_version = 14
+default_onnx_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "vae", "onnx")
 
-    Returns:
-        str: Base64 encoded content of the file.
-    """
-    with open(file_path, "rb") as file:
-        return base64.b64encode(file.read()).decode("ascii")
+encoder_input_shape = (1, 3, sidelength, sidelength)
+decoder_input_shape = (1, latent_dim)
 
 
-def random_string(length: int = 10) -> str:
-    """
-    Generates a random string of fixed length.
-
-    Args:
-        length (int): Length of the random string to be generated.
-
-    Returns:
-        str: Randomly generated string.
-    """
-    import random
-    import string
-
-    letters = string.ascii_letters + string.digits
-    return "".join(random.choice(letters) for _ in range(length))
-
-
-def onnx_export_encoder(encoder: nn.Module, encoder_path: str) -> None:
+def onnx_export_encoder(encoder: nn.Module, f: str | BinaryIO) -> None:
     # Dummy image input
-    encoder_dummy_input: torch.Tensor = torch.randn(1, 3, 32, 32)
+    encoder_dummy_input: torch.Tensor = torch.randn(*encoder_input_shape)
 
     # Export to ONNX
     torch.onnx.export(
         encoder,
         (encoder_dummy_input,),
-        encoder_path,
+        f,  # type: ignore[arg-type]  # file-like objects are accepted as well
         input_names=["image"],
         output_names=["mu", "logvar"],
         dynamic_axes={
@@ -111,54 +267,168 @@ def onnx_export_encoder(encoder: nn.Module, encoder_path: str) -> None:
             "mu": {0: "batch_size"},
             "logvar": {0: "batch_size"},
         },
-        opset_version=14,
+        opset_version=onnx_opset_version,
     )
 
 
-def onnx_export_decoder(decoder: nn.Module, decoder_path: str) -> None:
+def onnx_export_decoder(decoder: nn.Module, f: str | BinaryIO) -> None:
     # Dummy latent input
-    decoder_dummy_input: torch.Tensor = torch.randn(1, latent_dim)
+    decoder_dummy_input: torch.Tensor = torch.randn(*decoder_input_shape)
 
     # Export to ONNX
     torch.onnx.export(
         decoder,
         (decoder_dummy_input,),
-        decoder_path,
+        f,  # type: ignore[arg-type]
         input_names=["z"],
         output_names=["reconstruction"],
         dynamic_axes={"z": {0: "batch_size"}, "reconstruction": {0: "batch_size"}},
-        opset_version=14,
+        opset_version=onnx_opset_version,
     )
 
 
-def onnx_export_to_files(
-    encoder: nn.Module, decoder: nn.Module, encoder_path: str, decoder_path: str
-) -> None:
+def state_dict_digest(module: nn.Module) -> str:
     """
-    Exports the VAE encoder and decoder to ONNX format and stores them at the specified paths.
+    Returns a digest of the names, types, shapes and values of a module's parameters and buffers.
     """
-    onnx_export_encoder(encoder, encoder_path)
-    onnx_export_decoder(decoder, decoder_path)
+    digest = hashlib.sha256()
+    for name, tensor in sorted(module.state_dict().items()):
+        tensor = tensor.detach().cpu().contiguous()
+        digest.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode("utf-8"))
+        digest.update(tensor.view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
 
 
-def onnx_export(encoder: nn.Module, decoder: nn.Module) -> tuple[str, str]:
+@functools.cache
+def source_digest(module_name: str) -> str:
     """
-    Exports the VAE encoder and decoder to ONNX format and returns it as base64 encoded strings.
+    Returns a digest of the source of a Python module, e.g. the one defining a model, so that
+    changes to its forward code, or to the helpers it calls, are noticed.
     """
+    try:
+        source = inspect.getsource(sys.modules[module_name])
+    except (KeyError, OSError, TypeError):
+        # E.g. defined interactively, fall back to the name
+        source = module_name
+    return hashlib.sha256(source.encode("utf-8")).hexdigest()
 
-    encoder_path = "/tmp/encoder_" + random_string() + ".onnx"
-    decoder_path = "/tmp/decoder_" + random_string() + ".onnx"
 
-    onnx_export_to_files(encoder, decoder, encoder_path, decoder_path)
+class OnnxExportCache:
+    def __init__(self, max_entries: int = 32, cache_dir: str | None = None):
+        """
+        Caches ONNX exports of encoders and decoders, so that exporting the same weights again is
+        free.
 
-    encoder_base64 = read_as_base64(encoder_path)
-    decoder_base64 = read_as_base64(decoder_path)
+        Entries are keyed by the module type and structure, digests of its source and of its state
+        dict, the torch version (which contains the exporter), the opset version and the dummy input
+        shape. The most recently used max_entries exports are kept in memory; if a
+        cache_dir is given (e.g. default_onnx_cache_dir), exports are also stored on disk and
+        survive the process.
+
+        Args:
+            max_entries (int): Number of exports kept in memory.
+            cache_dir (str | None): Directory of the on-disk tier, None to keep exports in memory
+                only.
+        """
+        self.max_entries = max_entries
+        self.cache_dir = cache_dir
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, module: nn.Module, input_shape: tuple[int, ...]) -> str:
+        params = {
+            "type": type(module).__qualname__,
+            "structure": repr(module),
+            "source": source_digest(type(module).__module__),
+            "torch": torch.__version__,
+            "state_dict": state_dict_digest(module),
+            "opset": onnx_opset_version,
+            "input_shape": list(input_shape),
+        }
+        return hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+    def get(
+        self,
+        module: nn.Module,
+        input_shape: tuple[int, ...],
+        export: Callable[[nn.Module, BinaryIO], None],
+    ) -> bytes:
+        """
+        Returns the ONNX export of a module, running export only on a cache miss.
+        """
+        key = self.key(module, input_shape)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+
+        path = None if self.cache_dir is None else os.path.join(self.cache_dir, f"{key}.onnx")
+        if path is not None and os.path.isfile(path):
+            with open(path, "rb") as f:
+                data = f.read()
+        else:
+            buffer = io.BytesIO()
+            export(module, buffer)
+            data = buffer.getvalue()
+            if path is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = f"{path}.{os.getpid()}.tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+
+        with self.lock:
+            self.entries[key] = data
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return data
+
+    def encoder(self, encoder: nn.Module) -> bytes:
+        return self.get(encoder, encoder_input_shape, onnx_export_encoder)
+
+    def decoder(self, decoder: nn.Module) -> bytes:
+        return self.get(decoder, decoder_input_shape, onnx_export_decoder)
+
+    def clear(self) -> None:
+        """
+        Empties the in-memory tier (the on-disk tier is left alone).
+        """
+        with self.lock:
+            self.entries.clear()
+
+
+# Shared by onnx_export and onnx_export_to_files
+onnx_export_cache = OnnxExportCache()
+
+
+def onnx_export_to_files(
+    encoder: nn.Module,
+    decoder: nn.Module,
+    encoder_path: str,
+    decoder_path: str,
+    cache: OnnxExportCache = onnx_export_cache,
+) -> None:
+    """
+    Exports the VAE encoder and decoder to ONNX format and stores them at the specified paths.
+    """
+    with open(encoder_path, "wb") as f:
+        f.write(cache.encoder(encoder))
+    with open(decoder_path, "wb") as f:
+        f.write(cache.decoder(decoder))
 
-    # Clean up temporary files
-    os.remove(encoder_path)
-    os.remove(decoder_path)
 
-    return encoder_base64, decoder_base64
+def onnx_export(
+    encoder: nn.Module, decoder: nn.Module, cache: OnnxExportCache = onnx_export_cache
+) -> tuple[bytes, bytes]:
+    """
+    Exports the VAE encoder and decoder to ONNX format and returns the serialized models, as
+    expected by the widgets in vaewidgets.
+
+    The export happens in memory and is cached (see OnnxExportCache), so rendering several widgets
+    for the same model only exports it once.
+    """
+    return cache.encoder(encoder), cache.decoder(decoder)
 
 
 def compress_floats(data: np.ndarray) -> bytes:
@@ -178,9 +448,3 @@ def expand_floats(data: bytes) -> np.ndarray:
     extent = maxval - minval
     float_data: np.ndarray = np.frombuffer(data[8:], dtype=np.uint8).astype(np.float32)
     return minval + float_data / 255.0 * extent
-
-
-def stringify_coords(coords: list[tuple[float, float]]) -> tuple[str, str]:
-    x_str = ",".join([f"{x:.3f}" for x, y in coords])
-    y_str = ",".join([f"{y:.3f}" for x, y in coords])
-    return x_str, y_str
@@ -1,3 +1,5 @@
+import functools
+import gzip
 from base64 import b64encode
 
 import anywidget
@@ -6,20 +8,37 @@ import torch
 import traitlets
 from IPython.display import HTML
 
-from util import compress_floats, stringify_coords
+from datasetfile import write_dataset, write_web_files
+from image import face_path
+from trajectorystore import TrajectoryReader
+from util import compress_floats
 
 
+@functools.cache
 def get_js(label: str) -> str:
     with open(f"widget-wrappers/dist/{label}.js") as js_file:
         return js_file.read()
 
 
+@functools.cache
+def get_face_img_bytes() -> bytes:
+    with open(face_path, "rb") as f:
+        return f.read()
+
+
+@functools.cache
 def get_face_img_base64_url() -> str:
-    with open("../misc/face.png", "rb") as f:
-        face_img_base64 = b64encode(f.read()).decode("ascii")
+    face_img_base64 = b64encode(get_face_img_bytes()).decode("ascii")
     return f"data:image/png;base64,{face_img_base64}"
 
 
+def compress(data: bytes) -> bytes:
+    """
+    Compresses a widget payload with gzip; the front end inflates it with DecompressionStream.
+    """
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+
 def widget(js: str, height: int = 300) -> HTML:
     return HTML(  # type: ignore[no-untyped-call]
         f"""
@@ -73,77 +92,90 @@ class AreaSelectionWidget(anywidget.AnyWidget):
         self.height = initial_height
 
 
+class DatasetVisualizationWidget(anywidget.AnyWidget):
+    _esm = "widget-wrappers/dist/datasetvisualization.js"
+    trainsetCoords = traitlets.Bytes().tag(sync=True)
+    valsetCoords = traitlets.Bytes().tag(sync=True)
+    trainsetImages = traitlets.Bytes().tag(sync=True)
+    valsetImages = traitlets.Bytes().tag(sync=True)
+
+    def __init__(
+        self,
+        trainset_coords: list[tuple[float, float]],
+        valset_coords: list[tuple[float, float]],
+        trainset_images: bytes,
+        valset_images: bytes,
+    ) -> None:
+        super().__init__()
+        self.trainsetCoords = compress(np.array(trainset_coords, dtype="<f4").tobytes())
+        self.valsetCoords = compress(np.array(valset_coords, dtype="<f4").tobytes())
+        self.trainsetImages = compress(trainset_images)
+        self.valsetImages = compress(valset_images)
+
+
 def dataset_visualization(
     trainset_coords: list[tuple[float, float]],
     valset_coords: list[tuple[float, float]],
     trainset: torch.Tensor,
     valset: torch.Tensor,
     write_to_files: bool = False,
-) -> HTML:
-    trainset_coords_x, trainset_coords_y = stringify_coords(trainset_coords)
-    valset_coords_x, valset_coords_y = stringify_coords(valset_coords)
+) -> DatasetVisualizationWidget:
     trainset_images_bytes = trainset.numpy().tobytes()
     valset_images_bytes = valset.numpy().tobytes()
     if write_to_files:
-        with open("trainset_coords.json", "w") as f:
-            f.write(f'{{"x": [{trainset_coords_x}], "y": [{trainset_coords_y}]}}')
-        with open("valset_coords.json", "w") as f:
-            f.write(f'{{"x": [{valset_coords_x}], "y": [{valset_coords_y}]}}')
-        with open("trainset_images.bin", "wb") as f:
-            f.write(trainset_images_bytes)
-        with open("valset_images.bin", "wb") as f:
-            f.write(valset_images_bytes)
-    trainset_images_base64 = b64encode(trainset_images_bytes).decode("ascii")
-    valset_images_base64 = b64encode(valset_images_bytes).decode("ascii")
-
-    js = get_js("datasetvisualization")
-
-    return widget(
-        f"""
-        var datasetVisualizationTrainsetX = [{trainset_coords_x}];
-        var datasetVisualizationTrainsetY = [{trainset_coords_y}];
-        var datasetVisualizationValsetX = [{valset_coords_x}];
-        var datasetVisualizationValsetY = [{valset_coords_y}];
-        var datasetVisualizationTrainsetImagesBase64 = '{trainset_images_base64}';
-        var datasetVisualizationValsetImagesBase64 = '{valset_images_base64}';
-        {js}
-        """,
+        write_dataset("dataset.vds", trainset_coords, valset_coords, trainset, valset)
+        write_web_files(trainset_coords, valset_coords, trainset, valset)
+    return DatasetVisualizationWidget(
+        trainset_coords, valset_coords, trainset_images_bytes, valset_images_bytes
     )
 
 
+class MappingWidget(anywidget.AnyWidget):
+    _esm = "widget-wrappers/dist/mapping.js"
+    encoder = traitlets.Bytes().tag(sync=True)
+    decoder = traitlets.Bytes().tag(sync=True)
+    faceImg = traitlets.Bytes().tag(sync=True)
+    valsetBounds: traitlets.List[list[float]] = traitlets.List(
+        default_value=None, allow_none=True
+    ).tag(sync=True)
+
+    def __init__(
+        self,
+        encoder: bytes,
+        decoder: bytes,
+        valset_bounds: tuple[tuple[float, float], tuple[float, float]] | None = None,
+    ) -> None:
+        super().__init__()
+        self.encoder = compress(encoder)
+        self.decoder = compress(decoder)
+        self.faceImg = get_face_img_bytes()
+        if valset_bounds is not None:
+            self.valsetBounds = [list(from_to) for from_to in valset_bounds]
+
+
 def mapping(
-    encoder_base64: str,
-    decoder_base64: str,
+    encoder: bytes,
+    decoder: bytes,
     valset_bounds: tuple[tuple[float, float], tuple[float, float]] | None = None,
-) -> HTML:
-    js = get_js("mapping")
-    face_img_base64_url = get_face_img_base64_url()
-    if valset_bounds is None:
-        valset_bounds_str = "null"
-    else:
-        valset_bounds_str = f"{[list(from_to) for from_to in valset_bounds]}"
-    return widget(
-        f"""
-        var encoderBase64 = '{encoder_base64}';
-        var decoderBase64 = '{decoder_base64}';
-        var faceImgUrl = '{face_img_base64_url}';
-        var valsetBounds = {valset_bounds_str};
-        {js}
-        """,
-    )
+) -> MappingWidget:
+    return MappingWidget(encoder, decoder, valset_bounds)
 
 
-def decoding(encoder_base64: str, decoder_base64: str) -> HTML:
-    js = get_js("decoding")
-    face_img_base64_url = get_face_img_base64_url()
-    return widget(
-        f"""
-        var encoderBase64 = '{encoder_base64}';
-        var decoderBase64 = '{decoder_base64}';
-        var faceImgUrl = '{face_img_base64_url}';
-        {js}
-        """,
-    )
+class DecodingWidget(anywidget.AnyWidget):
+    _esm = "widget-wrappers/dist/decoding.js"
+    encoder = traitlets.Bytes().tag(sync=True)
+    decoder = traitlets.Bytes().tag(sync=True)
+    faceImg = traitlets.Bytes().tag(sync=True)
+
+    def __init__(self, encoder: bytes, decoder: bytes) -> None:
+        super().__init__()
+        self.encoder = compress(encoder)
+        self.decoder = compress(decoder)
+        self.faceImg = get_face_img_bytes()
+
+
+def decoding(encoder: bytes, decoder: bytes) -> DecodingWidget:
+    return DecodingWidget(encoder, decoder)
 
 
 class GridViewer(anywidget.AnyWidget):
@@ -164,40 +196,53 @@ class GridViewer(anywidget.AnyWidget):
         self.grid = grid
 
 
-def model_comparison(losses: bytes, grids: bytes) -> HTML:
-    js = get_js("modelcomparison")
-    losses_base64 = b64encode(losses).decode("ascii")
-    grids_base64 = b64encode(grids).decode("ascii")
-    return widget(
-        f"""
-        var lossesBase64 = '{losses_base64}';
-        var gridsBase64 = '{grids_base64}';
-        {js}
-        """,
-        340,
-    )
+class ModelComparisonWidget(anywidget.AnyWidget):
+    _esm = "widget-wrappers/dist/modelcomparison.js"
+    losses = traitlets.Bytes().tag(sync=True)
+    grids = traitlets.Bytes().tag(sync=True)
 
+    def __init__(self, losses: bytes, grids: bytes) -> None:
+        super().__init__()
+        self.losses = compress(losses)
+        self.grids = compress(grids)
 
-def evolution(train_losses: list[float], val_losses: list[float], grid_data: np.ndarray) -> HTML:
-    converted_grid_data = compress_floats(grid_data)
-    js = get_js("evolution")
-    grid_data_base64 = b64encode(converted_grid_data).decode("ascii")
-    return widget(
-        f"""
-        var trainLosses = [{",".join(f"{loss:.3f}" for loss in train_losses)}];
-        var valLosses = [{",".join(f"{loss:.3f}" for loss in val_losses)}];
-        var gridDataBase64 = '{grid_data_base64}';
-        {js}
-        """,
-        340,
-    )
 
+def model_comparison(losses: bytes, grids: bytes) -> ModelComparisonWidget:
+    return ModelComparisonWidget(losses, grids)
 
-def sampling(decoder_base64: str) -> HTML:
-    js = get_js("sampling")
-    return widget(
-        f"""
-        var decoderBase64 = '{decoder_base64}';
-        {js}
-        """,
-    )
+
+class EvolutionWidget(anywidget.AnyWidget):
+    _esm = "widget-wrappers/dist/evolution.js"
+    trainLosses = traitlets.Bytes().tag(sync=True)
+    valLosses = traitlets.Bytes().tag(sync=True)
+    gridData = traitlets.Bytes().tag(sync=True)
+
+    def __init__(
+        self, train_losses: list[float], val_losses: list[float], grid_data: np.ndarray
+    ) -> None:
+        super().__init__()
+        self.trainLosses = compress(np.array(train_losses, dtype="<f4").tobytes())
+        self.valLosses = compress(np.array(val_losses, dtype="<f4").tobytes())
+        self.gridData = compress(compress_floats(grid_data))
+
+
+def evolution(
+    train_losses: list[float], val_losses: list[float], grid_data: np.ndarray | str
+) -> EvolutionWidget:
+    if isinstance(grid_data, str):
+        # Path of a trajectory store written during training (see TrajectoryRecorder)
+        _, _, grid_data = TrajectoryReader(grid_data).trajectory(0)
+    return EvolutionWidget(train_losses, val_losses, grid_data)
+
+
+class SamplingWidget(anywidget.AnyWidget):
+    _esm = "widget-wrappers/dist/sampling.js"
+    decoder = traitlets.Bytes().tag(sync=True)
+
+    def __init__(self, decoder: bytes) -> None:
+        super().__init__()
+        self.decoder = compress(decoder)
+
+
+def sampling(decoder: bytes) -> SamplingWidget:
+    return SamplingWidget(decoder)
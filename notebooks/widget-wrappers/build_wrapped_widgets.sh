@@ -8,17 +8,17 @@ npx esbuild src/datasetexplanation.ts --bundle --format=iife --loader:.png=datau
 
 npx esbuild ../../widgets/src/areaselection.ts --bundle --format=esm --outfile=dist/areaselection.js
 
-npx esbuild src/datasetvisualization.ts --bundle --format=iife --loader:.png=dataurl \
+npx esbuild src/datasetvisualization.ts --bundle --format=esm --loader:.png=dataurl \
     --outfile=dist/datasetvisualization.js
 
-npx esbuild src/mapping.ts --bundle --format=iife --loader:.png=dataurl --outfile=dist/mapping.js
+npx esbuild src/mapping.ts --bundle --format=esm --loader:.png=dataurl --outfile=dist/mapping.js
 
-npx esbuild src/decoding.ts --bundle --format=iife --outfile=dist/decoding.js
+npx esbuild src/decoding.ts --bundle --format=esm --outfile=dist/decoding.js
 
 npx esbuild ../../widgets/src/gridviewer.ts --bundle --format=esm --outfile=dist/gridviewer.js
 
-npx esbuild src/modelcomparison.ts --bundle --format=iife --outfile=dist/modelcomparison.js
+npx esbuild src/modelcomparison.ts --bundle --format=esm --outfile=dist/modelcomparison.js
 
-npx esbuild src/evolution.ts --bundle --format=iife --outfile=dist/evolution.js
+npx esbuild src/evolution.ts --bundle --format=esm --outfile=dist/evolution.js
 
-npx esbuild src/sampling.ts --bundle --format=iife --outfile=dist/sampling.js
+npx esbuild src/sampling.ts --bundle --format=esm --outfile=dist/sampling.js
@@ -4,13 +4,17 @@ import { setUpDatasetExplanation } from 'widgets/datasetexplanation';
 import { addErrorMessage } from 'widgets/dom';
 import { makeStandardGrid } from 'widgets/grid';
 
-import { getPreviousElementSibling } from './util';
-
 /* eslint-disable no-var */
 declare var faceImgUrl: string;
-var datasetExplanationContainer = getPreviousElementSibling() as HTMLDivElement;
 /* eslint-enable no-var */
 
+// The widget goes into the element right above this script tag
+const previousElement = (document.currentScript as HTMLScriptElement).previousElementSibling;
+if (!previousElement) {
+  throw new Error('No previous element sibling found.');
+}
+const datasetExplanationContainer = previousElement as HTMLDivElement;
+
 setUpDatasetExplanation(
   pica(),
   faceImgUrl,
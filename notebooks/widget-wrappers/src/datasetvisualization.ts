@@ -1,26 +1,51 @@
-import fromBase64 from 'es-arraybuffer-base64/Uint8Array.fromBase64';
+import type { AnyModel, Render, RenderProps } from '@anywidget/types';
 import { setUpDatasetVisualization } from 'widgets/datasetvisualization';
+import { addDiv } from 'widgets/dom';
 
-import { getPreviousElementSibling } from './util';
+import { decompress, decompressFloats, reportError } from './util';
 
-/* eslint-disable no-var */
-declare var datasetVisualizationTrainsetX: number[];
-declare var datasetVisualizationTrainsetY: number[];
-declare var datasetVisualizationValsetX: number[];
-declare var datasetVisualizationValsetY: number[];
-declare var datasetVisualizationTrainsetImagesBase64: string;
-declare var datasetVisualizationValsetImagesBase64: string;
+interface DatasetVisualizationModel {
+  // Float32 (x, y) pairs
+  trainsetCoords: DataView;
+  valsetCoords: DataView;
+  // uint8 images
+  trainsetImages: DataView;
+  valsetImages: DataView;
+}
 
-var trainsetImages: Uint8Array = fromBase64(datasetVisualizationTrainsetImagesBase64);
-var valsetImages: Uint8Array = fromBase64(datasetVisualizationValsetImagesBase64);
-/* eslint-enable no-var */
+function splitCoords(coords: Float32Array): [number[], number[]] {
+  const x: number[] = [];
+  const y: number[] = [];
+  for (let i = 0; i < coords.length; i += 2) {
+    x.push(coords[i]);
+    y.push(coords[i + 1]);
+  }
+  return [x, y];
+}
 
-setUpDatasetVisualization(
-    getPreviousElementSibling() as HTMLDivElement,
-    datasetVisualizationTrainsetX,
-    datasetVisualizationTrainsetY,
-    datasetVisualizationValsetX,
-    datasetVisualizationValsetY,
-    trainsetImages,
-    valsetImages
-);
+async function setUp(
+  model: AnyModel<DatasetVisualizationModel>, container: HTMLDivElement
+): Promise<void> {
+  const [trainsetX, trainsetY] = splitCoords(await decompressFloats(model.get('trainsetCoords')));
+  const [valsetX, valsetY] = splitCoords(await decompressFloats(model.get('valsetCoords')));
+  setUpDatasetVisualization(
+    container,
+    trainsetX,
+    trainsetY,
+    valsetX,
+    valsetY,
+    await decompress(model.get('trainsetImages')),
+    await decompress(model.get('valsetImages'))
+  );
+}
+
+const render: Render<DatasetVisualizationModel> = (
+  { model, el }: RenderProps<DatasetVisualizationModel>
+) => {
+  const container = addDiv(el, {}, { height: '300px' });
+  setUp(model, container).catch((error: unknown) => {
+    reportError(container, 'dataset visualization', error);
+  });
+};
+
+export default { render };
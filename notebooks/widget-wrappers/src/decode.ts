@@ -1,4 +1,3 @@
-import fromBase64 from 'es-arraybuffer-base64/Uint8Array.fromBase64';
 import { Semaphore } from 'widgets/semaphore';
 import type OrtFunction from 'widgets/types/ortfunction';
 
@@ -10,17 +9,12 @@ declare global {
   }
 }
 
-// Global variable injected by Python
-// eslint-disable-next-line no-var
-declare var decoderBase64: string;
-
-export async function makeGuardedDecode(): Promise<OrtFunction> {
+export async function makeGuardedDecode(decoderBytes: Uint8Array): Promise<OrtFunction> {
   if (window.decode !== undefined) {
     console.log('Using existing decode function');
     // If decode is already defined, return it directly
     return window.decode;
   }
-  const decoderBytes = fromBase64(decoderBase64);
   const decoderSession = await ort.InferenceSession.create(decoderBytes);
   const lock = new Semaphore(1);
   async function decode(zTensor: ort.Tensor): Promise<ort.InferenceSession.ReturnType> {
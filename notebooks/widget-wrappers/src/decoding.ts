@@ -1,46 +1,43 @@
+import type { AnyModel, Render, RenderProps } from '@anywidget/types';
 import * as ort from 'onnxruntime-web';
 import pica from 'pica';
 import { hueRange,sizeRange } from 'widgets/constants';
 import { setUpDecoding as setUpDecodingInternal } from 'widgets/decoding';
-import { addErrorMessage } from 'widgets/dom';
+import { addDiv } from 'widgets/dom';
 import { encodeGrid, makeStandardGrid } from 'widgets/grid';
 import { loadImage } from 'widgets/util';
 
 import { makeGuardedDecode } from './decode';
 import { makeGuardedEncode } from './encode';
-import { getPreviousElementSibling } from './util';
-
-/* eslint-disable no-var */
-declare var faceImgUrl: string;
-var settingUpDecoding = false;
-var decodingContainer = getPreviousElementSibling() as HTMLDivElement;
-/* eslint-enable no-var */
-
-async function setUpDecoding(): Promise<void> {
-  if (settingUpDecoding) {
-    console.warn('Decoding setup is already in progress.');
-    return;
-  }
-  settingUpDecoding = true;
-  const encode = await makeGuardedEncode();
-  const decode = await makeGuardedDecode();
+import { decompress, reportError, withImageUrl } from './util';
+
+interface DecodingModel {
+  encoder: DataView;
+  decoder: DataView;
+  faceImg: DataView;
+}
+
+async function setUpDecoding(
+  model: AnyModel<DecodingModel>, decodingContainer: HTMLDivElement
+): Promise<void> {
+  const encode = await makeGuardedEncode(await decompress(model.get('encoder')));
+  const decode = await makeGuardedDecode(await decompress(model.get('decoder')));
 
   const alphaGrid = makeStandardGrid(sizeRange, hueRange);
 
   const picaInstance = pica();
 
-  const img = await loadImage(faceImgUrl);
+  const img = await withImageUrl(model.get('faceImg'), loadImage);
   const zGrid = await encodeGrid(ort, picaInstance, img, encode, alphaGrid);
 
   setUpDecodingInternal(ort, decode, zGrid, decodingContainer);
-  settingUpDecoding = false;
 }
 
-setUpDecoding().catch((error: unknown) => {
-  console.error('Error setting up decoding:', error);
-  let msg = 'Unknown error';
-  if (error instanceof Error) {
-    msg = error.message;
-  }
-  addErrorMessage(decodingContainer, `Error setting up decoding widget: ${msg}`);
-});
+const render: Render<DecodingModel> = ({ model, el }: RenderProps<DecodingModel>) => {
+  const decodingContainer = addDiv(el, {}, { height: '300px' });
+  setUpDecoding(model, decodingContainer).catch((error: unknown) => {
+    reportError(decodingContainer, 'decoding', error);
+  });
+};
+
+export default { render };
@@ -1,4 +1,3 @@
-import fromBase64 from 'es-arraybuffer-base64/Uint8Array.fromBase64';
 import { Semaphore } from 'widgets/semaphore';
 import type OrtFunction from 'widgets/types/ortfunction';
 
@@ -10,17 +9,12 @@ declare global {
   }
 }
 
-// Global variable injected by Python
-// eslint-disable-next-line no-var
-declare var encoderBase64: string;
-
-export async function makeGuardedEncode(): Promise<OrtFunction> {
+export async function makeGuardedEncode(encoderBytes: Uint8Array): Promise<OrtFunction> {
   if (window.encode !== undefined) {
     console.log('Using existing encode function');
     // If encode is already defined, return it directly
     return window.encode;
   }
-  const encoderBytes = fromBase64(encoderBase64);
   const encoderSession = await ort.InferenceSession.create(encoderBytes);
   const lock = new Semaphore(1);
   async function encode(imageTensor: ort.Tensor): Promise<ort.InferenceSession.ReturnType> {
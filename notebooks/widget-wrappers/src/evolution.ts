@@ -1,25 +1,36 @@
-import fromBase64 from 'es-arraybuffer-base64/Uint8Array.fromBase64';
+import type { AnyModel, Render, RenderProps } from '@anywidget/types';
+import { addDiv } from 'widgets/dom';
 import { setUpEvolution as setUpEvolutionInternal } from 'widgets/evolution';
 import { expandFloats } from 'widgets/util';
 
-import { getPreviousElementSibling } from './util';
+import { decompress, decompressFloats, reportError } from './util';
 
-/* eslint-disable no-var */
-declare var trainLosses : number[];
-declare var valLosses : number[];
-declare var gridDataBase64: string;
-var decodingContainer = getPreviousElementSibling() as HTMLDivElement;
-/* eslint-enable no-var */
+interface EvolutionModel {
+  // Float32 losses
+  trainLosses: DataView;
+  valLosses: DataView;
+  // Grid data as written by util.compress_floats
+  gridData: DataView;
+}
 
-function setUpEvolution(): void {
-  const gridData = fromBase64(gridDataBase64);
+async function setUpEvolution(
+  model: AnyModel<EvolutionModel>, evolutionContainer: HTMLDivElement
+): Promise<void> {
+  const gridData = await decompress(model.get('gridData'));
   const [, , gridFloats] = expandFloats(gridData.buffer);
   setUpEvolutionInternal(
-    decodingContainer,
-    trainLosses,
-    valLosses,
+    evolutionContainer,
+    Array.from(await decompressFloats(model.get('trainLosses'))),
+    Array.from(await decompressFloats(model.get('valLosses'))),
     gridFloats
   );
 }
 
-setUpEvolution();
+const render: Render<EvolutionModel> = ({ model, el }: RenderProps<EvolutionModel>) => {
+  const evolutionContainer = addDiv(el, {}, { height: '340px' });
+  setUpEvolution(model, evolutionContainer).catch((error: unknown) => {
+    reportError(evolutionContainer, 'evolution', error);
+  });
+};
+
+export default { render };
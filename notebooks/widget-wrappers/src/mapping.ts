@@ -1,7 +1,8 @@
+import type { AnyModel, Render, RenderProps } from '@anywidget/types';
 import * as ort from 'onnxruntime-web';
 import pica from 'pica';
 import { hueRange,sizeRange } from 'widgets/constants';
-import { addErrorMessage } from 'widgets/dom';
+import { addDiv } from 'widgets/dom';
 import { encodeGrid, makeStandardGrid } from 'widgets/grid';
 import { setUpMapping as setUpMappingInternal } from 'widgets/mapping';
 import type Pair from 'widgets/types/pair';
@@ -9,42 +10,49 @@ import { loadImage } from 'widgets/util';
 
 import { makeGuardedDecode } from './decode';
 import { makeGuardedEncode } from './encode';
-import { getPreviousElementSibling } from './util';
-
-/* eslint-disable no-var */
-declare var faceImgUrl: string;
-declare var valsetBounds: Pair<Pair<number>>;
-var mappingContainer = getPreviousElementSibling() as HTMLDivElement;
-var settingUpMapping = false;
-/* eslint-enable no-var */
-
-async function setUpMapping(): Promise<void> {
-  if (settingUpMapping) {
-    console.warn('Mapping setup is already in progress.');
-    return;
-  }
-  settingUpMapping = true;
-  const encode = await makeGuardedEncode();
-  const decode = await makeGuardedDecode();
+import { decompress, reportError, withImageUrl } from './util';
+
+interface MappingModel {
+  encoder: DataView;
+  decoder: DataView;
+  faceImg: DataView;
+  valsetBounds: Pair<Pair<number>> | null;
+}
+
+async function setUpMapping(
+  model: AnyModel<MappingModel>, mappingContainer: HTMLDivElement
+): Promise<void> {
+  const encode = await makeGuardedEncode(await decompress(model.get('encoder')));
+  const decode = await makeGuardedDecode(await decompress(model.get('decoder')));
 
   const alphaGrid = makeStandardGrid(sizeRange, hueRange);
 
   const picaInstance = pica();
 
-  const img = await loadImage(faceImgUrl);
-  const zGrid = await encodeGrid(ort, picaInstance, img, encode, alphaGrid);
-
-  await setUpMappingInternal(
-    ort, picaInstance, encode, decode, faceImgUrl, mappingContainer, alphaGrid, zGrid, valsetBounds
-  );
-  settingUpMapping = false;
+  // The URL is only needed until setUpMappingInternal has loaded the image
+  await withImageUrl(model.get('faceImg'), async(faceImgUrl): Promise<void> => {
+    const img = await loadImage(faceImgUrl);
+    const zGrid = await encodeGrid(ort, picaInstance, img, encode, alphaGrid);
+
+    await setUpMappingInternal(
+      ort,
+      picaInstance,
+      encode,
+      decode,
+      faceImgUrl,
+      mappingContainer,
+      alphaGrid,
+      zGrid,
+      model.get('valsetBounds') ?? undefined
+    );
+  });
 }
 
-setUpMapping().catch((error: unknown) => {
-  console.error('Error setting up mapping widget:', error);
-  let msg = 'Unknown error';
-  if (error instanceof Error) {
-    msg = error.message;
-  }
-  addErrorMessage(mappingContainer, `Error setting up mapping widget: ${msg}`);
-});
+const render: Render<MappingModel> = ({ model, el }: RenderProps<MappingModel>) => {
+  const mappingContainer = addDiv(el, {}, { height: '300px' });
+  setUpMapping(model, mappingContainer).catch((error: unknown) => {
+    reportError(mappingContainer, 'mapping', error);
+  });
+};
+
+export default { render };
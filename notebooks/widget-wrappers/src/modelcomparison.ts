@@ -1,33 +1,35 @@
-import fromBase64 from 'es-arraybuffer-base64/Uint8Array.fromBase64';
-import { addErrorMessage } from 'widgets/dom';
+import type { AnyModel, Render, RenderProps } from '@anywidget/types';
+import { addDiv } from 'widgets/dom';
 import { loadLosses } from 'widgets/lossdata';
 import { setUpModelComparison } from 'widgets/modelcomparison';
 import { expandFloats } from 'widgets/util';
 
-import { getPreviousElementSibling } from './util';
+import { decompress, reportError } from './util';
 
-/* eslint-disable no-var */
-declare var lossesBase64: string;
-declare var gridsBase64: string;
-var modelComparisonContainer = getPreviousElementSibling() as HTMLDivElement;
-/* eslint-enable no-var */
+interface ModelComparisonModel {
+  losses: DataView;
+  grids: DataView;
+}
 
-try {
-  const lossesUint8 = fromBase64(lossesBase64);
-  const gridsUint8 = fromBase64(gridsBase64);
+async function setUp(
+  model: AnyModel<ModelComparisonModel>, modelComparisonContainer: HTMLDivElement
+): Promise<void> {
+  const lossesUint8 = await decompress(model.get('losses'));
+  const gridsUint8 = await decompress(model.get('grids'));
   const [minLoss, maxLoss, trainLosses, valLosses] = loadLosses(lossesUint8.buffer);
   const [, , gridData] = expandFloats(gridsUint8.buffer);
   setUpModelComparison(
     modelComparisonContainer, minLoss, maxLoss, trainLosses, valLosses, gridData
   );
-} catch (error) {
-  console.error('Error setting up model comparison widget:', error);
-  let msg = 'Unknown error';
-  if (error instanceof Error) {
-    msg = error.message;
-  }
-  addErrorMessage(
-    modelComparisonContainer,
-    `Error setting up model comparison widget: ${msg}`
-  );
 }
+
+const render: Render<ModelComparisonModel> = (
+  { model, el }: RenderProps<ModelComparisonModel>
+) => {
+  const modelComparisonContainer = addDiv(el, {}, { height: '340px' });
+  setUp(model, modelComparisonContainer).catch((error: unknown) => {
+    reportError(modelComparisonContainer, 'model comparison', error);
+  });
+};
+
+export default { render };
@@ -1,32 +1,28 @@
+import type { AnyModel, Render, RenderProps } from '@anywidget/types';
 import * as ort from 'onnxruntime-web';
-import { addErrorMessage } from 'widgets/dom';
+import { addDiv } from 'widgets/dom';
 import { setUpSampling as setUpSamplingInternal } from 'widgets/sampling';
 
 import { makeGuardedDecode } from './decode';
-import { getPreviousElementSibling } from './util';
+import { decompress, reportError } from './util';
 
-/* eslint-disable no-var */
-var samplingContainer = getPreviousElementSibling() as HTMLDivElement;
-var settingUpSampling = false;
-/* eslint-enable no-var */
+interface SamplingModel {
+  decoder: DataView;
+}
 
-async function setUpSampling(): Promise<void> {
-  if (settingUpSampling) {
-    console.warn('Mapping setup is already in progress.');
-    return;
-  }
-  settingUpSampling = true;
-  const decode = await makeGuardedDecode();
+async function setUpSampling(
+  model: AnyModel<SamplingModel>, samplingContainer: HTMLDivElement
+): Promise<void> {
+  const decode = await makeGuardedDecode(await decompress(model.get('decoder')));
 
   await setUpSamplingInternal(ort, decode, samplingContainer);
-  settingUpSampling = false;
 }
 
-setUpSampling().catch((error: unknown) => {
-  console.error('Error setting up sampling widget:', error);
-  let msg = 'Unknown error';
-  if (error instanceof Error) {
-    msg = error.message;
-  }
-  addErrorMessage(samplingContainer, `Error setting up sampling widget: ${msg}`);
-});
+const render: Render<SamplingModel> = ({ model, el }: RenderProps<SamplingModel>) => {
+  const samplingContainer = addDiv(el, {}, { height: '300px' });
+  setUpSampling(model, samplingContainer).catch((error: unknown) => {
+    reportError(samplingContainer, 'sampling', error);
+  });
+};
+
+export default { render };
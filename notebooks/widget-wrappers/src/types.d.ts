@@ -1,4 +0,0 @@
-declare module 'es-arraybuffer-base64/Uint8Array.fromBase64' {
-  function fromBase64(base64: string): Uint8Array;
-  export default fromBase64;
-}
@@ -1,11 +1,39 @@
-export function getPreviousElementSibling(): Element {
-  // Get the current script tag
-  const currentScript = document.currentScript as HTMLScriptElement;
-
-  // Get the element right above the current script tag
-  const pes = currentScript.previousElementSibling;
-  if (!pes) {
-    throw new Error('No previous element sibling found.');
+import { addErrorMessage } from 'widgets/dom';
+
+function toArrayBuffer(data: DataView): ArrayBuffer {
+  return data.buffer.slice(data.byteOffset, data.byteOffset + data.byteLength) as ArrayBuffer;
+}
+
+// Decompresses a gzip-compressed binary buffer sent by Python
+export async function decompress(data: DataView): Promise<Uint8Array> {
+  const stream = new Blob([toArrayBuffer(data)]).stream().pipeThrough(
+    new DecompressionStream('gzip')
+  );
+  return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+export async function decompressFloats(data: DataView): Promise<Float32Array> {
+  const bytes = await decompress(data);
+  return new Float32Array(bytes.buffer);
+}
+
+// Passes an object URL of the image to use, which is revoked once use is done with it
+export async function withImageUrl<T>(
+  data: DataView, use: (url: string) => Promise<T>, type = 'image/png'
+): Promise<T> {
+  const url = URL.createObjectURL(new Blob([toArrayBuffer(data)], { type }));
+  try {
+    return await use(url);
+  } finally {
+    URL.revokeObjectURL(url);
+  }
+}
+
+export function reportError(container: HTMLElement, widgetName: string, error: unknown): void {
+  console.error(`Error setting up ${widgetName} widget:`, error);
+  let msg = 'Unknown error';
+  if (error instanceof Error) {
+    msg = error.message;
   }
-  return pes;
+  addErrorMessage(container, `Error setting up ${widgetName} widget: ${msg}`);
 }
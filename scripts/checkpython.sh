@@ -18,6 +18,8 @@ black --check --diff *.py
 
 mypy --strict --pretty *.py
 
+python check_import_time.py
+
 for notebook in *.ipynb; do
     python check_notebook_json.py $notebook
 done